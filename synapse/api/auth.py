@@ -14,7 +14,6 @@
 # limitations under the License.
 
 """This module contains classes for authenticating the user."""
-from canonicaljson import encode_canonical_json
 from signedjson.key import decode_verify_key_bytes
 from signedjson.sign import verify_signed_json, SignatureVerifyException
 
@@ -23,8 +22,9 @@ from twisted.internet import defer
 from synapse.api.constants import EventTypes, Membership, JoinRules
 from synapse.api.errors import AuthError, Codes, SynapseError, EventSizeError
 from synapse.types import Requester, RoomID, UserID, EventID
+from synapse.util.caches.descriptors import CACHE_SIZE_FACTOR
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.logutils import log_function
-from synapse.util.logcontext import preserve_context_over_fn
 from unpaddedbase64 import decode_base64
 
 import logging
@@ -55,6 +55,12 @@ class Auth(object):
             "user_id = ",
         ])
 
+        # access token -> (UserID, is_guest), see
+        # _get_user_and_guest_from_macaroon
+        self._macaroon_cache = LruCache(
+            max_size=int(10000 * CACHE_SIZE_FACTOR)
+        )
+
     def check(self, event, auth_events):
         """ Checks if this event is correctly authed.
 
@@ -149,7 +155,7 @@ class Auth(object):
             too_big("type")
         if len(event.event_id) > 255:
             too_big("event_id")
-        if len(encode_canonical_json(event.get_pdu_json())) > 65536:
+        if len(event.get_json_bytes()) > 65536:
             too_big("event")
 
     @defer.inlineCallbacks
@@ -545,8 +551,7 @@ class Auth(object):
                 default=[""]
             )[0]
             if user and access_token and ip_addr:
-                preserve_context_over_fn(
-                    self.store.insert_client_ip,
+                self.store.insert_client_ip(
                     user=user,
                     access_token=access_token,
                     ip=ip_addr,
@@ -615,6 +620,51 @@ class Auth(object):
 
     @defer.inlineCallbacks
     def get_user_from_macaroon(self, macaroon_str):
+        user, guest = self._get_user_and_guest_from_macaroon(macaroon_str)
+
+        if guest:
+            ret = {
+                "user": user,
+                "is_guest": True,
+                "token_id": None,
+            }
+        else:
+            # This codepath exists so that we can actually return a
+            # token ID, because we use token IDs in place of device
+            # identifiers throughout the codebase.
+            # TODO(daniel): Remove this fallback when device IDs are
+            # properly implemented.
+            ret = yield self._look_up_user_by_access_token(macaroon_str)
+            if ret["user"] != user:
+                logger.error(
+                    "Macaroon user (%s) != DB user (%s)",
+                    user,
+                    ret["user"]
+                )
+                raise AuthError(
+                    self.TOKEN_NOT_FOUND_HTTP_STATUS,
+                    "User mismatch in macaroon",
+                    errcode=Codes.UNKNOWN_TOKEN
+                )
+        defer.returnValue(ret)
+
+    def _get_user_and_guest_from_macaroon(self, macaroon_str):
+        """Checks the access token macaroon and returns who it was issued to.
+
+        Verifying the macaroon means running through its HMAC chain, so we
+        cache the result for each token. That only depends on the token and
+        our secret key, since we don't check the expiry of access tokens;
+        revoked tokens are caught by the store lookup.
+
+        Returns:
+            (UserID, bool): The user and whether they are a guest.
+        Raises:
+            AuthError if the macaroon is invalid.
+        """
+        cached = self._macaroon_cache.get(macaroon_str)
+        if cached is not None:
+            return cached
+
         try:
             macaroon = pymacaroons.Macaroon.deserialize(macaroon_str)
             self.validate_macaroon(macaroon, "access", False)
@@ -627,44 +677,21 @@ class Auth(object):
                     user = UserID.from_string(caveat.caveat_id[len(user_prefix):])
                 elif caveat.caveat_id == "guest = true":
                     guest = True
-
-            if user is None:
-                raise AuthError(
-                    self.TOKEN_NOT_FOUND_HTTP_STATUS, "No user caveat in macaroon",
-                    errcode=Codes.UNKNOWN_TOKEN
-                )
-
-            if guest:
-                ret = {
-                    "user": user,
-                    "is_guest": True,
-                    "token_id": None,
-                }
-            else:
-                # This codepath exists so that we can actually return a
-                # token ID, because we use token IDs in place of device
-                # identifiers throughout the codebase.
-                # TODO(daniel): Remove this fallback when device IDs are
-                # properly implemented.
-                ret = yield self._look_up_user_by_access_token(macaroon_str)
-                if ret["user"] != user:
-                    logger.error(
-                        "Macaroon user (%s) != DB user (%s)",
-                        user,
-                        ret["user"]
-                    )
-                    raise AuthError(
-                        self.TOKEN_NOT_FOUND_HTTP_STATUS,
-                        "User mismatch in macaroon",
-                        errcode=Codes.UNKNOWN_TOKEN
-                    )
-            defer.returnValue(ret)
         except (pymacaroons.exceptions.MacaroonException, TypeError, ValueError):
             raise AuthError(
                 self.TOKEN_NOT_FOUND_HTTP_STATUS, "Invalid macaroon passed.",
                 errcode=Codes.UNKNOWN_TOKEN
             )
 
+        if user is None:
+            raise AuthError(
+                self.TOKEN_NOT_FOUND_HTTP_STATUS, "No user caveat in macaroon",
+                errcode=Codes.UNKNOWN_TOKEN
+            )
+
+        self._macaroon_cache.set(macaroon_str, (user, guest))
+        return user, guest
+
     def validate_macaroon(self, macaroon, type_string, verify_expiry):
         """
         validate that a Macaroon is understood by and was signed by this server.
@@ -749,7 +776,10 @@ class Auth(object):
 
     @defer.inlineCallbacks
     def add_auth_events(self, builder, context):
-        auth_ids = self.compute_auth_events(builder, context.current_state)
+        current_state = yield context.get_current_state(
+            self.auth_types_for_event(builder)
+        )
+        auth_ids = self.compute_auth_events(builder, current_state)
 
         auth_events_entries = yield self.store.add_event_hashes(
             auth_ids
@@ -757,6 +787,33 @@ class Auth(object):
 
         builder.auth_events = auth_events_entries
 
+    def auth_types_for_event(self, event):
+        """Get the (type, state_key) pairs of the state needed to auth the
+        event with `compute_auth_events` and `check`.
+        """
+        if event.type == EventTypes.Create:
+            return []
+
+        auth_types = [
+            (EventTypes.PowerLevels, "", ),
+            (EventTypes.Member, event.user_id, ),
+            (EventTypes.Create, "", ),
+        ]
+
+        if event.type == EventTypes.Member:
+            auth_types.append((EventTypes.JoinRules, "", ))
+            auth_types.append((EventTypes.Member, event.state_key, ))
+
+            e_type = event.content["membership"]
+            if e_type == Membership.INVITE:
+                if "third_party_invite" in event.content:
+                    auth_types.append((
+                        EventTypes.ThirdPartyInvite,
+                        event.content["third_party_invite"]["signed"]["token"]
+                    ))
+
+        return auth_types
+
     def compute_auth_events(self, event, current_state):
         if event.type == EventTypes.Create:
             return []
@@ -12,8 +12,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from twisted.internet import defer
+
 from synapse.api.errors import SynapseError
 from synapse.types import UserID, RoomID
+from synapse.util.caches.descriptors import CACHE_SIZE_FACTOR
+from synapse.util.caches.lrucache import LruCache
 
 import json
 
@@ -24,9 +28,25 @@ class Filtering(object):
         super(Filtering, self).__init__()
         self.store = hs.get_datastore()
 
+        # (user_localpart, filter_id) -> FilterCollection. Stored filters never
+        # change, so we only need to compile each of them once.
+        self._filter_collection_cache = LruCache(
+            max_size=int(1000 * CACHE_SIZE_FACTOR)
+        )
+
     def get_user_filter(self, user_localpart, filter_id):
+        key = (user_localpart, filter_id)
+        filter_collection = self._filter_collection_cache.get(key)
+        if filter_collection is not None:
+            return defer.succeed(filter_collection)
+
+        def compile_filter(filter_json):
+            filter_collection = FilterCollection(filter_json)
+            self._filter_collection_cache.set(key, filter_collection)
+            return filter_collection
+
         result = self.store.get_user_filter(user_localpart, filter_id)
-        result.addCallback(FilterCollection)
+        result.addCallback(compile_filter)
         return result
 
     def add_user_filter(self, user_localpart, user_filter):
@@ -189,16 +209,36 @@ class Filter(object):
     def __init__(self, filter_json):
         self.filter_json = filter_json
 
+        # The filter is compiled up front, as it is checked against every
+        # event we send down a sync.
+        self._rooms = _compile_literals(filter_json.get("rooms", None))
+        self._not_rooms = _compile_literals(filter_json.get("not_rooms", []))
+        self._senders = _compile_literals(filter_json.get("senders", None))
+        self._not_senders = _compile_literals(filter_json.get("not_senders", []))
+        self._types = _compile_wildcards(filter_json.get("types", None))
+        self._not_types = _compile_wildcards(filter_json.get("not_types", None))
+
+        self._matches_everything = not (
+            self._rooms is not None or self._not_rooms
+            or self._senders is not None or self._not_senders
+            or self._types is not None or self._not_types is not None
+        )
+
+        self._limit = filter_json.get("limit", 10)
+
     def check(self, event):
         """Checks whether the filter matches the given event.
 
         Returns:
             bool: True if the event matches
         """
+        if self._matches_everything:
+            return True
+
         sender = event.get("sender", None)
         if not sender:
             # Presence events have their 'sender' in content.user_id
-            content = event.get("content")
+            content = event.get("content", None)
             # account_data has been allowed to have non-dict content, so check type first
             if isinstance(content, dict):
                 sender = content.get("user_id")
@@ -215,22 +255,22 @@ class Filter(object):
         Returns:
             bool: True if the event fields match
         """
-        literal_keys = {
-            "rooms": lambda v: room_id == v,
-            "senders": lambda v: sender == v,
-            "types": lambda v: _matches_wildcard(event_type, v)
-        }
-
-        for name, match_func in literal_keys.items():
-            not_name = "not_%s" % (name,)
-            disallowed_values = self.filter_json.get(not_name, [])
-            if any(map(match_func, disallowed_values)):
+        if room_id in self._not_rooms:
+            return False
+        if self._rooms is not None and room_id not in self._rooms:
+            return False
+
+        if sender in self._not_senders:
+            return False
+        if self._senders is not None and sender not in self._senders:
+            return False
+
+        if self._not_types is not None:
+            if _matches_wildcards(event_type, self._not_types):
+                return False
+        if self._types is not None:
+            if not _matches_wildcards(event_type, self._types):
                 return False
-
-            allowed_values = self.filter_json.get(name, None)
-            if allowed_values is not None:
-                if not any(map(match_func, allowed_values)):
-                    return False
 
         return True
 
@@ -245,28 +285,51 @@ class Filter(object):
         """
         room_ids = set(room_ids)
 
-        disallowed_rooms = set(self.filter_json.get("not_rooms", []))
-        room_ids -= disallowed_rooms
+        room_ids -= self._not_rooms
 
-        allowed_rooms = self.filter_json.get("rooms", None)
-        if allowed_rooms is not None:
-            room_ids &= set(allowed_rooms)
+        if self._rooms is not None:
+            room_ids &= self._rooms
 
         return room_ids
 
     def filter(self, events):
-        return filter(self.check, events)
+        if self._matches_everything:
+            return list(events)
+        return [event for event in events if self.check(event)]
 
     def limit(self):
-        return self.filter_json.get("limit", 10)
+        return self._limit
+
+
+def _compile_literals(values):
+    """Turns a list of literal values from a filter into a set, leaving None
+    (i.e. no restriction) alone.
+    """
+    if values is None:
+        return None
+    return frozenset(values)
 
 
-def _matches_wildcard(actual_value, filter_value):
-    if filter_value.endswith("*"):
-        type_prefix = filter_value[:-1]
-        return actual_value.startswith(type_prefix)
-    else:
-        return actual_value == filter_value
+def _compile_wildcards(values):
+    """Turns a list of values from a filter, which may end with "*" to match
+    any suffix, into a set of exact values and a tuple of prefixes. None (i.e.
+    no restriction) is left alone.
+    """
+    if values is None:
+        return None
+
+    exact = frozenset(v for v in values if not v.endswith("*"))
+    prefixes = tuple(v[:-1] for v in values if v.endswith("*"))
+    return exact, prefixes
+
+
+def _matches_wildcards(actual_value, compiled):
+    exact, prefixes = compiled
+    if actual_value in exact:
+        return True
+    if not prefixes or actual_value is None:
+        return False
+    return actual_value.startswith(prefixes)
 
 
 DEFAULT_FILTER_COLLECTION = FilterCollection({})
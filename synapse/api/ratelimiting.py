@@ -12,16 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import collections
+import heapq
 
 
 class Ratelimiter(object):
     """
-    Ratelimit message sending by user.
+    Ratelimit actions by key, e.g. message sending by user.
+
+    Each key has a token bucket that fills up by one for each action and
+    drains at a constant rate. Keys are forgotten once their bucket has
+    drained, in expiry order, so that the cost of pruning is amortised over
+    the actions.
     """
 
     def __init__(self):
-        self.message_counts = collections.OrderedDict()
+        # key -> (action count, time start, rate hz)
+        self.message_counts = {}
+        # Heap of (expiry time, key), with at most one entry per key. Entries
+        # may be older than the key's expiry, in which case they get pushed
+        # back when popped.
+        self._expiry_heap = []
 
     def send_message(self, user_id, time_now_s, msg_rate_hz, burst_count):
         """Can the user send a message?
@@ -36,12 +46,29 @@ class Ratelimiter(object):
             A pair of a bool indicating if they can send a message now and a
                 time in seconds of when they can next send a message.
         """
+        return self.can_do_action(user_id, time_now_s, msg_rate_hz, burst_count)
+
+    def can_do_action(self, key, time_now_s, rate_hz, burst_count):
+        """Can the entity (e.g. user or server) perform the action?
+        Args:
+            key: The key to ratelimit on, e.g. a user ID or a tuple of the
+                action and a user ID, if different actions have different
+                limits.
+            time_now_s: The time now.
+            rate_hz: The long term number of actions that can be performed in
+                a second.
+            burst_count: How many actions can be performed before being
+                limited.
+        Returns:
+            A pair of a bool indicating if they can perform the action now and
+                a time in seconds of when they can next perform it.
+        """
         self.prune_message_counts(time_now_s)
-        message_count, time_start, _ignored = self.message_counts.pop(
-            user_id, (0., time_now_s, None),
+        message_count, time_start, old_rate_hz = self.message_counts.get(
+            key, (0., time_now_s, None),
         )
         time_delta = time_now_s - time_start
-        sent_count = message_count - time_delta * msg_rate_hz
+        sent_count = message_count - time_delta * rate_hz
         if sent_count < 0:
             allowed = True
             time_start = time_now_s
@@ -52,13 +79,20 @@ class Ratelimiter(object):
             allowed = True
             message_count += 1
 
-        self.message_counts[user_id] = (
-            message_count, time_start, msg_rate_hz
+        self.message_counts[key] = (
+            message_count, time_start, rate_hz
         )
 
-        if msg_rate_hz > 0:
+        if rate_hz > 0:
+            if not old_rate_hz > 0:
+                # Either a new key or one which previously never expired.
+                heapq.heappush(
+                    self._expiry_heap,
+                    (time_start + message_count / rate_hz, key),
+                )
+
             time_allowed = (
-                time_start + (message_count - burst_count + 1) / msg_rate_hz
+                time_start + (message_count - burst_count + 1) / rate_hz
             )
             if time_allowed < time_now_s:
                 time_allowed = time_now_s
@@ -68,12 +102,21 @@ class Ratelimiter(object):
         return allowed, time_allowed
 
     def prune_message_counts(self, time_now_s):
-        for user_id in self.message_counts.keys():
-            message_count, time_start, msg_rate_hz = (
-                self.message_counts[user_id]
-            )
-            time_delta = time_now_s - time_start
-            if message_count - time_delta * msg_rate_hz > 0:
-                break
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= time_now_s:
+            _, key = heapq.heappop(heap)
+
+            entry = self.message_counts.get(key)
+            if entry is None:
+                continue
+
+            message_count, time_start, rate_hz = entry
+            if not rate_hz > 0:
+                # The key will only expire once it's given a rate again.
+                continue
+
+            expiry = time_start + message_count / rate_hz
+            if expiry > time_now_s:
+                heapq.heappush(heap, (expiry, key))
             else:
-                del self.message_counts[user_id]
+                del self.message_counts[key]
@@ -62,7 +62,9 @@ from synapse.api.urls import (
 from synapse.config.homeserver import HomeServerConfig
 from synapse.crypto import context_factory
 from synapse.util.logcontext import LoggingContext
-from synapse.metrics.resource import MetricsResource, METRICS_PREFIX
+from synapse.metrics.resource import (
+    MetricsResource, METRICS_PREFIX, ProfileResource, PROFILE_PREFIX,
+)
 from synapse.replication.resource import ReplicationResource, REPLICATION_PREFIX
 from synapse.federation.transport.server import TransportLayerServer
 
@@ -169,6 +171,7 @@ class SynapseHomeServer(HomeServer):
 
                 if name == "metrics" and self.get_config().enable_metrics:
                     resources[METRICS_PREFIX] = MetricsResource(self)
+                    resources[PROFILE_PREFIX] = ProfileResource(self)
 
                 if name == "replication":
                     resources[REPLICATION_PREFIX] = ReplicationResource(self)
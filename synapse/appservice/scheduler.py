@@ -51,10 +51,14 @@ components.
 
 from synapse.appservice import ApplicationServiceState
 from twisted.internet import defer
+from canonicaljson import encode_canonical_json
+import synapse.metrics
 import logging
 
 logger = logging.getLogger(__name__)
 
+metrics = synapse.metrics.get_metrics_for(__name__)
+
 
 class AppServiceScheduler(object):
     """ Public facing API for this module. Does the required DI to tie the
@@ -62,7 +66,8 @@ class AppServiceScheduler(object):
     case is a simple array.
     """
 
-    def __init__(self, clock, store, as_api):
+    def __init__(self, clock, store, as_api, max_txn_events=None,
+                 max_txn_bytes=None):
         self.clock = clock
         self.store = store
         self.as_api = as_api
@@ -73,7 +78,26 @@ class AppServiceScheduler(object):
         self.txn_ctrl = _TransactionController(
             clock, store, as_api, create_recoverer
         )
-        self.queuer = _ServiceQueuer(self.txn_ctrl)
+        self.queuer = _ServiceQueuer(
+            self.txn_ctrl, max_txn_events=max_txn_events,
+            max_txn_bytes=max_txn_bytes,
+        )
+
+        metrics.register_callback(
+            "queued_events",
+            lambda: {
+                (service_id,): len(events)
+                for service_id, events in self.queuer.queued_events.items()
+            },
+            labels=["appservice"],
+        )
+        metrics.register_callback(
+            "unsent_transactions",
+            lambda: {
+                (r.service.id,): r.backlog for r in self.txn_ctrl.recoverers
+            },
+            labels=["appservice"],
+        )
 
     @defer.inlineCallbacks
     def start(self):
@@ -92,24 +116,59 @@ class _ServiceQueuer(object):
     """Queues events for the same application service together, sending
     transactions as soon as possible. Once a transaction is sent successfully,
     this schedules any other events in the queue to run.
+
+    Transactions are limited to max_txn_events events and max_txn_bytes bytes
+    of event JSON (if given), so that a backlog is split across several
+    transactions rather than sent as one huge one. A single event larger than
+    max_txn_bytes is still sent, on its own.
     """
 
-    def __init__(self, txn_ctrl):
+    def __init__(self, txn_ctrl, max_txn_events=None, max_txn_bytes=None):
         self.queued_events = {}  # dict of {service_id: [events]}
         self.pending_requests = {}  # dict of {service_id: Deferred}
         self.txn_ctrl = txn_ctrl
+        self.max_txn_events = max_txn_events
+        self.max_txn_bytes = max_txn_bytes
 
     def enqueue(self, service, event):
+        # add to queue for this service
+        self.queued_events.setdefault(service.id, []).append(event)
+
         # if this service isn't being sent something
         if not self.pending_requests.get(service.id):
-            self._send_request(service, [event])
+            self._send_request(service)
+
+    def _take_events(self, service):
+        """Removes the next transaction's worth of events from the queue for
+        the service.
+        """
+        queue = self.queued_events.get(service.id, [])
+
+        count = len(queue)
+        if self.max_txn_events:
+            count = min(count, self.max_txn_events)
+
+        if self.max_txn_bytes:
+            size = 0
+            for i, event in enumerate(queue[:count]):
+                size += len(encode_canonical_json(event.get_pdu_json()))
+                if size > self.max_txn_bytes:
+                    count = max(i, 1)
+                    break
+
+        events = queue[:count]
+        if count < len(queue):
+            self.queued_events[service.id] = queue[count:]
         else:
-            # add to queue for this service
-            if service.id not in self.queued_events:
-                self.queued_events[service.id] = []
-            self.queued_events[service.id].append(event)
+            self.queued_events.pop(service.id, None)
+
+        return events
+
+    def _send_request(self, service):
+        events = self._take_events(service)
+        if not events:
+            return
 
-    def _send_request(self, service, events):
         # send request and add callbacks
         d = self.txn_ctrl.send(service, events)
         d.addBoth(self._on_request_finish)
@@ -119,10 +178,7 @@ class _ServiceQueuer(object):
     def _on_request_finish(self, service):
         self.pending_requests[service.id] = None
         # if there are queued events, then send them.
-        if (service.id in self.queued_events
-                and len(self.queued_events[service.id]) > 0):
-            self._send_request(service, self.queued_events[service.id])
-            self.queued_events[service.id] = []
+        self._send_request(service)
 
     def _on_request_fail(self, err):
         logger.error("AS request failed: %s", err)
@@ -219,6 +275,8 @@ class _Recoverer(object):
         self.service = service
         self.callback = callback
         self.backoff_counter = 1
+        # the number of transactions waiting to be sent, as of the last retry
+        self.backlog = 0
 
     def recover(self):
         self.clock.call_later((2 ** self.backoff_counter), self.retry)
@@ -232,20 +290,28 @@ class _Recoverer(object):
     @defer.inlineCallbacks
     def retry(self):
         try:
-            txn = yield self.store.get_oldest_unsent_txn(self.service)
-            if txn:
+            # Send the backlog in order, one transaction at a time. This is a
+            # loop rather than recursion since the backlog may be long.
+            while True:
+                self.backlog = yield self.store.get_appservice_unsent_txn_count(
+                    self.service
+                )
+                txn = yield self.store.get_oldest_unsent_txn(self.service)
+                if not txn:
+                    self.backlog = 0
+                    self._set_service_recovered()
+                    return
+
                 logger.info("Retrying transaction %s for AS ID %s",
                             txn.id, txn.service.id)
                 sent = yield txn.send(self.as_api)
-                if sent:
-                    yield txn.complete(self.store)
-                    # reset the backoff counter and retry immediately
-                    self.backoff_counter = 1
-                    yield self.retry()
-                else:
+                if not sent:
                     self._backoff()
-            else:
-                self._set_service_recovered()
+                    return
+
+                yield txn.complete(self.store)
+                # reset the backoff counter and retry immediately
+                self.backoff_counter = 1
         except Exception as e:
             logger.exception(e)
             self._backoff()
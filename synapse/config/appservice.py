@@ -19,9 +19,22 @@ class AppServiceConfig(Config):
 
     def read_config(self, config):
         self.app_service_config_files = config.get("app_service_config_files", [])
+        self.app_service_max_txn_events = config.get(
+            "app_service_max_txn_events", 100
+        )
+        self.app_service_max_txn_size = self.parse_size(
+            config.get("app_service_max_txn_size", "1M")
+        )
 
     def default_config(cls, **kwargs):
         return """\
         # A list of application service config file to use
         app_service_config_files: []
+
+        # The maximum number of events, and total size of the events, to send
+        # to an application service in a single transaction. Events which
+        # arrive faster than the application service accepts them are split
+        # across several transactions.
+        app_service_max_txn_events: 100
+        app_service_max_txn_size: "1M"
         """
@@ -22,6 +22,12 @@ class DatabaseConfig(Config):
         self.event_cache_size = self.parse_size(
             config.get("event_cache_size", "10K")
         )
+        self.recent_events_per_room = int(
+            config.get("recent_events_per_room", 50)
+        )
+        self.recent_events_cache_size = self.parse_size(
+            config.get("recent_events_cache_size", "10K")
+        )
 
         self.database_config = config.get("database")
 
@@ -59,6 +65,13 @@ class DatabaseConfig(Config):
 
         # Number of events to cache in memory.
         event_cache_size: "10K"
+
+        # Number of the latest events of each room to keep in memory, used to
+        # serve the timelines of sync and initialSync.
+        recent_events_per_room: 50
+
+        # Number of rooms to keep the latest events of in memory.
+        recent_events_cache_size: "10K"
         """ % locals()
 
     def read_arguments(self, args):
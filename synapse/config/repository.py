@@ -55,7 +55,20 @@ class ContentRepositoryConfig(Config):
         self.max_image_pixels = self.parse_size(config["max_image_pixels"])
         self.media_store_path = self.ensure_directory(config["media_store_path"])
         self.uploads_path = self.ensure_directory(config["uploads_path"])
+
+        self.remote_media_cache_max_size = None
+        if config.get("remote_media_cache_max_size"):
+            self.remote_media_cache_max_size = self.parse_size(
+                config["remote_media_cache_max_size"]
+            )
+
+        self.remote_media_secondary_store_path = None
+        if config.get("remote_media_secondary_store_path"):
+            self.remote_media_secondary_store_path = self.ensure_directory(
+                config["remote_media_secondary_store_path"]
+            )
         self.dynamic_thumbnails = config["dynamic_thumbnails"]
+        self.thumbnail_processes = config.get("thumbnail_processes", 0)
         self.thumbnail_requirements = parse_thumbnail_requirements(
             config["thumbnail_sizes"]
         )
@@ -70,6 +83,16 @@ class ContentRepositoryConfig(Config):
         # Directory where in-progress uploads are stored.
         uploads_path: "%(uploads_path)s"
 
+        # The largest total size of remote media and thumbnails to keep in
+        # media_store_path. When it is exceeded the least recently used remote
+        # media is evicted. If not set the remote media cache is unbounded.
+        # remote_media_cache_max_size: "10G"
+
+        # Directory where remote media evicted from media_store_path is moved,
+        # for example on slower but cheaper disks. If not set evicted media
+        # is deleted and will be downloaded again if requested.
+        # remote_media_secondary_store_path: "/mnt/cold/media_store"
+
         # The largest allowed upload size in bytes
         max_upload_size: "10M"
 
@@ -83,6 +106,12 @@ class ContentRepositoryConfig(Config):
         # from a precalcualted list.
         dynamic_thumbnails: false
 
+        # Number of worker processes used to generate thumbnails. If 0 then
+        # thumbnails are generated in a thread of the main process, which
+        # competes with the rest of the server for the CPU. The workers are
+        # forked as the server starts, before any of its threads are running.
+        thumbnail_processes: 0
+
         # List of thumbnail to precalculate when an image is uploaded.
         thumbnail_sizes:
         - width: 32
@@ -23,7 +23,7 @@ from synapse.util.logcontext import (
     preserve_fn
 )
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
 from signedjson.sign import (
     verify_signed_json, signature_ids, sign_json, encode_canonical_json
@@ -102,12 +102,28 @@ class Keyring(object):
             group_id_to_group[group_id] = group
             group_id_to_json[group_id] = json_object
 
+        # The signatures for each server are checked in a single batch once
+        # the keys for all of that server's json objects have either been
+        # fetched or failed to be fetched. Batching per server means that a
+        # slow server doesn't hold up verifying everyone else's objects.
+        server_to_count = {}
+        for group in group_id_to_group.values():
+            server_to_count[group.server_name] = (
+                server_to_count.get(group.server_name, 0) + 1
+            )
+        server_to_verifier = {
+            server_name: _SignatureVerifier(count)
+            for server_name, count in server_to_count.items()
+        }
+
         @defer.inlineCallbacks
         def handle_key_deferred(group, deferred):
             server_name = group.server_name
+            verifier = server_to_verifier[server_name]
             try:
                 _, _, key_id, verify_key = yield deferred
             except IOError as e:
+                verifier.skip()
                 logger.warn(
                     "Got IOError when downloading keys for %s: %s %s",
                     server_name, type(e).__name__, str(e.message),
@@ -118,6 +134,7 @@ class Keyring(object):
                     Codes.UNAUTHORIZED,
                 )
             except Exception as e:
+                verifier.skip()
                 logger.exception(
                     "Got Exception when downloading keys for %s: %s %s",
                     server_name, type(e).__name__, str(e.message),
@@ -130,9 +147,8 @@ class Keyring(object):
 
             json_object = group_id_to_json[group.group_id]
 
-            try:
-                verify_signed_json(json_object, server_name, verify_key)
-            except:
+            verified = yield verifier.verify(json_object, server_name, verify_key)
+            if not verified:
                 raise SynapseError(
                     401,
                     "Invalid signature for server %s with key %s:%s" % (
@@ -691,3 +707,82 @@ class Keyring(object):
             ],
             consumeErrors=True,
         ).addErrback(unwrapFirstError)
+
+
+class _SignatureVerifier(object):
+    """Collects the json objects for a single server from a call to
+    verify_json_objects_for_server and checks their signatures in a single
+    batch in the reactor's thread pool, so that verifying a large batch
+    doesn't block the reactor.
+
+    The batch is started once every one of the `expected` json objects has
+    either been added with `verify` or given up on with `skip`.
+    """
+
+    def __init__(self, expected):
+        self._remaining = expected
+        self._pending = []
+
+    def verify(self, json_object, server_name, verify_key):
+        """Queues a json object to have its signature checked.
+
+        Returns:
+            Deferred: resolves to whether the signature was valid.
+        """
+        deferred = defer.Deferred()
+        self._pending.append((json_object, server_name, verify_key, deferred))
+        self._done_one()
+
+        # The batch completes in the logcontext of whichever caller started
+        # it, so make sure each caller resumes in its own.
+        return preserve_context_over_deferred(deferred)
+
+    def skip(self):
+        """Marks that one of the expected json objects won't be verified,
+        e.g. because we failed to fetch the key for it.
+        """
+        self._done_one()
+
+    def _done_one(self):
+        self._remaining -= 1
+        if self._remaining == 0:
+            self._run()
+
+    def _run(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        def on_results(results):
+            for (_, _, _, deferred), result in zip(pending, results):
+                deferred.callback(result)
+
+        def on_err(failure):
+            for _, _, _, deferred in pending:
+                deferred.errback(failure)
+
+        preserve_context_over_fn(
+            threads.deferToThread,
+            _verify_signed_jsons,
+            [(j, s, k) for j, s, k, _ in pending],
+        ).addCallbacks(on_results, on_err)
+
+
+def _verify_signed_jsons(to_verify):
+    """Checks the signatures on a list of json objects. This is run in a
+    worker thread.
+
+    Args:
+        to_verify (list): List of (json_object, server_name, verify_key)
+
+    Returns:
+        list of bools indicating whether each signature was valid.
+    """
+    results = []
+    for json_object, server_name, verify_key in to_verify:
+        try:
+            verify_signed_json(json_object, server_name, verify_key)
+            results.append(True)
+        except Exception:
+            results.append(False)
+    return results
@@ -16,6 +16,8 @@
 from synapse.util.frozenutils import freeze
 from synapse.util.caches import intern_dict
 
+from canonicaljson import encode_canonical_json
+
 
 # Whether we should use frozen_dict in FrozenEvent. Using frozen_dicts prevents
 # bugs where we accidentally share e.g. signature dicts. However, converting
@@ -51,6 +53,15 @@ def _event_dict_property(key):
     )
 
 
+# Keys that aren't covered by the content hash of an event
+_CONTENT_HASH_EXCLUDED_KEYS = (
+    "age_ts", "unsigned", "signatures", "hashes", "outlier", "destinations",
+)
+
+# Keys that aren't covered by the reference hash or signatures of an event
+_REDACTED_EXCLUDED_KEYS = ("age_ts", "unsigned", "signatures")
+
+
 class EventBase(object):
     def __init__(self, event_dict, signatures={}, unsigned={},
                  internal_metadata_dict={}, rejected_reason=None):
@@ -99,6 +110,33 @@ class EventBase(object):
     def get(self, key, default):
         return self._event_dict.get(key, default)
 
+    def get_json_bytes(self):
+        """Returns the canonical JSON encoding of `get_dict()`.
+        """
+        return encode_canonical_json(self.get_dict())
+
+    def get_content_hash_json_bytes(self):
+        """Returns the canonical JSON encoding of the parts of the event that
+        its content hash is calculated over.
+        """
+        event_json = self.get_pdu_json()
+        for key in _CONTENT_HASH_EXCLUDED_KEYS:
+            event_json.pop(key, None)
+        return encode_canonical_json(event_json)
+
+    def get_redacted_json_bytes(self):
+        """Returns the canonical JSON encoding of the redacted event, without
+        its signatures and unsigned data. This is what the reference hash and
+        the signatures of the event are calculated over.
+        """
+        # Imported here to avoid a circular import
+        from synapse.events.utils import prune_event
+
+        event_json = prune_event(self).get_pdu_json()
+        for key in _REDACTED_EXCLUDED_KEYS:
+            event_json.pop(key, None)
+        return encode_canonical_json(event_json)
+
     def get_internal_metadata_dict(self):
         return self.internal_metadata.get_dict()
 
@@ -158,6 +196,53 @@ class FrozenEvent(EventBase):
             rejected_reason=rejected_reason,
         )
 
+        # Lazily computed canonical JSON encodings of the event, which are
+        # reused when hashing, signing, checking and persisting the event.
+        self._content_hash_json_bytes = None
+        self._redacted_json_bytes = None
+
+        # Tuple of (signatures, unsigned, bytes). Unlike the rest of the
+        # event, signatures and unsigned can change, so we keep copies of them
+        # to check that the encoding is still valid.
+        self._json_bytes = None
+
+    def get_json_bytes(self):
+        if not USE_FROZEN_DICTS:
+            return super(FrozenEvent, self).get_json_bytes()
+
+        if self._json_bytes is not None:
+            signatures, unsigned, json_bytes = self._json_bytes
+            if signatures == self.signatures and unsigned == self.unsigned:
+                return json_bytes
+
+        json_bytes = super(FrozenEvent, self).get_json_bytes()
+        self._json_bytes = (
+            {name: dict(sigs) for name, sigs in self.signatures.items()},
+            dict(self.unsigned),
+            json_bytes,
+        )
+        return json_bytes
+
+    def get_content_hash_json_bytes(self):
+        if not USE_FROZEN_DICTS:
+            return super(FrozenEvent, self).get_content_hash_json_bytes()
+
+        if self._content_hash_json_bytes is None:
+            self._content_hash_json_bytes = (
+                super(FrozenEvent, self).get_content_hash_json_bytes()
+            )
+        return self._content_hash_json_bytes
+
+    def get_redacted_json_bytes(self):
+        if not USE_FROZEN_DICTS:
+            return super(FrozenEvent, self).get_redacted_json_bytes()
+
+        if self._redacted_json_bytes is None:
+            self._redacted_json_bytes = (
+                super(FrozenEvent, self).get_redacted_json_bytes()
+            )
+        return self._redacted_json_bytes
+
     @staticmethod
     def from_event(event):
         e = FrozenEvent(
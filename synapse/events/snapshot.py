@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from twisted.internet import defer
+
 
 class EventContext(object):
 
@@ -21,3 +23,30 @@ class EventContext(object):
         self.state_group = None
         self.rejected = False
         self.push_actions = []
+
+        # For contexts whose state is loaded on demand this is set instead of
+        # current_state. It is called with a list of types to load, see
+        # get_current_state.
+        self.state_loader = None
+
+    @defer.inlineCallbacks
+    def get_current_state(self, types=None):
+        """Get the state of the room before the event.
+
+        Args:
+            types (list): List of (type, state_key) tuples to load, where a
+                state_key of None matches any state_key. If None, all of the
+                state is loaded. If the state has already been loaded then
+                the returned dict may include more than the requested types.
+
+        Returns:
+            Deferred[dict]: (type, state_key) -> event
+        """
+        if self.current_state is not None:
+            defer.returnValue(self.current_state)
+
+        state = yield self.state_loader(types)
+        if types is None:
+            self.current_state = state
+
+        defer.returnValue(state)
@@ -14,7 +14,7 @@
 # limitations under the License.
 
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
 from synapse.events.utils import prune_event
 
@@ -23,6 +23,9 @@ from synapse.crypto.event_signing import check_event_content_hash
 from synapse.api.errors import SynapseError
 
 from synapse.util import unwrapFirstError
+from synapse.util.logcontext import (
+    preserve_context_over_deferred, preserve_context_over_fn,
+)
 
 import logging
 
@@ -116,23 +119,20 @@ class FederationBase(object):
         """Throws a SynapseError if a PDU does not have the correct
         signatures.
 
+        The PDUs are redacted and their content hashes checked in a worker
+        thread, and the signatures are then verified in a batch by the
+        keyring, so that large batches of PDUs don't block the reactor.
+
         Returns:
-            FrozenEvent: Either the given event or it redacted if it failed the
-            content hash check.
+            list of Deferreds, each resolving to either the given event or it
+            redacted if it failed the content hash check.
         """
+        deferreds = [defer.Deferred() for _ in pdus]
 
-        redacted_pdus = [
-            prune_event(pdu)
-            for pdu in pdus
-        ]
-
-        deferreds = self.keyring.verify_json_objects_for_server([
-            (p.origin, p.get_pdu_json())
-            for p in redacted_pdus
-        ])
-
-        def callback(_, pdu, redacted):
-            if not check_event_content_hash(pdu):
+        def callback(_, pdu, redacted, content_hash_ok):
+            if isinstance(content_hash_ok, SynapseError):
+                raise content_hash_ok
+            if not content_hash_ok:
                 logger.warn(
                     "Event content has been tampered, redacting %s: %s",
                     pdu.event_id, pdu.get_pdu_json()
@@ -148,11 +148,48 @@ class FederationBase(object):
             )
             return failure
 
-        for deferred, pdu, redacted in zip(deferreds, pdus, redacted_pdus):
-            deferred.addCallbacks(
-                callback, errback,
-                callbackArgs=[pdu, redacted],
-                errbackArgs=[pdu],
-            )
-
-        return deferreds
+        def verify(checked):
+            verify_deferreds = self.keyring.verify_json_objects_for_server([
+                (redacted.origin, redacted_json)
+                for redacted, redacted_json, _ in checked
+            ])
+
+            for deferred, verify_deferred, pdu, (redacted, _, content_hash_ok) in zip(
+                deferreds, verify_deferreds, pdus, checked
+            ):
+                verify_deferred.addCallbacks(
+                    callback, errback,
+                    callbackArgs=[pdu, redacted, content_hash_ok],
+                    errbackArgs=[pdu],
+                )
+                verify_deferred.chainDeferred(deferred)
+
+        def on_err(failure):
+            for deferred in deferreds:
+                deferred.errback(failure)
+
+        preserve_context_over_fn(
+            threads.deferToThread, _prune_and_check_hashes, pdus
+        ).addCallbacks(verify, on_err)
+
+        return [preserve_context_over_deferred(d) for d in deferreds]
+
+
+def _prune_and_check_hashes(pdus):
+    """Redacts each of the PDUs and checks their content hashes. This is run
+    in a worker thread.
+
+    Returns:
+        list of (redacted_pdu, redacted_pdu_json, content_hash_ok) tuples,
+        where content_hash_ok is either a bool or the SynapseError raised
+        while checking the hash.
+    """
+    results = []
+    for pdu in pdus:
+        redacted = prune_event(pdu)
+        try:
+            content_hash_ok = check_event_content_hash(pdu)
+        except SynapseError as e:
+            content_hash_ok = e
+        results.append((redacted, redacted.get_pdu_json(), content_hash_ok))
+    return results
@@ -107,6 +107,18 @@ class FederationClient(FederationBase):
         self._transaction_queue.enqueue_edu(edu)
         return defer.succeed(None)
 
+    @log_function
+    def send_presence(self, destination, states):
+        """Queues presence states to be sent to the given destination. Only
+        the latest state of each user is sent, in a single m.presence EDU.
+
+        Args:
+            destination (str)
+            states (list): List of UserPresenceState
+        """
+        self._transaction_queue.send_presence(destination, states)
+        return defer.succeed(None)
+
     @log_function
     def send_failure(self, failure, destination):
         self._transaction_queue.enqueue_failure(failure, destination)
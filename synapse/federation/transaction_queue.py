@@ -17,9 +17,10 @@
 from twisted.internet import defer
 
 from .persistence import TransactionActions
-from .units import Transaction
+from .units import Edu, Transaction
 
 from synapse.api.errors import HttpResponseException
+from synapse.storage.presence import format_user_presence_state
 from synapse.util.logutils import log_function
 from synapse.util.logcontext import PreserveLoggingContext
 from synapse.util.retryutils import (
@@ -68,6 +69,10 @@ class TransactionQueue(object):
         # destination -> list of tuple(edu, deferred)
         self.pending_edus_by_dest = edus = {}
 
+        # destination -> user_id -> UserPresenceState. Only the latest state
+        # of each user is kept, and they're all sent in a single EDU.
+        self.pending_presence_by_dest = presence = {}
+
         metrics.register_callback(
             "pending_pdus",
             lambda: sum(map(len, pdus.values())),
@@ -76,6 +81,10 @@ class TransactionQueue(object):
             "pending_edus",
             lambda: sum(map(len, edus.values())),
         )
+        metrics.register_callback(
+            "pending_presence",
+            lambda: sum(map(len, presence.values())),
+        )
 
         # destination -> list of tuple(failure, deferred)
         self.pending_failures_by_dest = {}
@@ -166,6 +175,27 @@ class TransactionQueue(object):
 
         return deferred
 
+    def send_presence(self, destination, states):
+        """Queues presence states to be sent to the destination in the next
+        transaction, replacing any queued state of the same users.
+
+        Args:
+            destination (str)
+            states (list): List of UserPresenceState
+        """
+        if not self.can_send_to(destination):
+            return
+
+        self.pending_presence_by_dest.setdefault(destination, {}).update({
+            state.user_id: state for state in states
+        })
+
+        def log_failure(f):
+            logger.warn("Failed to send presence to %s: %s", destination, f.value)
+
+        with PreserveLoggingContext():
+            self._attempt_new_transaction(destination).addErrback(log_failure)
+
     @defer.inlineCallbacks
     def enqueue_failure(self, failure, destination):
         if destination == self.server_name or destination == "localhost":
@@ -214,11 +244,35 @@ class TransactionQueue(object):
         pending_pdus = self.pending_pdus_by_dest.pop(destination, [])
         pending_edus = self.pending_edus_by_dest.pop(destination, [])
         pending_failures = self.pending_failures_by_dest.pop(destination, [])
+        pending_presence = self.pending_presence_by_dest.pop(destination, {})
 
         if pending_pdus:
             logger.debug("TX [%s] len(pending_pdus_by_dest[dest]) = %d",
                          destination, len(pending_pdus))
 
+        if pending_presence:
+            now = self._clock.time_msec()
+            presence_edu = Edu(
+                origin=self.server_name,
+                destination=destination,
+                edu_type="m.presence",
+                content={
+                    "push": [
+                        format_user_presence_state(state, now)
+                        for state in pending_presence.values()
+                    ],
+                },
+            )
+
+            def log_presence_failure(f):
+                logger.warn(
+                    "Failed to send presence to %s: %s", destination, f.value
+                )
+
+            deferred = defer.Deferred()
+            deferred.addErrback(log_presence_failure)
+            pending_edus.append((presence_edu, deferred))
+
         if not pending_pdus and not pending_edus and not pending_failures:
             logger.debug("TX [%s] Nothing to send", destination)
             return
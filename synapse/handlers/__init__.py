@@ -63,7 +63,9 @@ class Handlers(object):
             hs, asapi, AppServiceScheduler(
                 clock=hs.get_clock(),
                 store=hs.get_datastore(),
-                as_api=asapi
+                as_api=asapi,
+                max_txn_events=hs.config.app_service_max_txn_events,
+                max_txn_bytes=hs.config.app_service_max_txn_size,
             )
         )
         self.sync_handler = SyncHandler(hs)
@@ -36,6 +36,9 @@ VISIBILITY_PRIORITY = (
     "joined",
 )
 
+# The maximum number of forward extremities a new event will reference.
+MAX_PREV_EVENTS = 10
+
 
 class BaseHandler(object):
     """
@@ -204,6 +207,14 @@ class BaseHandler(object):
             builder.room_id,
         )
 
+        # Referencing every extremity makes state resolution for the new event
+        # more expensive, so we only pick the deepest few. The rest get merged
+        # in by later events.
+        if len(latest_ret) > MAX_PREV_EVENTS:
+            latest_ret = sorted(
+                latest_ret, key=lambda e: e[2], reverse=True,
+            )[:MAX_PREV_EVENTS]
+
         if latest_ret:
             depth = max([d for _, _, d in latest_ret]) + 1
         else:
@@ -219,7 +230,7 @@ class BaseHandler(object):
 
         state_handler = self.state_handler
 
-        context = yield state_handler.compute_event_context(builder)
+        context = yield state_handler.compute_event_context(builder, lazy=True)
 
         # If we've received an invite over federation, there are no latest
         # events in the room, because we don't know enough about the graph
@@ -227,8 +238,8 @@ class BaseHandler(object):
         # no relevant events. It may have returned some events (if we have
         # joined and left the room), but not useful ones, like the invite.
         if (
-            not self.is_host_in_room(context.current_state) and
-            builder.type == EventTypes.Member
+            builder.type == EventTypes.Member and
+            not self.is_host_in_room(context.current_state)
         ):
             prev_member_event = yield self.store.get_room_member(
                 builder.sender, builder.room_id
@@ -279,8 +290,8 @@ class BaseHandler(object):
         event = builder.build()
 
         logger.debug(
-            "Created event %s with current state: %s",
-            event.event_id, context.current_state,
+            "Created event %s with state group %s",
+            event.event_id, context.state_group,
         )
 
         defer.returnValue(
@@ -321,9 +332,14 @@ class BaseHandler(object):
         if ratelimit:
             self.ratelimit(requester)
 
-        self.auth.check(event, auth_events=context.current_state)
+        auth_events = yield context.get_current_state(
+            self.auth.auth_types_for_event(event)
+        )
+        self.auth.check(event, auth_events=auth_events)
 
-        yield self.maybe_kick_guest_users(event, context.current_state.values())
+        if event.type == EventTypes.GuestAccess:
+            current_state = yield context.get_current_state()
+            yield self.maybe_kick_guest_users(event, current_state.values())
 
         if event.type == EventTypes.CanonicalAlias:
             # Check the alias is acually valid (at this time at least)
@@ -382,7 +398,7 @@ class BaseHandler(object):
                     )
 
         if event.type == EventTypes.Redaction:
-            if self.auth.check_redaction(event, auth_events=context.current_state):
+            if self.auth.check_redaction(event, auth_events=auth_events):
                 original_event = yield self.store.get_event(
                     event.redacts,
                     check_redacted=False,
@@ -407,23 +423,14 @@ class BaseHandler(object):
             event, context, self
         )
 
+        # We fetch the servers in the room before persisting the event, so that
+        # e.g. a server whose last user is being kicked still gets the event.
+        destinations = yield self.store.get_joined_hosts_for_room(event.room_id)
+
         (event_stream_id, max_stream_id) = yield self.store.persist_event(
             event, context=context
         )
 
-        destinations = set()
-        for k, s in context.current_state.items():
-            try:
-                if k[0] == EventTypes.Member:
-                    if s.content["membership"] == Membership.JOIN:
-                        destinations.add(
-                            UserID.from_string(s.state_key).domain
-                        )
-            except SynapseError:
-                logger.warn(
-                    "Failed to get destination from event %s", s.event_id
-                )
-
         with PreserveLoggingContext():
             # Don't block waiting on waking up all the listeners.
             self.notifier.on_new_room_event(
@@ -27,7 +27,9 @@ from contextlib import contextmanager
 
 from synapse.api.errors import SynapseError
 from synapse.api.constants import PresenceState
-from synapse.storage.presence import UserPresenceState
+from synapse.storage.presence import (
+    UserPresenceState, format_user_presence_state,
+)
 
 from synapse.util.logcontext import preserve_fn
 from synapse.util.logutils import log_function
@@ -70,6 +72,14 @@ FEDERATION_TIMEOUT = 30 * 60 * 1000
 # How often to resend presence to remote servers
 FEDERATION_PING_INTERVAL = 25 * 60 * 1000
 
+# How often to write queued presence updates to the database. This bounds how
+# many updates are lost if the process dies.
+PERSIST_INTERVAL = 1000
+
+# How often to also write presence changes that only affect timers, and so
+# haven't been sent to anyone.
+UNPERSISTED_PERSIST_INTERVAL = 5 * 60 * 1000
+
 assert LAST_ACTIVE_GRANULARITY < IDLE_TIMER
 
 
@@ -152,9 +162,25 @@ class PresenceHandler(BaseHandler):
                 )
 
         # Set of users who have presence in the `user_to_current_state` that
-        # have not yet been persisted
+        # have not yet been persisted, and haven't been queued to be persisted.
         self.unpersisted_users_changes = set()
 
+        # user_id -> (stream_id, UserPresenceState) of updates that have been
+        # sent out but not yet written to the database.
+        self._pending_presence_writes = {}
+
+        # Same as above, for the batch that is currently being written.
+        self._presence_writes_in_flight = {}
+
+        self._persisting_presence = False
+        self._last_unpersisted_persist_ts = self.clock.time_msec()
+
+        self.clock.looping_call(self._persist_pending_presence, PERSIST_INTERVAL)
+
+        metrics.register_callback(
+            "pending_presence_writes", lambda: len(self._pending_presence_writes)
+        )
+
         reactor.addSystemEventTrigger("before", "shutdown", self._on_shutdown)
 
         self.serial_to_user = {}
@@ -187,18 +213,83 @@ class PresenceHandler(BaseHandler):
         earlier than they should when synapse is restarted. This affect of this
         is some spurious presence changes that will self-correct.
         """
+        yield self._queue_unpersisted_changes()
+
         logger.info(
             "Performing _on_shutdown. Persiting %d unpersisted changes",
-            len(self.user_to_current_state)
+            len(self._pending_presence_writes)
         )
 
-        if self.unpersisted_users_changes:
-            yield self.store.update_presence([
-                self.user_to_current_state[user_id]
-                for user_id in self.unpersisted_users_changes
-            ])
+        if self._pending_presence_writes:
+            stream_ids, states = zip(*self._pending_presence_writes.values())
+            yield self.store.persist_presence(stream_ids, states)
         logger.info("Finished _on_shutdown")
 
+    def _queue_presence_writes(self, stream_ids, states):
+        """Queues presence updates, which have been assigned the given stream
+        ids, to be written by the next _persist_pending_presence.
+        """
+        for stream_id, state in zip(stream_ids, states):
+            # Taking stream ids may have waited on the database, so a newer
+            # update for the user could have been queued in the meantime.
+            pending = self._pending_presence_writes.get(state.user_id)
+            if pending is None or pending[0] < stream_id:
+                self._pending_presence_writes[state.user_id] = (stream_id, state)
+
+    @defer.inlineCallbacks
+    def _queue_unpersisted_changes(self):
+        """Queues the changes in `unpersisted_users_changes` to be written to
+        the database. These have not been sent to anyone, so we don't mark the
+        users as changed in the presence stream.
+        """
+        if not self.unpersisted_users_changes:
+            return
+
+        states = [
+            self.user_to_current_state[user_id]
+            for user_id in self.unpersisted_users_changes
+        ]
+        self.unpersisted_users_changes = set()
+
+        stream_ids = yield self.store.take_presence_stream_ids(
+            states, update_stream_cache=False,
+        )
+        self._queue_presence_writes(stream_ids, states)
+
+    @defer.inlineCallbacks
+    def _persist_pending_presence(self):
+        """Writes all queued presence updates to the database in a single
+        transaction.
+        """
+        if self._persisting_presence:
+            return
+
+        self._persisting_presence = True
+        try:
+            now = self.clock.time_msec()
+            if now - self._last_unpersisted_persist_ts >= UNPERSISTED_PERSIST_INTERVAL:
+                self._last_unpersisted_persist_ts = now
+                yield self._queue_unpersisted_changes()
+
+            if not self._pending_presence_writes:
+                return
+
+            self._presence_writes_in_flight = self._pending_presence_writes
+            self._pending_presence_writes = {}
+
+            with Measure(self.clock, "presence_persist_pending"):
+                stream_ids, states = zip(*self._presence_writes_in_flight.values())
+                yield self.store.persist_presence(stream_ids, states)
+        except Exception:
+            logger.exception("Failed to persist presence updates")
+
+            # Try again next time, unless there has been a newer update.
+            for user_id, row in self._presence_writes_in_flight.items():
+                self._pending_presence_writes.setdefault(user_id, row)
+        finally:
+            self._presence_writes_in_flight = {}
+            self._persisting_presence = False
+
     @defer.inlineCallbacks
     def _update_states(self, new_states):
         """Updates presence of users. Sets the appropriate timeouts. Pokes
@@ -407,59 +498,89 @@ class PresenceHandler(BaseHandler):
         """Given a list of states return which entities (rooms, users, servers)
         are interested in the given states.
 
+        The rooms, presence list observers and joined hosts are looked up in
+        bulk for all the states at once, so the number of queries doesn't
+        grow with the number of states.
+
         Returns:
             3-tuple: `(room_ids_to_states, users_to_states, hosts_to_states)`,
-            with each item being a dict of `entity_name` -> `[UserPresenceState]`
+            with each item being a dict of `entity_name` -> `[UserPresenceState]`.
+            Each state appears at most once per host in `hosts_to_states`.
         """
+        user_ids = list(set(state.user_id for state in states))
+
+        rooms_by_user = yield self.store.get_rooms_for_users(user_ids)
+        observers_by_user = (
+            yield self.store.get_presence_list_observers_accepted_for_users(
+                user_ids
+            )
+        )
+
         room_ids_to_states = {}
         users_to_states = {}
         for state in states:
-            events = yield self.store.get_rooms_for_user(state.user_id)
-            for e in events:
+            for e in rooms_by_user[state.user_id]:
                 room_ids_to_states.setdefault(e.room_id, []).append(state)
 
-            plist = yield self.store.get_presence_list_observers_accepted(state.user_id)
-            for u in plist:
+            for u in observers_by_user[state.user_id]:
                 users_to_states.setdefault(u, []).append(state)
 
             # Always notify self
             users_to_states.setdefault(state.user_id, []).append(state)
 
-        hosts_to_states = {}
-        for room_id, states in room_ids_to_states.items():
-            local_states = filter(lambda s: self.hs.is_mine_id(s.user_id), states)
-            if not local_states:
-                continue
+        # host -> user_id -> state, so that each host gets each state once
+        hosts_to_user_states = {}
 
-            hosts = yield self.store.get_joined_hosts_for_room(room_id)
-            for host in hosts:
-                hosts_to_states.setdefault(host, []).extend(local_states)
+        local_room_states = {}
+        for room_id, room_states in room_ids_to_states.items():
+            local_states = [
+                s for s in room_states if self.hs.is_mine_id(s.user_id)
+            ]
+            if local_states:
+                local_room_states[room_id] = local_states
 
-        for user_id, states in users_to_states.items():
-            local_states = filter(lambda s: self.hs.is_mine_id(s.user_id), states)
+        hosts_by_room = yield self.store.get_joined_hosts_for_rooms(
+            local_room_states.keys()
+        )
+        for room_id, local_states in local_room_states.items():
+            for host in hosts_by_room[room_id]:
+                host_states = hosts_to_user_states.setdefault(host, {})
+                for s in local_states:
+                    host_states[s.user_id] = s
+
+        for user_id, user_states in users_to_states.items():
+            local_states = [
+                s for s in user_states if self.hs.is_mine_id(s.user_id)
+            ]
             if not local_states:
                 continue
 
             host = UserID.from_string(user_id).domain
-            hosts_to_states.setdefault(host, []).extend(local_states)
+            host_states = hosts_to_user_states.setdefault(host, {})
+            for s in local_states:
+                host_states[s.user_id] = s
 
-        # TODO: de-dup hosts_to_states, as a single host might have multiple
-        # of same presence
+        hosts_to_states = {
+            host: host_states.values()
+            for host, host_states in hosts_to_user_states.items()
+        }
 
         defer.returnValue((room_ids_to_states, users_to_states, hosts_to_states))
 
     @defer.inlineCallbacks
     def _persist_and_notify(self, states):
-        """Persist states in the database, poke the notifier and send to
-        interested remote servers
+        """Queue states to be persisted in the database, poke the notifier and
+        send to interested remote servers. The notifier is poked without
+        waiting for the states to be persisted.
         """
-        stream_id, max_token = yield self.store.update_presence(states)
+        stream_ids = yield self.store.take_presence_stream_ids(states)
+        self._queue_presence_writes(stream_ids, states)
 
         parties = yield self._get_interested_parties(states)
         room_ids_to_states, users_to_states, hosts_to_states = parties
 
         self.notifier.on_new_event(
-            "presence_key", stream_id, rooms=room_ids_to_states.keys(),
+            "presence_key", stream_ids[-1], rooms=room_ids_to_states.keys(),
             users=[UserID.from_string(u) for u in users_to_states.keys()]
         )
 
@@ -471,18 +592,8 @@ class PresenceHandler(BaseHandler):
         Args:
             hosts_to_states (dict): Mapping `server_name` -> `[UserPresenceState]`
         """
-        now = self.clock.time_msec()
         for host, states in hosts_to_states.items():
-            self.federation.send_edu(
-                destination=host,
-                edu_type="m.presence",
-                content={
-                    "push": [
-                        _format_user_presence_state(state, now)
-                        for state in states
-                    ]
-                }
-            )
+            self.federation.send_presence(host, states)
 
     @defer.inlineCallbacks
     def incoming_presence(self, origin, content):
@@ -562,13 +673,13 @@ class PresenceHandler(BaseHandler):
             defer.returnValue([
                 {
                     "type": "m.presence",
-                    "content": _format_user_presence_state(state, now),
+                    "content": format_user_presence_state(state, now),
                 }
                 for state in updates
             ])
         else:
             defer.returnValue([
-                _format_user_presence_state(state, now) for state in updates
+                format_user_presence_state(state, now) for state in updates
             ])
 
     @defer.inlineCallbacks
@@ -784,10 +895,27 @@ class PresenceHandler(BaseHandler):
         - status_msg(int)
         - currently_active(int)
         """
-        # TODO(markjh): replicate the unpersisted changes.
-        # This could use the in-memory stores for recent changes.
-        rows = yield self.store.get_all_presence_updates(last_id, current_id)
-        defer.returnValue(rows)
+        # Updates that haven't been persisted yet come from memory. We take
+        # them before reading the database so that a write that completes in
+        # the meantime can't be missed.
+        unpersisted = self._presence_writes_in_flight.values()
+        unpersisted.extend(self._pending_presence_writes.values())
+
+        db_rows = yield self.store.get_all_presence_updates(last_id, current_id)
+
+        rows_by_stream_id = {row[0]: row for row in db_rows}
+        for stream_id, state in unpersisted:
+            if last_id < stream_id <= current_id:
+                rows_by_stream_id[stream_id] = (
+                    stream_id, state.user_id, state.state, state.last_active_ts,
+                    state.last_federation_update_ts, state.last_user_sync_ts,
+                    state.status_msg, state.currently_active,
+                )
+
+        defer.returnValue([
+            rows_by_stream_id[stream_id]
+            for stream_id in sorted(rows_by_stream_id)
+        ])
 
 
 def should_notify(old_state, new_state):
@@ -814,24 +942,6 @@ def should_notify(old_state, new_state):
     return False
 
 
-def _format_user_presence_state(state, now):
-    """Convert UserPresenceState to a format that can be sent down to clients
-    and to other servers.
-    """
-    content = {
-        "presence": state.state,
-        "user_id": state.user_id,
-    }
-    if state.last_active_ts:
-        content["last_active_ago"] = now - state.last_active_ts
-    if state.status_msg and state.state != PresenceState.OFFLINE:
-        content["status_msg"] = state.status_msg
-    if state.state == PresenceState.ONLINE:
-        content["currently_active"] = state.currently_active
-
-    return content
-
-
 class PresenceEventSource(object):
     def __init__(self, hs):
         self.hs = hs
@@ -843,75 +953,34 @@ class PresenceEventSource(object):
     def get_new_events(self, user, from_key, room_ids=None, include_offline=True,
                        **kwargs):
         # The process for getting presence events are:
-        #  1. Get the rooms the user is in.
-        #  2. Get the list of user in the rooms.
-        #  3. Get the list of users that are in the user's presence list.
-        #  4. If there is a from_key set, cross reference the list of users
+        #  1. Get the users that share a room with the user, which is
+        #     maintained by the store.
+        #  2. Get the list of users that are in the user's presence list.
+        #  3. If there is a from_key set, cross reference the list of users
         #     with the `presence_stream_cache` to see which ones we actually
         #     need to check.
-        #  5. Load current state for the users.
+        #  4. Load current state for the users.
         #
         # We don't try and limit the presence updates by the current token, as
         # sending down the rare duplicate is not a concern.
 
         with Measure(self.clock, "presence.get_new_events"):
-            user_id = user.to_string()
             if from_key is not None:
                 from_key = int(from_key)
-            room_ids = room_ids or []
 
             presence = self.hs.get_handlers().presence_handler
             stream_change_cache = self.store.presence_stream_cache
 
-            if not room_ids:
-                rooms = yield self.store.get_rooms_for_user(user_id)
-                room_ids = set(e.room_id for e in rooms)
-            else:
-                room_ids = set(room_ids)
-
             max_token = self.store.get_current_presence_token()
 
-            plist = yield self.store.get_presence_list_accepted(user.localpart)
-            friends = set(row["observed_user_id"] for row in plist)
-            friends.add(user_id)  # So that we receive our own presence
-
-            user_ids_changed = set()
-            changed = None
-            if from_key and max_token - from_key < 100:
-                # For small deltas, its quicker to get all changes and then
-                # work out if we share a room or they're in our presence list
-                changed = stream_change_cache.get_all_entities_changed(from_key)
-
-            # get_all_entities_changed can return None
-            if changed is not None:
-                for other_user_id in changed:
-                    if other_user_id in friends:
-                        user_ids_changed.add(other_user_id)
-                        continue
-                    other_rooms = yield self.store.get_rooms_for_user(other_user_id)
-                    if room_ids.intersection(e.room_id for e in other_rooms):
-                        user_ids_changed.add(other_user_id)
-                        continue
+            user_ids_to_check = yield self._get_interested_in(user, room_ids)
+
+            if from_key:
+                user_ids_changed = stream_change_cache.get_entities_changed(
+                    user_ids_to_check, from_key,
+                )
             else:
-                # Too many possible updates. Find all users we can see and check
-                # if any of them have changed.
-                user_ids_to_check = set()
-                for room_id in room_ids:
-                    users = yield self.store.get_users_in_room(room_id)
-                    user_ids_to_check.update(users)
-
-                user_ids_to_check.update(friends)
-
-                # Always include yourself. Only really matters for when the user is
-                # not in any rooms, but still.
-                user_ids_to_check.add(user_id)
-
-                if from_key:
-                    user_ids_changed = stream_change_cache.get_entities_changed(
-                        user_ids_to_check, from_key,
-                    )
-                else:
-                    user_ids_changed = user_ids_to_check
+                user_ids_changed = user_ids_to_check
 
             updates = yield presence.current_state_for_users(user_ids_changed)
 
@@ -920,12 +989,46 @@ class PresenceEventSource(object):
         defer.returnValue(([
             {
                 "type": "m.presence",
-                "content": _format_user_presence_state(s, now),
+                "content": format_user_presence_state(s, now),
             }
             for s in updates.values()
             if include_offline or s.state != PresenceState.OFFLINE
         ], max_token))
 
+    @defer.inlineCallbacks
+    def _get_interested_in(self, user, room_ids=None):
+        """Returns the set of users whose presence the given user should
+        receive, i.e. those in its presence list and those it shares a room
+        with.
+
+        Args:
+            user (UserID)
+            room_ids (list): The rooms to consider, defaults to all rooms the
+                user is joined to.
+        """
+        user_id = user.to_string()
+
+        plist = yield self.store.get_presence_list_accepted(user.localpart)
+        users_interested_in = set(row["observed_user_id"] for row in plist)
+        users_interested_in.add(user_id)  # So that we receive our own presence
+
+        if room_ids:
+            rooms = yield self.store.get_rooms_for_user(user_id)
+            if set(room_ids) != set(r.room_id for r in rooms):
+                # Only a subset of rooms was asked for, e.g. when peeking, so
+                # we can't use the per user index.
+                users_by_room = yield self.store.get_users_in_rooms(room_ids)
+                for users in users_by_room.values():
+                    users_interested_in.update(users)
+                defer.returnValue(users_interested_in)
+
+        users_who_share_room = yield self.store.get_users_who_share_room_with_user(
+            user_id
+        )
+        users_interested_in.update(users_who_share_room)
+
+        defer.returnValue(users_interested_in)
+
     def get_current_key(self):
         return self.store.get_current_presence_token()
 
@@ -25,6 +25,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# How long to wait for more receipts before sending them to remote servers, so
+# that receipts sent in quick succession are sent to each server in one EDU.
+FEDERATION_FLUSH_DELAY_MS = 50
+
+
 class ReceiptsHandler(BaseHandler):
     def __init__(self, hs):
         super(ReceiptsHandler, self).__init__(hs)
@@ -36,6 +41,10 @@ class ReceiptsHandler(BaseHandler):
         )
         self.clock = self.hs.get_clock()
 
+        # destination -> m.receipt EDU content waiting to be sent
+        self._pending_federation_receipts = {}
+        self._federation_flush_timer = None
+
     @defer.inlineCallbacks
     def received_client_receipt(self, room_id, receipt_type, user_id,
                                 event_id):
@@ -107,9 +116,8 @@ class ReceiptsHandler(BaseHandler):
     @defer.inlineCallbacks
     def _push_remotes(self, receipts):
         """Given a list of receipts, works out which remote servers should be
-        poked and pokes them.
+        poked and queues the receipts to be sent to them.
         """
-        # TODO: Some of this stuff should be coallesced.
         for receipt in receipts:
             room_id = receipt["room_id"]
             receipt_type = receipt["receipt_type"]
@@ -117,31 +125,41 @@ class ReceiptsHandler(BaseHandler):
             event_ids = receipt["event_ids"]
             data = receipt["data"]
 
-            remotedomains = set()
-
-            rm_handler = self.hs.get_handlers().room_member_handler
-            yield rm_handler.fetch_room_distributions_into(
-                room_id, localusers=None, remotedomains=remotedomains
-            )
+            remotedomains = yield self.store.get_joined_hosts_for_room(room_id)
+            remotedomains = remotedomains - {self.server_name}
 
             logger.debug("Sending receipt to: %r", remotedomains)
 
             for domain in remotedomains:
-                self.federation.send_edu(
-                    destination=domain,
-                    edu_type="m.receipt",
-                    content={
-                        room_id: {
-                            receipt_type: {
-                                user_id: {
-                                    "event_ids": event_ids,
-                                    "data": data,
-                                }
-                            }
-                        },
-                    },
+                content = self._pending_federation_receipts.setdefault(domain, {})
+                content.setdefault(room_id, {}).setdefault(receipt_type, {})[
+                    user_id
+                ] = {
+                    "event_ids": event_ids,
+                    "data": data,
+                }
+
+            if remotedomains and not self._federation_flush_timer:
+                self._federation_flush_timer = self.clock.call_later(
+                    FEDERATION_FLUSH_DELAY_MS / 1000.0,
+                    self._flush_federation_receipts,
                 )
 
+    def _flush_federation_receipts(self):
+        """Sends the receipts queued for each remote server as a single EDU.
+        """
+        self._federation_flush_timer = None
+
+        pending = self._pending_federation_receipts
+        self._pending_federation_receipts = {}
+
+        for domain, content in pending.items():
+            self.federation.send_edu(
+                destination=domain,
+                edu_type="m.receipt",
+                content=content,
+            )
+
     @defer.inlineCallbacks
     def get_receipts_for_room(self, room_id, to_key):
         """Gets all receipts for a room, upto the given key.
@@ -18,13 +18,14 @@ from twisted.internet import defer
 from ._base import BaseHandler
 
 from synapse.api.errors import SynapseError, AuthError
-from synapse.util.logcontext import PreserveLoggingContext
+from synapse.util.logcontext import PreserveLoggingContext, preserve_fn
 from synapse.util.metrics import Measure
+from synapse.util.wheel_timer import WheelTimer
 from synapse.types import UserID
 
 import logging
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import json
 
 logger = logging.getLogger(__name__)
@@ -34,6 +35,14 @@ logger = logging.getLogger(__name__)
 # key
 RoomMember = namedtuple("RoomMember", ("room_id", "user"))
 
+# How often to check for typing notifications that have timed out, and the
+# accuracy of the timeouts.
+TIMEOUT_CHECK_INTERVAL_MS = 5000
+
+# How long to wait for more typing changes before sending them to remote
+# servers, so that changes in quick succession are sent together.
+FEDERATION_FLUSH_DELAY_MS = 50
+
 
 class TypingNotificationHandler(BaseHandler):
     def __init__(self, hs):
@@ -50,20 +59,33 @@ class TypingNotificationHandler(BaseHandler):
         hs.get_distributor().observe("user_left_room", self.user_left_room)
 
         self._member_typing_until = {}  # clock time we expect to stop
-        self._member_typing_timer = {}  # deferreds to manage theabove
 
-        # map room IDs to serial numbers
-        self._room_serials = {}
+        # RoomMembers that may have timed out, checked by _handle_timeouts
+        self.wheel_timer = WheelTimer(bucket_size=TIMEOUT_CHECK_INTERVAL_MS)
+        self.clock.looping_call(
+            self._handle_timeouts, TIMEOUT_CHECK_INTERVAL_MS
+        )
+
+        # map room IDs to serial numbers, in the order of the serials so that
+        # the most recently changed rooms can be found without a full scan
+        self._room_serials = OrderedDict()
         self._latest_room_serial = 0
-        # map room IDs to sets of users currently typing
+        # map room IDs to sets of users currently typing. Rooms where nobody
+        # is typing are removed.
         self._room_typing = {}
 
+        # map destinations to dicts of (room_id, user_id) -> typing, waiting
+        # to be sent
+        self._pending_federation_updates = {}
+        self._federation_flush_timer = None
+
     def tearDown(self):
         """Cancels all the pending timers.
         Normally this shouldn't be needed, but it's required from unit tests
         to avoid a "Reactor was unclean" warning."""
-        for t in self._member_typing_timer.values():
-            self.clock.cancel_call_later(t)
+        if self._federation_flush_timer:
+            self.clock.cancel_call_later(self._federation_flush_timer)
+            self._federation_flush_timer = None
 
     @defer.inlineCallbacks
     def started_typing(self, target_user, auth_user, room_id, timeout):
@@ -79,24 +101,14 @@ class TypingNotificationHandler(BaseHandler):
             "%s has started typing in %s", target_user.to_string(), room_id
         )
 
-        until = self.clock.time_msec() + timeout
+        now = self.clock.time_msec()
+        until = now + timeout
         member = RoomMember(room_id=room_id, user=target_user)
 
         was_present = member in self._member_typing_until
 
-        if member in self._member_typing_timer:
-            self.clock.cancel_call_later(self._member_typing_timer[member])
-
-        def _cb():
-            logger.debug(
-                "%s has timed out in %s", target_user.to_string(), room_id
-            )
-            self._stopped_typing(member)
-
         self._member_typing_until[member] = until
-        self._member_typing_timer[member] = self.clock.call_later(
-            timeout / 1000.0, _cb
-        )
+        self.wheel_timer.insert(now=now, obj=member, then=until)
 
         if was_present:
             # No point sending another notification
@@ -124,10 +136,6 @@ class TypingNotificationHandler(BaseHandler):
 
         member = RoomMember(room_id=room_id, user=target_user)
 
-        if member in self._member_typing_timer:
-            self.clock.cancel_call_later(self._member_typing_timer[member])
-            del self._member_typing_timer[member]
-
         yield self._stopped_typing(member)
 
     @defer.inlineCallbacks
@@ -148,57 +156,76 @@ class TypingNotificationHandler(BaseHandler):
             typing=False,
         )
 
-        del self._member_typing_until[member]
-
-        if member in self._member_typing_timer:
-            # Don't cancel it - either it already expired, or the real
-            # stopped_typing() will cancel it
-            del self._member_typing_timer[member]
+        # Any entry left in the wheel timer is ignored by _handle_timeouts
+        self._member_typing_until.pop(member, None)
+
+    def _handle_timeouts(self):
+        """Stops the typing notifications that have timed out."""
+        now = self.clock.time_msec()
+
+        with Measure(self.clock, "typing._handle_timeouts"):
+            # The members returned may have started typing again, or stopped,
+            # since the timer was set.
+            members = set(self.wheel_timer.fetch(now))
+            for member in members:
+                until = self._member_typing_until.get(member)
+                if until is not None and until <= now:
+                    logger.debug(
+                        "%s has timed out in %s",
+                        member.user.to_string(), member.room_id,
+                    )
+                    preserve_fn(self._stopped_typing)(member)
 
     @defer.inlineCallbacks
     def _push_update(self, room_id, user, typing):
-        localusers = set()
-        remotedomains = set()
+        domains = yield self.store.get_joined_hosts_for_room(room_id)
 
-        rm_handler = self.homeserver.get_handlers().room_member_handler
-        yield rm_handler.fetch_room_distributions_into(
-            room_id, localusers=localusers, remotedomains=remotedomains
-        )
-
-        if localusers:
+        if self.server_name in domains:
             self._push_update_local(
                 room_id=room_id,
                 user=user,
                 typing=typing
             )
 
-        deferreds = []
+        remotedomains = domains - {self.server_name}
         for domain in remotedomains:
-            deferreds.append(self.federation.send_edu(
-                destination=domain,
-                edu_type="m.typing",
-                content={
-                    "room_id": room_id,
-                    "user_id": user.to_string(),
-                    "typing": typing,
-                },
-            ))
-
-        yield defer.DeferredList(deferreds, consumeErrors=True)
+            updates = self._pending_federation_updates.setdefault(domain, {})
+            updates[(room_id, user.to_string())] = typing
+
+        if remotedomains and not self._federation_flush_timer:
+            self._federation_flush_timer = self.clock.call_later(
+                FEDERATION_FLUSH_DELAY_MS / 1000.0, self._flush_federation_updates
+            )
+
+    def _flush_federation_updates(self):
+        """Sends the typing changes that have built up for each remote server.
+        Only the latest change for each user in each room is sent.
+        """
+        self._federation_flush_timer = None
+
+        pending = self._pending_federation_updates
+        self._pending_federation_updates = {}
+
+        for domain, updates in pending.items():
+            for (room_id, user_id), typing in updates.items():
+                self.federation.send_edu(
+                    destination=domain,
+                    edu_type="m.typing",
+                    content={
+                        "room_id": room_id,
+                        "user_id": user_id,
+                        "typing": typing,
+                    },
+                )
 
     @defer.inlineCallbacks
     def _recv_edu(self, origin, content):
         room_id = content["room_id"]
         user = UserID.from_string(content["user_id"])
 
-        localusers = set()
-
-        rm_handler = self.homeserver.get_handlers().room_member_handler
-        yield rm_handler.fetch_room_distributions_into(
-            room_id, localusers=localusers
-        )
+        domains = yield self.store.get_joined_hosts_for_room(room_id)
 
-        if localusers:
+        if self.server_name in domains:
             self._push_update_local(
                 room_id=room_id,
                 user=user,
@@ -206,13 +233,18 @@ class TypingNotificationHandler(BaseHandler):
             )
 
     def _push_update_local(self, room_id, user, typing):
-        room_set = self._room_typing.setdefault(room_id, set())
         if typing:
-            room_set.add(user)
+            self._room_typing.setdefault(room_id, set()).add(user)
         else:
-            room_set.discard(user)
+            room_set = self._room_typing.get(room_id)
+            if room_set is not None:
+                room_set.discard(user)
+                if not room_set:
+                    del self._room_typing[room_id]
 
         self._latest_room_serial += 1
+        # Move the room to the end to keep _room_serials ordered by serial
+        self._room_serials.pop(room_id, None)
         self._room_serials[room_id] = self._latest_room_serial
 
         with PreserveLoggingContext():
@@ -221,16 +253,20 @@ class TypingNotificationHandler(BaseHandler):
             )
 
     def get_all_typing_updates(self, last_id, current_id):
-        # TODO: Work out a way to do this without scanning the entire state.
+        # _room_serials is ordered by serial, so walk back from the most
+        # recently changed room until we reach rooms that haven't changed.
         rows = []
-        for room_id, serial in self._room_serials.items():
-            if last_id < serial and serial <= current_id:
-                typing = self._room_typing[room_id]
+        for room_id in reversed(self._room_serials):
+            serial = self._room_serials[room_id]
+            if serial <= last_id:
+                break
+            if serial <= current_id:
+                typing = self._room_typing.get(room_id, ())
                 typing_bytes = json.dumps([
                     u.to_string() for u in typing
                 ], ensure_ascii=False)
                 rows.append((serial, room_id, typing_bytes))
-        rows.sort()
+        rows.reverse()
         return rows
 
 
@@ -253,7 +289,7 @@ class TypingNotificationEventSource(object):
         return self._room_member_handler
 
     def _make_event_for(self, room_id):
-        typing = self.handler()._room_typing[room_id]
+        typing = self.handler()._room_typing.get(room_id, ())
         return {
             "type": "m.typing",
             "room_id": room_id,
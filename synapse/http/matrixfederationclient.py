@@ -408,13 +408,16 @@ class MatrixFederationHttpClient(object):
 
     @defer.inlineCallbacks
     def get_file(self, destination, path, output_stream, args={},
-                 retry_on_dns_fail=True, max_size=None):
+                 retry_on_dns_fail=True, max_size=None, headers_callback=None):
         """GETs a file from a given homeserver
         Args:
             destination (str): The remote server to send the HTTP request to.
             path (str): The HTTP path to GET.
             output_stream (file): File to write the response body to.
             args (dict): Optional dictionary used to create the query string.
+            headers_callback (callable): Optional function that is called with
+                the dict of response headers as soon as they have been
+                received, before the body is read.
         Returns:
             A (int,dict) tuple of the file length and a dict of the response
             headers.
@@ -444,6 +447,9 @@ class MatrixFederationHttpClient(object):
 
         headers = dict(response.headers.getAllRawHeaders())
 
+        if headers_callback:
+            headers_callback(headers)
+
         try:
             length = yield preserve_context_over_fn(
                 _readBodyToFile,
@@ -230,6 +230,11 @@ class JsonResource(HttpServer, resource.Resource):
             else:
                 servlet_classname = "%r" % callback
 
+            if start_context:
+                # Copied to the contexts of any database transactions, so we
+                # can tell which servlet they were run for.
+                start_context.servlet = servlet_classname
+
             kwargs = intern_dict({
                 name: urllib.unquote(value).decode("UTF-8") if value else value
                 for name, value in m.groupdict().items()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.util.logcontext import LoggingContext
+
+import logging
+import os
+import re
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Request contexts are named e.g. "GET-123"; strip the request number so that
+# samples from different requests are aggregated.
+_REQUEST_ID_RE = re.compile(r"-[0-9]+$")
+
+
+class SamplingProfiler(object):
+    """Periodically samples the stacks of the reactor thread and the database
+    threads from a background thread, counting how often each stack is seen.
+
+    Each sample is tagged with the servlet, or failing that the name, of the
+    logging context active in the thread, so the result shows what work the
+    CPU was spent on. Database threads that aren't running a transaction are
+    ignored.
+
+    Args:
+        reactor_thread_ident (int): The ident of the reactor thread.
+        db_threadpool (ThreadPool): The database connection pool's threads.
+        interval (float): Seconds between samples.
+    """
+
+    def __init__(self, reactor_thread_ident, db_threadpool, interval):
+        self.reactor_thread_ident = reactor_thread_ident
+        self.db_threadpool = db_threadpool
+        self.interval = interval
+        self.counts = {}
+        self.sample_count = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        LoggingContext.contexts_by_thread = {}
+        self._thread = threading.Thread(
+            target=self._run, name="sampling-profiler",
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Tells the sampling thread to stop. This doesn't wait for it, so is
+        safe to call from the reactor; use `join` before reading the results.
+        """
+        self._stopped.set()
+        LoggingContext.contexts_by_thread = None
+
+    def join(self):
+        """Waits for the sampling thread to finish any sample in progress.
+        Blocks, so must not be called on the reactor thread.
+        """
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self._sample()
+            except Exception:
+                logger.exception("Failed to take profiling sample")
+
+    def _sample(self):
+        frames = sys._current_frames()
+        contexts = LoggingContext.contexts_by_thread or {}
+
+        threads = [("reactor", self.reactor_thread_ident)]
+        for db_thread in self.db_threadpool.threads:
+            threads.append(("database", db_thread.ident))
+
+        for thread_name, ident in threads:
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+
+            context = contexts.get(ident, LoggingContext.sentinel)
+            if context:
+                label = getattr(context, "servlet", None)
+                if not label:
+                    label = _REQUEST_ID_RE.sub("", str(context.name))
+            elif thread_name == "database":
+                # Idle, waiting for work.
+                continue
+            else:
+                label = "-"
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s" % (
+                    os.path.basename(code.co_filename), code.co_name,
+                ))
+                frame = frame.f_back
+            stack.append(label)
+            stack.append(thread_name)
+            stack.reverse()
+
+            key = ";".join(stack)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+        self.sample_count += 1
+
+    def collapsed_stacks(self):
+        """Returns the samples in the "collapsed stack" format understood by
+        flamegraph.pl, i.e. lines of semicolon separated frames, outermost
+        first, followed by the number of times the stack was seen.
+        """
+        return "".join(
+            "%s %d\n" % (stack, count)
+            for stack, count in sorted(self.counts.items())
+        )
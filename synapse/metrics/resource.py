@@ -13,12 +13,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from twisted.internet import defer, threads
 from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from synapse.api.errors import AuthError, SynapseError
+from synapse.http.server import request_handler, finish_request
+from synapse.http.servlet import parse_integer
+from synapse.metrics.profiler import SamplingProfiler
+from synapse.util.async import sleep
+from synapse.util.logcontext import preserve_context_over_fn
 
 import synapse.metrics
+import thread
 
 
 METRICS_PREFIX = "/_synapse/metrics"
+PROFILE_PREFIX = "/_synapse/profile"
+
+# The longest we allow a profile to run for, in seconds.
+MAX_PROFILE_DURATION = 300
+
+# The longest interval between samples we allow, in milliseconds.
+MAX_PROFILE_INTERVAL_MS = 1000
 
 
 class MetricsResource(Resource):
@@ -37,3 +54,73 @@ class MetricsResource(Resource):
 
         # Encode as UTF-8 (default)
         return response.encode()
+
+
+class ProfileResource(Resource):
+    """Runs the sampling profiler over the reactor and database threads and
+    returns the collapsed stacks, e.g. for flamegraph.pl::
+
+        => GET /_synapse/profile?duration=30&interval_ms=10
+
+    Only server admins may use it, and only one profile can run at a time.
+    """
+    isLeaf = True
+
+    def __init__(self, hs):
+        Resource.__init__(self)  # Resource is old-style, so no super()
+
+        self.hs = hs
+        self.auth = hs.get_auth()
+        self.clock = hs.get_clock()
+        self.version_string = hs.version_string
+        self.db_pool = hs.get_db_pool()
+        self.profiler = None
+
+    def render_GET(self, request):
+        self._async_render_GET(request)
+        return NOT_DONE_YET
+
+    @request_handler
+    @defer.inlineCallbacks
+    def _async_render_GET(self, request):
+        requester = yield self.auth.get_user_by_req(request)
+        is_admin = yield self.auth.is_server_admin(requester.user)
+        if not is_admin:
+            raise AuthError(403, "You are not a server admin")
+
+        duration = parse_integer(request, "duration", default=30)
+        interval_ms = parse_integer(request, "interval_ms", default=10)
+        if not 0 < duration <= MAX_PROFILE_DURATION:
+            raise SynapseError(
+                400, "duration must be between 1 and %d" % (MAX_PROFILE_DURATION,)
+            )
+        if not 0 < interval_ms <= MAX_PROFILE_INTERVAL_MS:
+            raise SynapseError(
+                400,
+                "interval_ms must be between 1 and %d" % (MAX_PROFILE_INTERVAL_MS,)
+            )
+
+        if self.profiler:
+            raise SynapseError(409, "A profile is already running")
+
+        # We're called on the reactor thread.
+        profiler = SamplingProfiler(
+            thread.get_ident(), self.db_pool.threadpool, interval_ms / 1000.,
+        )
+        self.profiler = profiler
+        profiler.start()
+        try:
+            yield sleep(duration)
+        finally:
+            profiler.stop()
+            self.profiler = None
+
+        # Let any sample in progress finish before reading the results.
+        yield preserve_context_over_fn(threads.deferToThread, profiler.join)
+
+        response = profiler.collapsed_stacks()
+
+        request.setHeader("Content-Type", "text/plain")
+        request.setHeader("Content-Length", str(len(response)))
+        request.write(response)
+        finish_request(request)
@@ -40,7 +40,7 @@ class ActionGenerator:
         )
 
         actions_by_user = yield bulk_evaluator.action_for_event_by_user(
-            event, handler, context.current_state
+            event, handler, context
         )
 
         context.push_actions = [
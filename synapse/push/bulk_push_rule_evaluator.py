@@ -98,9 +98,17 @@ class BulkPushRuleEvaluator:
         self.store = store
 
     @defer.inlineCallbacks
-    def action_for_event_by_user(self, event, handler, current_state):
+    def action_for_event_by_user(self, event, handler, context):
         actions_by_user = {}
 
+        # We only need the history visibility and the membership of the users
+        # we're evaluating push rules for.
+        current_state = yield context.get_current_state(
+            [(EventTypes.RoomHistoryVisibility, "")] + [
+                (EventTypes.Member, uid) for uid in self.rules_by_user
+            ]
+        )
+
         users_dict = yield self.store.are_guests(self.rules_by_user.keys())
 
         filtered_by_user = yield handler.filter_events_for_clients(
@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .thumbnailer import Thumbnailer
+from .thumbnailer import Thumbnailer, generate_thumbnails
 
 from synapse.http.matrixfederationclient import MatrixFederationHttpClient
 from synapse.http.server import respond_with_json, finish_request
@@ -22,13 +22,16 @@ from synapse.api.errors import (
     cs_error, Codes, SynapseError
 )
 
-from twisted.internet import defer, threads
+from twisted.internet import defer
+from twisted.python.failure import Failure
 from twisted.web.resource import Resource
 from twisted.protocols.basic import FileSender
 
 from synapse.util.async import ObservableDeferred
 from synapse.util.stringutils import is_ascii
-from synapse.util.logcontext import preserve_context_over_fn
+from synapse.util.logcontext import (
+    preserve_context_over_fn, PreserveLoggingContext
+)
 
 import os
 
@@ -60,10 +63,247 @@ def parse_media_id(request):
         )
 
 
+def parse_byte_range(range_header, file_size):
+    """Parses the value of a HTTP Range header against a file of the given
+    size.
+
+    Only a single range is supported. Headers asking for multiple ranges, or
+    which can't be parsed, are ignored and the whole file should be sent.
+
+    Args:
+        range_header (str): The value of the Range header.
+        file_size (int): The size of the file in bytes.
+    Returns:
+        A (start, end) tuple of the inclusive byte offsets to send, or None if
+        the whole file should be sent.
+    Raises:
+        SynapseError(416) if the range can't be satisfied.
+    """
+    units, _, ranges = range_header.strip().partition("=")
+    if units.strip().lower() != "bytes" or "," in ranges:
+        return None
+
+    first, sep, last = ranges.strip().partition("-")
+    if not sep:
+        return None
+
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else file_size - 1
+        elif last:
+            # A suffix range, e.g. "bytes=-500" for the last 500 bytes.
+            start = max(file_size - int(last), 0)
+            end = file_size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+
+    if start >= file_size:
+        raise SynapseError(
+            416, "Requested range not satisfiable", Codes.UNKNOWN,
+        )
+
+    if end < start:
+        return None
+
+    return start, min(end, file_size - 1)
+
+
+def _get_upload_name(headers):
+    """Works out the name of a downloaded file from the Content-Disposition
+    response header, if any.
+    """
+    content_disposition = headers.get("Content-Disposition", None)
+    if not content_disposition:
+        return None
+
+    _, params = cgi.parse_header(content_disposition[0],)
+    upload_name = None
+
+    # First check if there is a valid UTF-8 filename
+    upload_name_utf8 = params.get("filename*", None)
+    if upload_name_utf8:
+        if upload_name_utf8.lower().startswith("utf-8''"):
+            upload_name = upload_name_utf8[7:]
+
+    # If there isn't check for an ascii name.
+    if not upload_name:
+        upload_name_ascii = params.get("filename", None)
+        if upload_name_ascii and is_ascii(upload_name_ascii):
+            upload_name = upload_name_ascii
+
+    if upload_name:
+        upload_name = urlparse.unquote(upload_name)
+        try:
+            upload_name = upload_name.decode("utf-8")
+        except UnicodeDecodeError:
+            upload_name = None
+
+    return upload_name
+
+
+class DownloadProgress(object):
+    """Tracks a remote media download that is still being written to disk, so
+    that concurrent requests for the same media can be served from the
+    partially written file as the bytes arrive.
+
+    The object is passed to the federation client as the output stream.
+    """
+
+    def __init__(self):
+        self.length = 0
+        self.finished = False
+        self.failure = None
+        self._stream = None
+        self._started = ObservableDeferred(defer.Deferred(), consumeErrors=True)
+        self._waiters = []
+
+    def set_stream(self, stream):
+        self._stream = stream
+
+    def write(self, data):
+        self._stream.write(data)
+        # Flush so that readers of the file see everything we count.
+        self._stream.flush()
+        self.length += len(data)
+        self._notify()
+
+    def started(self, media_info):
+        """Called once the response headers have been received with the
+        media_info known so far. A media_info of None means that the media
+        can't be streamed and callers should wait for the download to finish.
+        """
+        if not self._started.called:
+            with PreserveLoggingContext():
+                self._started.callback(media_info)
+
+    def wait_for_start(self):
+        return self._started.observe()
+
+    def finish(self):
+        self.finished = True
+        self.started(None)
+        self._notify()
+
+    def fail(self, failure):
+        if self.finished:
+            return
+        self.finished = True
+        self.failure = failure
+        if not self._started.called:
+            with PreserveLoggingContext():
+                self._started.errback(failure)
+        self._notify()
+
+    def wait_for_data(self, offset):
+        """Returns a deferred which fires once more than `offset` bytes have
+        been written, or the download has finished.
+        """
+        if self.failure:
+            return defer.fail(self.failure)
+        if self.length > offset or self.finished:
+            return defer.succeed(self.length)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
+
+    def _notify(self):
+        waiters, self._waiters = self._waiters, []
+        with PreserveLoggingContext():
+            for d in waiters:
+                if self.failure:
+                    d.errback(self.failure)
+                else:
+                    d.callback(self.length)
+
+
+class RangeFileSender(FileSender):
+    """A FileSender that stops after sending the given number of bytes, for
+    responding to Range requests. The file should already have been seeked
+    to the start of the range.
+    """
+
+    def __init__(self, length):
+        self.remaining = length
+
+    def resumeProducing(self):
+        chunk = ''
+        if self.file and self.remaining > 0:
+            chunk = self.file.read(min(self.CHUNK_SIZE, self.remaining))
+            self.remaining -= len(chunk)
+        if not chunk:
+            self.file = None
+            self.consumer.unregisterProducer()
+            if self.deferred:
+                self.deferred.callback(self.lastSent)
+                self.deferred = None
+            return
+
+        self.consumer.write(chunk)
+        self.lastSent = chunk[-1:]
+
+
+class InProgressFileSender(FileSender):
+    """A FileSender for a file that is still being downloaded. When it catches
+    up with the download it waits for more data rather than finishing.
+    """
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.offset = 0
+        self.waiting = False
+
+    def resumeProducing(self):
+        if self.waiting or not self.file:
+            return
+
+        chunk = ''
+        available = self.progress.length - self.offset
+        if available > 0:
+            chunk = self.file.read(min(self.CHUNK_SIZE, available))
+
+        if chunk:
+            self.offset += len(chunk)
+            self.consumer.write(chunk)
+            self.lastSent = chunk[-1:]
+        elif self.progress.finished and not self.progress.failure:
+            self.file = None
+            self.consumer.unregisterProducer()
+            if self.deferred:
+                self.deferred.callback(self.lastSent)
+                self.deferred = None
+        else:
+            # Wait for the download to write some more. Nothing has been
+            # written to the consumer so it won't ask us again; we resume
+            # ourselves when data arrives.
+            self.waiting = True
+            d = self.progress.wait_for_data(self.offset)
+            d.addCallbacks(self._on_data, self._on_failure)
+
+    def stopProducing(self):
+        self.file = None
+        FileSender.stopProducing(self)
+
+    def _on_data(self, _):
+        self.waiting = False
+        self.resumeProducing()
+
+    def _on_failure(self, failure):
+        self.waiting = False
+        self.file = None
+        self.consumer.unregisterProducer()
+        if self.deferred:
+            self.deferred.errback(failure)
+            self.deferred = None
+
+
 class BaseMediaResource(Resource):
     isLeaf = True
 
-    def __init__(self, hs, filepaths):
+    def __init__(self, hs, filepaths, secondary_filepaths, downloads,
+                 thumbnailer_pool):
         Resource.__init__(self)
         self.auth = hs.get_auth()
         self.client = MatrixFederationHttpClient(hs)
@@ -73,8 +313,12 @@ class BaseMediaResource(Resource):
         self.max_upload_size = hs.config.max_upload_size
         self.max_image_pixels = hs.config.max_image_pixels
         self.filepaths = filepaths
+        self.secondary_filepaths = secondary_filepaths
         self.version_string = hs.version_string
-        self.downloads = {}
+        # Map from (server_name, media_id) to in progress remote downloads,
+        # shared between the media resources.
+        self.downloads = downloads
+        self.thumbnailer_pool = thumbnailer_pool
         self.dynamic_thumbnails = hs.config.dynamic_thumbnails
         self.thumbnail_requirements = hs.config.thumbnail_requirements
 
@@ -94,36 +338,87 @@ class BaseMediaResource(Resource):
         if not os.path.exists(dirname):
             os.makedirs(dirname)
 
-    def _get_remote_media(self, server_name, media_id):
+    def _remote_filepaths(self, media_info):
+        """Returns the MediaFilePaths for the media store that holds the
+        remote media.
+        """
+        if media_info.get("cold_ts") and self.secondary_filepaths:
+            return self.secondary_filepaths
+        return self.filepaths
+
+    def _start_remote_media_download(self, server_name, media_id):
+        """Starts fetching remote media, or joins the fetch already in
+        progress for it.
+
+        Returns:
+            A (ObservableDeferred, DownloadProgress) tuple. The deferred
+            resolves to the media_info once the file and its thumbnails have
+            been stored.
+        """
+        self.store.mark_remote_media_accessed(server_name, media_id)
+
         key = (server_name, media_id)
         download = self.downloads.get(key)
         if download is None:
-            download = self._get_remote_media_impl(server_name, media_id)
-            download = ObservableDeferred(
-                download,
+            progress = DownloadProgress()
+            deferred = self._get_remote_media_impl(
+                server_name, media_id, progress
+            )
+            deferred = ObservableDeferred(
+                deferred,
                 consumeErrors=True
             )
+            download = (deferred, progress)
             self.downloads[key] = download
 
-            @download.addBoth
+            @deferred.addBoth
             def callback(media_info):
                 del self.downloads[key]
                 return media_info
-        return download.observe()
+        return download
+
+    def _get_remote_media(self, server_name, media_id):
+        deferred, _ = self._start_remote_media_download(server_name, media_id)
+        return deferred.observe()
 
     @defer.inlineCallbacks
-    def _get_remote_media_impl(self, server_name, media_id):
-        media_info = yield self.store.get_cached_remote_media(
+    def _get_remote_media_streaming(self, server_name, media_id):
+        """Like _get_remote_media, but returns as soon as the remote server has
+        started sending the file rather than waiting for all of it.
+
+        Returns:
+            A deferred (media_info, progress) tuple. progress is None if the
+            file is already complete on disk, otherwise it is the
+            DownloadProgress for the file being written.
+        """
+        deferred, progress = self._start_remote_media_download(
             server_name, media_id
         )
-        if not media_info:
-            media_info = yield self._download_remote_file(
+        media_info = yield progress.wait_for_start()
+        if media_info is None:
+            media_info = yield deferred.observe()
+            progress = None
+        defer.returnValue((media_info, progress))
+
+    @defer.inlineCallbacks
+    def _get_remote_media_impl(self, server_name, media_id, progress):
+        try:
+            media_info = yield self.store.get_cached_remote_media(
                 server_name, media_id
             )
+            if media_info:
+                progress.finish()
+            else:
+                media_info = yield self._download_remote_file(
+                    server_name, media_id, progress
+                )
+        except Exception:
+            progress.fail(Failure())
+            raise
         defer.returnValue(media_info)
 
     @defer.inlineCallbacks
-    def _download_remote_file(self, server_name, media_id):
+    def _download_remote_file(self, server_name, media_id, progress):
         file_id = random_string(24)
 
         fname = self.filepaths.remote_media_filepath(
@@ -131,43 +426,31 @@ class BaseMediaResource(Resource):
         )
         self._makedirs(fname)
 
+        def headers_received(headers):
+            content_length = headers.get("Content-Length", None)
+            progress.started({
+                "media_type": headers["Content-Type"][0],
+                "media_length": (
+                    int(content_length[0]) if content_length else None
+                ),
+                "upload_name": _get_upload_name(headers),
+                "filesystem_id": file_id,
+            })
+
         try:
             with open(fname, "wb") as f:
+                progress.set_stream(f)
                 request_path = "/".join((
                     "/_matrix/media/v1/download", server_name, media_id,
                 ))
                 length, headers = yield self.client.get_file(
-                    server_name, request_path, output_stream=f,
+                    server_name, request_path, output_stream=progress,
                     max_size=self.max_upload_size,
+                    headers_callback=headers_received,
                 )
             media_type = headers["Content-Type"][0]
             time_now_ms = self.clock.time_msec()
-
-            content_disposition = headers.get("Content-Disposition", None)
-            if content_disposition:
-                _, params = cgi.parse_header(content_disposition[0],)
-                upload_name = None
-
-                # First check if there is a valid UTF-8 filename
-                upload_name_utf8 = params.get("filename*", None)
-                if upload_name_utf8:
-                    if upload_name_utf8.lower().startswith("utf-8''"):
-                        upload_name = upload_name_utf8[7:]
-
-                # If there isn't check for an ascii name.
-                if not upload_name:
-                    upload_name_ascii = params.get("filename", None)
-                    if upload_name_ascii and is_ascii(upload_name_ascii):
-                        upload_name = upload_name_ascii
-
-                if upload_name:
-                    upload_name = urlparse.unquote(upload_name)
-                    try:
-                        upload_name = upload_name.decode("utf-8")
-                    except UnicodeDecodeError:
-                        upload_name = None
-            else:
-                upload_name = None
+            upload_name = _get_upload_name(headers)
 
             yield self.store.store_cached_remote_media(
                 origin=server_name,
@@ -182,12 +465,17 @@ class BaseMediaResource(Resource):
             os.remove(fname)
             raise
 
+        # Anyone streaming the file can now finish; they don't need to wait
+        # for the thumbnails.
+        progress.finish()
+
         media_info = {
             "media_type": media_type,
             "media_length": length,
             "upload_name": upload_name,
             "created_ts": time_now_ms,
             "filesystem_id": file_id,
+            "cold_ts": None,
         }
 
         yield self._generate_remote_thumbnails(
@@ -196,76 +484,128 @@ class BaseMediaResource(Resource):
 
         defer.returnValue(media_info)
 
+    def _set_file_headers(self, request, media_type, upload_name):
+        request.setHeader(b"Content-Type", media_type.encode("UTF-8"))
+        if upload_name:
+            if is_ascii(upload_name):
+                request.setHeader(
+                    b"Content-Disposition",
+                    b"inline; filename=%s" % (
+                        urllib.quote(upload_name.encode("utf-8")),
+                    ),
+                )
+            else:
+                request.setHeader(
+                    b"Content-Disposition",
+                    b"inline; filename*=utf-8''%s" % (
+                        urllib.quote(upload_name.encode("utf-8")),
+                    ),
+                )
+
+        # cache for at least a day.
+        # XXX: we might want to turn this off for data we don't want to
+        # recommend caching as it's sensitive or private - or at least
+        # select private. don't bother setting Expires as all our
+        # clients are smart enough to be happy with Cache-Control
+        request.setHeader(
+            b"Cache-Control", b"public,max-age=86400,s-maxage=86400"
+        )
+
     @defer.inlineCallbacks
     def _respond_with_file(self, request, media_type, file_path,
                            file_size=None, upload_name=None):
         logger.debug("Responding with %r", file_path)
 
         if os.path.isfile(file_path):
-            request.setHeader(b"Content-Type", media_type.encode("UTF-8"))
-            if upload_name:
-                if is_ascii(upload_name):
-                    request.setHeader(
-                        b"Content-Disposition",
-                        b"inline; filename=%s" % (
-                            urllib.quote(upload_name.encode("utf-8")),
-                        ),
-                    )
-                else:
-                    request.setHeader(
-                        b"Content-Disposition",
-                        b"inline; filename*=utf-8''%s" % (
-                            urllib.quote(upload_name.encode("utf-8")),
-                        ),
-                    )
-
-            # cache for at least a day.
-            # XXX: we might want to turn this off for data we don't want to
-            # recommend caching as it's sensitive or private - or at least
-            # select private. don't bother setting Expires as all our
-            # clients are smart enough to be happy with Cache-Control
-            request.setHeader(
-                b"Cache-Control", b"public,max-age=86400,s-maxage=86400"
-            )
             if file_size is None:
                 stat = os.stat(file_path)
                 file_size = stat.st_size
 
-            request.setHeader(
-                b"Content-Length", b"%d" % (file_size,)
-            )
+            byte_range = None
+            range_header = request.getHeader(b"Range")
+            if range_header:
+                try:
+                    byte_range = parse_byte_range(range_header, file_size)
+                except SynapseError:
+                    request.setHeader(
+                        b"Content-Range", b"bytes */%d" % (file_size,)
+                    )
+                    raise
+
+            self._set_file_headers(request, media_type, upload_name)
+            request.setHeader(b"Accept-Ranges", b"bytes")
 
             with open(file_path, "rb") as f:
-                yield FileSender().beginFileTransfer(f, request)
+                if byte_range:
+                    start, end = byte_range
+                    request.setResponseCode(206)
+                    request.setHeader(
+                        b"Content-Range",
+                        b"bytes %d-%d/%d" % (start, end, file_size),
+                    )
+                    request.setHeader(
+                        b"Content-Length", b"%d" % (end - start + 1,)
+                    )
+                    f.seek(start)
+                    sender = RangeFileSender(end - start + 1)
+                else:
+                    request.setHeader(
+                        b"Content-Length", b"%d" % (file_size,)
+                    )
+                    sender = FileSender()
+
+                yield sender.beginFileTransfer(f, request)
 
             finish_request(request)
         else:
             self._respond_404(request)
 
-    def _get_thumbnail_requirements(self, media_type):
-        return self.thumbnail_requirements.get(media_type, ())
+    @defer.inlineCallbacks
+    def _respond_with_in_progress_file(self, request, media_type, file_path,
+                                       progress, upload_name=None):
+        """Streams a file to the client while it is still being downloaded.
 
-    def _generate_thumbnail(self, input_path, t_path, t_width, t_height,
-                            t_method, t_type):
-        thumbnailer = Thumbnailer(input_path)
-        m_width = thumbnailer.width
-        m_height = thumbnailer.height
+        We don't know the final length, so the response is sent chunked and
+        any Range header is ignored.
+        """
+        logger.debug("Responding with in progress download %r", file_path)
 
-        if m_width * m_height >= self.max_image_pixels:
-            logger.info(
-                "Image too large to thumbnail %r x %r > %r",
-                m_width, m_height, self.max_image_pixels
-            )
+        self._set_file_headers(request, media_type, upload_name)
+
+        try:
+            with open(file_path, "rb") as f:
+                sender = InProgressFileSender(progress)
+                yield sender.beginFileTransfer(f, request)
+        except Exception:
+            # We've already started sending the body, so the best we can do
+            # is drop the connection so the client knows it is truncated.
+            logger.warn("Failed to stream in progress download %r", file_path)
+            request.transport.loseConnection()
             return
 
-        if t_method == "crop":
-            t_len = thumbnailer.crop(t_path, t_width, t_height, t_type)
-        elif t_method == "scale":
-            t_len = thumbnailer.scale(t_path, t_width, t_height, t_type)
-        else:
-            t_len = None
+        finish_request(request)
 
-        return t_len
+    def _get_thumbnail_requirements(self, media_type):
+        return self.thumbnail_requirements.get(media_type, ())
+
+    def _generate_thumbnails(self, input_path, thumbnails):
+        """Writes the given thumbnails of the image in the thumbnailer pool.
+
+        Args:
+            input_path (str): Path to the source image.
+            thumbnails (list): List of (output_path, width, height, method,
+                type) tuples.
+        Returns:
+            Deferred list of the lengths of the written thumbnails, with None
+            for any that couldn't be generated.
+        """
+        for thumbnail in thumbnails:
+            self._makedirs(thumbnail[0])
+
+        return preserve_context_over_fn(
+            self.thumbnailer_pool.run,
+            generate_thumbnails, input_path, thumbnails, self.max_image_pixels,
+        )
 
     @defer.inlineCallbacks
     def _generate_local_exact_thumbnail(self, media_id, t_width, t_height,
@@ -275,13 +615,10 @@ class BaseMediaResource(Resource):
         t_path = self.filepaths.local_media_thumbnail(
             media_id, t_width, t_height, t_type, t_method
         )
-        self._makedirs(t_path)
 
-        t_len = yield preserve_context_over_fn(
-            threads.deferToThread,
-            self._generate_thumbnail,
-            input_path, t_path, t_width, t_height, t_method, t_type
-        )
+        t_len, = yield self._generate_thumbnails(input_path, [
+            (t_path, t_width, t_height, t_method, t_type),
+        ])
 
         if t_len:
             yield self.store.store_local_thumbnail(
@@ -291,20 +628,19 @@ class BaseMediaResource(Resource):
             defer.returnValue(t_path)
 
     @defer.inlineCallbacks
-    def _generate_remote_exact_thumbnail(self, server_name, file_id, media_id,
+    def _generate_remote_exact_thumbnail(self, server_name, media_id, media_info,
                                          t_width, t_height, t_method, t_type):
-        input_path = self.filepaths.remote_media_filepath(server_name, file_id)
+        file_id = media_info["filesystem_id"]
+        filepaths = self._remote_filepaths(media_info)
+        input_path = filepaths.remote_media_filepath(server_name, file_id)
 
-        t_path = self.filepaths.remote_media_thumbnail(
+        t_path = filepaths.remote_media_thumbnail(
             server_name, file_id, t_width, t_height, t_type, t_method
         )
-        self._makedirs(t_path)
 
-        t_len = yield preserve_context_over_fn(
-            threads.deferToThread,
-            self._generate_thumbnail,
-            input_path, t_path, t_width, t_height, t_method, t_type
-        )
+        t_len, = yield self._generate_thumbnails(input_path, [
+            (t_path, t_width, t_height, t_method, t_type),
+        ])
 
         if t_len:
             yield self.store.store_remote_media_thumbnail(
@@ -314,6 +650,40 @@ class BaseMediaResource(Resource):
 
             defer.returnValue(t_path)
 
+    def _get_thumbnail_sizes(self, thumbnailer, requirements):
+        """Works out which thumbnails to generate for the requirements.
+
+        Returns:
+            A list of (width, height, method, type) tuples.
+        """
+        m_width = thumbnailer.width
+        m_height = thumbnailer.height
+
+        scales = set()
+        crops = set()
+        for r_width, r_height, r_method, r_type in requirements:
+            if r_method == "scale":
+                t_width, t_height = thumbnailer.aspect(r_width, r_height)
+                scales.add((
+                    min(m_width, t_width), min(m_height, t_height), r_type,
+                ))
+            elif r_method == "crop":
+                crops.add((r_width, r_height, r_type))
+
+        sizes = [
+            (s_width, s_height, "scale", s_type)
+            for s_width, s_height, s_type in scales
+        ]
+        for t_width, t_height, t_type in crops:
+            if (t_width, t_height, t_type) in scales:
+                # If the aspect ratio of the cropped thumbnail matches a purely
+                # scaled one then there is no point in calculating a separate
+                # thumbnail.
+                continue
+            sizes.append((t_width, t_height, "crop", t_type))
+
+        return sizes
+
     @defer.inlineCallbacks
     def _generate_local_thumbnails(self, media_id, media_info):
         media_type = media_info["media_type"]
@@ -333,52 +703,23 @@ class BaseMediaResource(Resource):
             )
             return
 
-        local_thumbnails = []
-
-        def generate_thumbnails():
-            scales = set()
-            crops = set()
-            for r_width, r_height, r_method, r_type in requirements:
-                if r_method == "scale":
-                    t_width, t_height = thumbnailer.aspect(r_width, r_height)
-                    scales.add((
-                        min(m_width, t_width), min(m_height, t_height), r_type,
-                    ))
-                elif r_method == "crop":
-                    crops.add((r_width, r_height, r_type))
-
-            for t_width, t_height, t_type in scales:
-                t_method = "scale"
-                t_path = self.filepaths.local_media_thumbnail(
-                    media_id, t_width, t_height, t_type, t_method
-                )
-                self._makedirs(t_path)
-                t_len = thumbnailer.scale(t_path, t_width, t_height, t_type)
-
-                local_thumbnails.append((
-                    media_id, t_width, t_height, t_type, t_method, t_len
-                ))
-
-            for t_width, t_height, t_type in crops:
-                if (t_width, t_height, t_type) in scales:
-                    # If the aspect ratio of the cropped thumbnail matches a purely
-                    # scaled one then there is no point in calculating a separate
-                    # thumbnail.
-                    continue
-                t_method = "crop"
-                t_path = self.filepaths.local_media_thumbnail(
+        sizes = self._get_thumbnail_sizes(thumbnailer, requirements)
+        t_lens = yield self._generate_thumbnails(input_path, [
+            (
+                self.filepaths.local_media_thumbnail(
                     media_id, t_width, t_height, t_type, t_method
-                )
-                self._makedirs(t_path)
-                t_len = thumbnailer.crop(t_path, t_width, t_height, t_type)
-                local_thumbnails.append((
-                    media_id, t_width, t_height, t_type, t_method, t_len
-                ))
-
-        yield preserve_context_over_fn(threads.deferToThread, generate_thumbnails)
+                ),
+                t_width, t_height, t_method, t_type,
+            )
+            for t_width, t_height, t_method, t_type in sizes
+        ])
 
-        for l in local_thumbnails:
-            yield self.store.store_local_thumbnail(*l)
+        for (t_width, t_height, t_method, t_type), t_len in zip(sizes, t_lens):
+            if not t_len:
+                continue
+            yield self.store.store_local_thumbnail(
+                media_id, t_width, t_height, t_type, t_method, t_len
+            )
 
         defer.returnValue({
             "width": m_width,
@@ -393,65 +734,36 @@ class BaseMediaResource(Resource):
         if not requirements:
             return
 
-        remote_thumbnails = []
-
         input_path = self.filepaths.remote_media_filepath(server_name, file_id)
         thumbnailer = Thumbnailer(input_path)
         m_width = thumbnailer.width
         m_height = thumbnailer.height
 
-        def generate_thumbnails():
-            if m_width * m_height >= self.max_image_pixels:
-                logger.info(
-                    "Image too large to thumbnail %r x %r > %r",
-                    m_width, m_height, self.max_image_pixels
-                )
-                return
-
-            scales = set()
-            crops = set()
-            for r_width, r_height, r_method, r_type in requirements:
-                if r_method == "scale":
-                    t_width, t_height = thumbnailer.aspect(r_width, r_height)
-                    scales.add((
-                        min(m_width, t_width), min(m_height, t_height), r_type,
-                    ))
-                elif r_method == "crop":
-                    crops.add((r_width, r_height, r_type))
-
-            for t_width, t_height, t_type in scales:
-                t_method = "scale"
-                t_path = self.filepaths.remote_media_thumbnail(
-                    server_name, file_id, t_width, t_height, t_type, t_method
-                )
-                self._makedirs(t_path)
-                t_len = thumbnailer.scale(t_path, t_width, t_height, t_type)
-                remote_thumbnails.append([
-                    server_name, media_id, file_id,
-                    t_width, t_height, t_type, t_method, t_len
-                ])
-
-            for t_width, t_height, t_type in crops:
-                if (t_width, t_height, t_type) in scales:
-                    # If the aspect ratio of the cropped thumbnail matches a purely
-                    # scaled one then there is no point in calculating a separate
-                    # thumbnail.
-                    continue
-                t_method = "crop"
-                t_path = self.filepaths.remote_media_thumbnail(
-                    server_name, file_id, t_width, t_height, t_type, t_method
-                )
-                self._makedirs(t_path)
-                t_len = thumbnailer.crop(t_path, t_width, t_height, t_type)
-                remote_thumbnails.append([
-                    server_name, media_id, file_id,
-                    t_width, t_height, t_type, t_method, t_len
-                ])
+        if m_width * m_height >= self.max_image_pixels:
+            logger.info(
+                "Image too large to thumbnail %r x %r > %r",
+                m_width, m_height, self.max_image_pixels
+            )
+            return
 
-        yield preserve_context_over_fn(threads.deferToThread, generate_thumbnails)
+        sizes = self._get_thumbnail_sizes(thumbnailer, requirements)
+        t_lens = yield self._generate_thumbnails(input_path, [
+            (
+                self.filepaths.remote_media_thumbnail(
+                    server_name, file_id, t_width, t_height, t_type, t_method
+                ),
+                t_width, t_height, t_method, t_type,
+            )
+            for t_width, t_height, t_method, t_type in sizes
+        ])
 
-        for r in remote_thumbnails:
-            yield self.store.store_remote_media_thumbnail(*r)
+        for (t_width, t_height, t_method, t_type), t_len in zip(sizes, t_lens):
+            if not t_len:
+                continue
+            yield self.store.store_remote_media_thumbnail(
+                server_name, media_id, file_id,
+                t_width, t_height, t_type, t_method, t_len
+            )
 
         defer.returnValue({
             "width": m_width,
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer, threads
+
+from synapse.util.logcontext import preserve_context_over_fn
+
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+
+# How often we check whether the remote media cache is too big, in ms.
+EVICTION_INTERVAL_MS = 60 * 60 * 1000
+
+# How many entries we fetch from the database at a time while evicting.
+EVICTION_BATCH_SIZE = 100
+
+
+class RemoteMediaCacheEvicter(object):
+    """Keeps the remote media in the primary media store under the configured
+    size by evicting the least recently accessed media. Evicted media is
+    moved to the secondary media store if there is one, otherwise it is
+    deleted and will be downloaded again when next requested.
+    """
+
+    def __init__(self, hs, filepaths, secondary_filepaths, downloads):
+        self.store = hs.get_datastore()
+        self.clock = hs.get_clock()
+        self.max_size = hs.config.remote_media_cache_max_size
+        self.filepaths = filepaths
+        self.secondary_filepaths = secondary_filepaths
+        self.downloads = downloads
+        self._evicting = False
+
+        if self.max_size:
+            self.clock.looping_call(self.evict, EVICTION_INTERVAL_MS)
+
+    @defer.inlineCallbacks
+    def evict(self):
+        if self._evicting:
+            return
+
+        self._evicting = True
+        try:
+            yield self._evict()
+        except Exception:
+            logger.exception("Failed to evict remote media")
+        finally:
+            self._evicting = False
+
+    @defer.inlineCallbacks
+    def _evict(self):
+        # Make sure recent accesses are taken into account so that we don't
+        # evict media that is still in use.
+        yield self.store._flush_remote_media_accesses()
+
+        total_size = yield self.store.get_remote_media_cache_size()
+        if total_size <= self.max_size:
+            return
+
+        logger.info(
+            "Remote media cache is %d bytes, evicting down to %d",
+            total_size, self.max_size,
+        )
+
+        evicted = 0
+        while total_size > self.max_size:
+            rows = yield self.store.get_least_recently_accessed_remote_media(
+                EVICTION_BATCH_SIZE
+            )
+            candidates = [
+                row for row in rows
+                if (row["media_origin"], row["media_id"]) not in self.downloads
+            ]
+            if not candidates:
+                break
+
+            for row in candidates:
+                yield self._evict_media(
+                    row["media_origin"], row["media_id"], row["filesystem_id"],
+                )
+                total_size -= row["size"]
+                evicted += 1
+                if total_size <= self.max_size:
+                    break
+
+        logger.info("Evicted %d remote media", evicted)
+
+    @defer.inlineCallbacks
+    def _evict_media(self, server_name, media_id, file_id):
+        if self.secondary_filepaths:
+            # Copy before marking the media cold so that it is always
+            # available from wherever the database says it is.
+            yield preserve_context_over_fn(
+                threads.deferToThread, self._copy_to_secondary,
+                server_name, file_id,
+            )
+            yield self.store.mark_remote_media_cold(
+                server_name, media_id, self.clock.time_msec(),
+            )
+        else:
+            yield self.store.delete_remote_media(server_name, media_id)
+
+        yield preserve_context_over_fn(
+            threads.deferToThread, self._delete_from_primary,
+            server_name, file_id,
+        )
+
+    def _copy_to_secondary(self, server_name, file_id):
+        src = self.filepaths.remote_media_filepath(server_name, file_id)
+        dst = self.secondary_filepaths.remote_media_filepath(server_name, file_id)
+        if os.path.exists(src):
+            dirname = os.path.dirname(dst)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            shutil.copyfile(src, dst)
+
+        src = self.filepaths.remote_media_thumbnail_dir(server_name, file_id)
+        dst = self.secondary_filepaths.remote_media_thumbnail_dir(
+            server_name, file_id
+        )
+        if os.path.exists(src):
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            shutil.copytree(src, dst)
+
+    def _delete_from_primary(self, server_name, file_id):
+        path = self.filepaths.remote_media_filepath(server_name, file_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+        shutil.rmtree(
+            self.filepaths.remote_media_thumbnail_dir(server_name, file_id),
+            ignore_errors=True,
+        )
@@ -59,18 +59,26 @@ class DownloadResource(BaseMediaResource):
 
     @defer.inlineCallbacks
     def _respond_remote_file(self, request, server_name, media_id, name):
-        media_info = yield self._get_remote_media(server_name, media_id)
+        media_info, progress = yield self._get_remote_media_streaming(
+            server_name, media_id
+        )
 
         media_type = media_info["media_type"]
         media_length = media_info["media_length"]
         filesystem_id = media_info["filesystem_id"]
         upload_name = name if name else media_info["upload_name"]
 
-        file_path = self.filepaths.remote_media_filepath(
+        file_path = self._remote_filepaths(media_info).remote_media_filepath(
             server_name, filesystem_id
         )
 
-        yield self._respond_with_file(
-            request, media_type, file_path, media_length,
-            upload_name=upload_name,
-        )
+        if progress:
+            yield self._respond_with_in_progress_file(
+                request, media_type, file_path, progress,
+                upload_name=upload_name,
+            )
+        else:
+            yield self._respond_with_file(
+                request, media_type, file_path, media_length,
+                upload_name=upload_name,
+            )
@@ -60,8 +60,12 @@ class MediaFilePaths(object):
                                content_type, method):
         top_level_type, sub_type = content_type.split("/")
         file_name = "%i-%i-%s-%s" % (width, height, top_level_type, sub_type)
+        return os.path.join(
+            self.remote_media_thumbnail_dir(server_name, file_id), file_name
+        )
+
+    def remote_media_thumbnail_dir(self, server_name, file_id):
         return os.path.join(
             self.base_path, "remote_thumbnail", server_name,
             file_id[0:2], file_id[2:4], file_id[4:],
-            file_name
         )
@@ -18,6 +18,8 @@ from .download_resource import DownloadResource
 from .thumbnail_resource import ThumbnailResource
 from .identicon_resource import IdenticonResource
 from .filepath import MediaFilePaths
+from .cache_evicter import RemoteMediaCacheEvicter
+from .thumbnailer import ThumbnailerPool
 
 from twisted.web.resource import Resource
 
@@ -74,7 +76,24 @@ class MediaRepositoryResource(Resource):
     def __init__(self, hs):
         Resource.__init__(self)
         filepaths = MediaFilePaths(hs.config.media_store_path)
-        self.putChild("upload", UploadResource(hs, filepaths))
-        self.putChild("download", DownloadResource(hs, filepaths))
-        self.putChild("thumbnail", ThumbnailResource(hs, filepaths))
+        secondary_filepaths = None
+        if hs.config.remote_media_secondary_store_path:
+            secondary_filepaths = MediaFilePaths(
+                hs.config.remote_media_secondary_store_path
+            )
+        downloads = {}
+        thumbnailer_pool = ThumbnailerPool(hs.config.thumbnail_processes)
+        self.putChild("upload", UploadResource(
+            hs, filepaths, secondary_filepaths, downloads, thumbnailer_pool
+        ))
+        self.putChild("download", DownloadResource(
+            hs, filepaths, secondary_filepaths, downloads, thumbnailer_pool
+        ))
+        self.putChild("thumbnail", ThumbnailResource(
+            hs, filepaths, secondary_filepaths, downloads, thumbnailer_pool
+        ))
         self.putChild("identicon", IdenticonResource())
+
+        self.cache_evicter = RemoteMediaCacheEvicter(
+            hs, filepaths, secondary_filepaths, downloads
+        )
@@ -143,6 +143,7 @@ class ThumbnailResource(BaseMediaResource):
         )
 
         file_id = media_info["filesystem_id"]
+        filepaths = self._remote_filepaths(media_info)
 
         for info in thumbnail_infos:
             t_w = info["thumbnail_width"] == desired_width
@@ -151,7 +152,7 @@ class ThumbnailResource(BaseMediaResource):
             t_type = info["thumbnail_type"] == desired_type
 
             if t_w and t_h and t_method and t_type:
-                file_path = self.filepaths.remote_media_thumbnail(
+                file_path = filepaths.remote_media_thumbnail(
                     server_name, file_id, desired_width, desired_height,
                     desired_type, desired_method,
                 )
@@ -162,7 +163,7 @@ class ThumbnailResource(BaseMediaResource):
 
         # Okay, so we generate one.
         file_path = yield self._generate_remote_exact_thumbnail(
-            server_name, file_id, media_id, desired_width,
+            server_name, media_id, media_info, desired_width,
             desired_height, desired_method, desired_type
         )
 
@@ -196,7 +197,7 @@ class ThumbnailResource(BaseMediaResource):
             file_id = thumbnail_info["filesystem_id"]
             t_length = thumbnail_info["thumbnail_length"]
 
-            file_path = self.filepaths.remote_media_thumbnail(
+            file_path = self._remote_filepaths(media_info).remote_media_thumbnail(
                 server_name, file_id, t_width, t_height, t_type, t_method,
             )
             yield self._respond_with_file(request, t_type, file_path, t_length)
@@ -239,7 +240,7 @@ class ThumbnailResource(BaseMediaResource):
         file_path = self.filepaths.default_thumbnail(
             top_level_type, sub_type, t_width, t_height, t_type, t_method,
         )
-        yield self.respond_with_file(request, t_type, file_path, t_length)
+        yield self._respond_with_file(request, t_type, file_path, t_length)
 
     def _select_thumbnail(self, desired_width, desired_height, desired_method,
                           desired_type, thumbnail_infos):
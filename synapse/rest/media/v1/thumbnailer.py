@@ -13,8 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from twisted.internet import defer, reactor, threads
+
 import PIL.Image as Image
-from io import BytesIO
+import logging
+import multiprocessing
+import os
+import signal
+import traceback
+
+logger = logging.getLogger(__name__)
 
 
 class Thumbnailer(object):
@@ -27,6 +35,9 @@ class Thumbnailer(object):
     def __init__(self, input_path):
         self.image = Image.open(input_path)
         self.width, self.height = self.image.size
+        # Map from (width, height) to resized copies of the image, so that
+        # smaller thumbnails can be derived from larger ones.
+        self.resized = {}
 
     def aspect(self, max_width, max_height):
         """Calculate the largest size that preserves aspect ratio which
@@ -46,9 +57,44 @@ class Thumbnailer(object):
         else:
             return ((max_height * self.width) // self.height, max_height)
 
+    def crop_size(self, width, height):
+        """Calculate the size the image is scaled to before being cropped to
+        the given dimensions.
+        """
+        if width * self.height > height * self.width:
+            return (width, (width * self.height) // self.width)
+        else:
+            return ((height * self.width) // self.height, height)
+
+    def draft(self, width, height):
+        """Asks the decoder to only load enough of the image to produce
+        thumbnails of up to the given size. For JPEGs this lets libjpeg decode
+        at a reduced scale, which is much faster for large photos. Must be
+        called before the image is loaded.
+        """
+        if self.image.format == "JPEG":
+            self.image.draft(self.image.mode, (width, height))
+
+    def resize(self, width, height):
+        """Rescales the image to the given dimensions, starting from the
+        smallest already resized copy that is at least twice as big so that
+        quality doesn't suffer.
+        """
+        source = self.image
+        source_width = source.size[0]
+        for (r_width, r_height), resized in self.resized.items():
+            if r_width >= 2 * width and r_height >= 2 * height:
+                if r_width < source_width:
+                    source = resized
+                    source_width = r_width
+
+        scaled = source.resize((width, height), Image.ANTIALIAS)
+        self.resized[(width, height)] = scaled
+        return scaled
+
     def scale(self, output_path, width, height, output_type):
         """Rescales the image to the given dimensions"""
-        scaled = self.image.resize((width, height), Image.ANTIALIAS)
+        scaled = self.resize(width, height)
         return self.save_image(scaled, output_type, output_path)
 
     def crop(self, output_path, width, height, output_type):
@@ -62,28 +108,165 @@ class Thumbnailer(object):
             max_width: The largest possible width.
             max_height: The larget possible height.
         """
-        if width * self.height > height * self.width:
-            scaled_height = (width * self.height) // self.width
-            scaled_image = self.image.resize(
-                (width, scaled_height), Image.ANTIALIAS
-            )
-            crop_top = (scaled_height - height) // 2
-            crop_bottom = height + crop_top
-            cropped = scaled_image.crop((0, crop_top, width, crop_bottom))
-        else:
-            scaled_width = (height * self.width) // self.height
-            scaled_image = self.image.resize(
-                (scaled_width, height), Image.ANTIALIAS
-            )
-            crop_left = (scaled_width - width) // 2
-            crop_right = width + crop_left
-            cropped = scaled_image.crop((crop_left, 0, crop_right, height))
+        scaled_width, scaled_height = self.crop_size(width, height)
+        scaled_image = self.resize(scaled_width, scaled_height)
+        crop_left = (scaled_width - width) // 2
+        crop_top = (scaled_height - height) // 2
+        cropped = scaled_image.crop(
+            (crop_left, crop_top, crop_left + width, crop_top + height)
+        )
         return self.save_image(cropped, output_type, output_path)
 
     def save_image(self, output_image, output_type, output_path):
-        output_bytes_io = BytesIO()
-        output_image.save(output_bytes_io, self.FORMATS[output_type], quality=80)
-        output_bytes = output_bytes_io.getvalue()
         with open(output_path, "wb") as output_file:
-            output_file.write(output_bytes)
-        return len(output_bytes)
+            output_image.save(output_file, self.FORMATS[output_type], quality=80)
+        return os.path.getsize(output_path)
+
+
+def generate_thumbnails(input_path, thumbnails, max_image_pixels):
+    """Generates several thumbnails of an image, decoding it only once.
+
+    This is run in the thumbnailing worker processes, so must be a module
+    level function taking and returning only picklable values.
+
+    Args:
+        input_path (str): Path to the source image.
+        thumbnails (list): List of (output_path, width, height, method, type)
+            tuples describing the thumbnails to write.
+        max_image_pixels (int): Images with more pixels than this are not
+            thumbnailed.
+    Returns:
+        A list with the length in bytes of each written thumbnail, or None if
+        it couldn't be generated, in the same order as `thumbnails`.
+    """
+    thumbnailer = Thumbnailer(input_path)
+
+    if thumbnailer.width * thumbnailer.height >= max_image_pixels:
+        logger.info(
+            "Image too large to thumbnail %r x %r > %r",
+            thumbnailer.width, thumbnailer.height, max_image_pixels
+        )
+        return [None] * len(thumbnails)
+
+    def scaled_size(thumbnail):
+        _, t_width, t_height, t_method, _ = thumbnail
+        if t_method == "crop":
+            return thumbnailer.crop_size(t_width, t_height)
+        return t_width, t_height
+
+    if thumbnails:
+        thumbnailer.draft(*max(scaled_size(t) for t in thumbnails))
+
+    # Do the biggest first so that the smaller ones can be derived from them.
+    ordered = sorted(
+        range(len(thumbnails)),
+        key=lambda i: scaled_size(thumbnails[i]),
+        reverse=True,
+    )
+
+    lengths = [None] * len(thumbnails)
+    for i in ordered:
+        t_path, t_width, t_height, t_method, t_type = thumbnails[i]
+        if t_method == "crop":
+            lengths[i] = thumbnailer.crop(t_path, t_width, t_height, t_type)
+        elif t_method == "scale":
+            lengths[i] = thumbnailer.scale(t_path, t_width, t_height, t_type)
+
+    return lengths
+
+
+# How long to wait for a thumbnailing job to run in a worker process before
+# giving up on it.
+THUMBNAIL_TIMEOUT_SECONDS = 60
+
+# How many jobs a worker process runs before it is replaced, so that any
+# memory leaked by PIL is given back.
+MAX_TASKS_PER_CHILD = 100
+
+
+def _init_worker():
+    """Undoes the signal handling the worker process inherited from the
+    reactor, so that it can be terminated and doesn't wake up the reactor in
+    the parent process. Interrupts are left to the parent to deal with.
+    """
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_in_worker(f, args):
+    """Runs f(*args) in a worker process. Python 2's Pool.apply_async has no
+    error callback, so failures are returned as a formatted traceback rather
+    than raised.
+    """
+    try:
+        return True, f(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class ThumbnailerPool(object):
+    """Runs thumbnailing jobs off the reactor thread.
+
+    If configured with a number of processes the jobs run in a pool of worker
+    processes, so that resizing doesn't compete with the reactor for the GIL.
+    Otherwise they run in the reactor's thread pool.
+    """
+
+    def __init__(self, processes, timeout=THUMBNAIL_TIMEOUT_SECONDS):
+        self.processes = processes
+        self.timeout = timeout
+        self._pool = None
+
+        if self.processes:
+            # Fork the workers as the reactor starts: after daemonizing, but
+            # before the reactor and database thread pools are started, so
+            # that the children can't inherit a lock held by another thread.
+            reactor.addSystemEventTrigger("before", "startup", self._start_pool)
+
+    def _start_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(
+                self.processes,
+                initializer=_init_worker,
+                maxtasksperchild=MAX_TASKS_PER_CHILD,
+            )
+
+    def run(self, f, *args):
+        """Runs f(*args), returning a deferred with the result. f must be a
+        module level function if we are using worker processes.
+        """
+        if not self.processes:
+            return threads.deferToThread(f, *args)
+
+        # Only happens if we were created after the reactor started.
+        self._start_pool()
+
+        d = defer.Deferred()
+
+        # The pool never calls back if the worker running the job dies, so
+        # make sure the caller isn't left waiting forever.
+        def on_timeout():
+            d.errback(Exception(
+                "Thumbnailing timed out after %ds" % (self.timeout,)
+            ))
+
+        timer = reactor.callLater(self.timeout, on_timeout)
+
+        def on_done(success, value):
+            if d.called:
+                # We've already timed out.
+                return
+
+            timer.cancel()
+            if success:
+                d.callback(value)
+            else:
+                d.errback(Exception("Thumbnailing failed:\n" + value))
+
+        def on_result(result):
+            # Called from the pool's result handler thread.
+            reactor.callFromThread(on_done, *result)
+
+        self._pool.apply_async(_run_in_worker, (f, args), callback=on_result)
+        return d
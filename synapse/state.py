@@ -100,7 +100,8 @@ class StateHandler(object):
         defer.returnValue(state)
 
     @defer.inlineCallbacks
-    def compute_event_context(self, event, old_state=None, outlier=False):
+    def compute_event_context(self, event, old_state=None, outlier=False,
+                              lazy=False):
         """ Fills out the context with the `current state` of the graph. The
         `current state` here is defined to be the state of the event graph
         just before the event - i.e. it never includes `event`
@@ -110,6 +111,11 @@ class StateHandler(object):
 
         Args:
             event (EventBase)
+            lazy (bool): If True and `event` is not a state event whose state
+                is a single existing state group, then the context only
+                records the state group and the state is loaded on demand
+                with `EventContext.get_current_state`, rather than being set
+                in `current_state`.
         Returns:
             an EventContext
         """
@@ -145,6 +151,22 @@ class StateHandler(object):
             context.prev_state_events = []
             defer.returnValue(context)
 
+        if lazy and not event.is_state():
+            event_to_groups = yield self.store.get_state_group_for_events(
+                [e for e, _ in event.prev_events]
+            )
+            groups = set(event_to_groups.values())
+            if len(groups) == 1:
+                # There is nothing to resolve, so we don't need to load the
+                # state until someone asks for it.
+                group = groups.pop()
+                context.state_group = group
+                context.state_loader = (
+                    lambda types: self.store.get_state_for_group(group, types)
+                )
+                context.prev_state_events = []
+                defer.returnValue(context)
+
         if event.is_state():
             ret = yield self.resolve_state_groups(
                 event.room_id, [e for e, _ in event.prev_events],
@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from .appservice import (
     ApplicationServiceStore, ApplicationServiceTransactionStore
 )
@@ -62,6 +62,9 @@ logger = logging.getLogger(__name__)
 # 120 seconds == 2 minutes
 LAST_SEEN_GRANULARITY = 120 * 1000
 
+# How often we write out the batched up client IPs, in msec.
+CLIENT_IP_FLUSH_INTERVAL_MS = 5 * 1000
+
 
 class DataStore(RoomMemberStore, RoomStore,
                 RegistrationStore, StreamStore, ProfileStore,
@@ -112,7 +115,8 @@ class DataStore(RoomMemberStore, RoomStore,
             db_conn, "account_data_max_stream_id", "stream_id"
         )
         self._presence_id_gen = StreamIdGenerator(
-            db_conn, "presence_stream", "stream_id"
+            db_conn, "presence_stream", "stream_id",
+            extra_tables=[("presence_stream_max_id", "stream_id")],
         )
 
         self._transaction_id_gen = IdGenerator(db_conn, "sent_transactions", "id")
@@ -144,6 +148,10 @@ class DataStore(RoomMemberStore, RoomStore,
         self._membership_stream_cache = StreamChangeCache(
             "MembershipStreamChangeCache", events_max,
         )
+        self._room_membership_stream_cache = StreamChangeCache(
+            "RoomMembershipStreamChangeCache", events_max,
+        )
+        self._membership_index = self._load_membership_index(db_conn)
 
         account_max = self._account_data_id_gen.get_max_token()
         self._account_data_stream_cache = StreamChangeCache(
@@ -177,6 +185,16 @@ class DataStore(RoomMemberStore, RoomStore,
 
         super(DataStore, self).__init__(hs)
 
+        # Map from (user_id, access_token, ip, user_agent) to last_seen for
+        # client IPs that haven't yet been written to the database.
+        self._batch_row_update = {}
+        self._clock.looping_call(
+            self._update_client_ips_batch, CLIENT_IP_FLUSH_INTERVAL_MS
+        )
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", self._update_client_ips_batch
+        )
+
     def take_presence_startup_info(self):
         active_on_startup = self.__presence_on_startup
         self.__presence_on_startup = None
@@ -237,8 +255,11 @@ class DataStore(RoomMemberStore, RoomStore,
 
         return [UserPresenceState(**row) for row in rows]
 
-    @defer.inlineCallbacks
     def insert_client_ip(self, user, access_token, ip, user_agent):
+        """Records that a user made a request from the given IP. This is only
+        queued up in memory; the queue is written to the database in a
+        single transaction every CLIENT_IP_FLUSH_INTERVAL_MS.
+        """
         now = int(self._clock.time_msec())
         key = (user.to_string(), access_token, ip)
 
@@ -249,27 +270,44 @@ class DataStore(RoomMemberStore, RoomStore,
 
         # Rate-limited inserts
         if last_seen is not None and (now - last_seen) < LAST_SEEN_GRANULARITY:
-            defer.returnValue(None)
+            return
 
         self.client_ip_last_seen.prefill(key, now)
 
-        # It's safe not to lock here: a) no unique constraint,
-        # b) LAST_SEEN_GRANULARITY makes concurrent updates incredibly unlikely
-        yield self._simple_upsert(
-            "user_ips",
-            keyvalues={
-                "user_id": user.to_string(),
-                "access_token": access_token,
-                "ip": ip,
-                "user_agent": user_agent,
-            },
-            values={
-                "last_seen": now,
-            },
-            desc="insert_client_ip",
-            lock=False,
+        self._batch_row_update[key + (user_agent,)] = now
+
+    def _update_client_ips_batch(self):
+        if not self._batch_row_update:
+            return defer.succeed(None)
+
+        to_update = self._batch_row_update
+        self._batch_row_update = {}
+        return self.runInteraction(
+            "_update_client_ips_batch", self._update_client_ips_batch_txn,
+            to_update,
         )
 
+    def _update_client_ips_batch_txn(self, txn, to_update):
+        for entry, last_seen in to_update.items():
+            user_id, access_token, ip, user_agent = entry
+            # It's safe not to lock here: a) no unique constraint,
+            # b) LAST_SEEN_GRANULARITY makes concurrent updates incredibly
+            # unlikely
+            self._simple_upsert_txn(
+                txn,
+                table="user_ips",
+                keyvalues={
+                    "user_id": user_id,
+                    "access_token": access_token,
+                    "ip": ip,
+                    "user_agent": user_agent,
+                },
+                values={
+                    "last_seen": last_seen,
+                },
+                lock=False,
+            )
+
     @defer.inlineCallbacks
     def count_daily_users(self):
         """
@@ -291,16 +329,39 @@ class DataStore(RoomMemberStore, RoomStore,
         ret = yield self.runInteraction("count_users", _count_users)
         defer.returnValue(ret)
 
+    @defer.inlineCallbacks
     def get_user_ip_and_agents(self, user):
-        return self._simple_select_list(
+        user_id = user.to_string()
+        rows = yield self._simple_select_list(
             table="user_ips",
-            keyvalues={"user_id": user.to_string()},
+            keyvalues={"user_id": user_id},
             retcols=[
                 "access_token", "ip", "user_agent", "last_seen"
             ],
             desc="get_user_ip_and_agents",
         )
 
+        results = {
+            (row["access_token"], row["ip"], row["user_agent"]): row["last_seen"]
+            for row in rows
+        }
+
+        # Include the client IPs that we haven't written out yet.
+        for entry, last_seen in self._batch_row_update.items():
+            entry_user_id, access_token, ip, user_agent = entry
+            if entry_user_id == user_id:
+                results[(access_token, ip, user_agent)] = last_seen
+
+        defer.returnValue([
+            {
+                "access_token": key[0],
+                "ip": key[1],
+                "user_agent": key[2],
+                "last_seen": last_seen,
+            }
+            for key, last_seen in results.items()
+        ])
+
 
 def are_all_users_on_domain(txn, database_engine, domain):
     sql = database_engine.convert_param_style(
@@ -38,6 +38,7 @@ class ApplicationServiceStore(SQLBaseStore):
             hs.hostname,
             hs.config.app_service_config_files
         )
+        self._app_service_room_interest_checked = set()
 
     def get_app_services(self):
         return defer.succeed(self.services_cache)
@@ -94,24 +95,97 @@ class ApplicationServiceStore(SQLBaseStore):
         )
 
     def _get_app_service_rooms_txn(self, txn, service):
+        self._ensure_app_service_room_interest_txn(txn, service)
+
+        rows = self._simple_select_list_txn(
+            txn,
+            table="application_services_room_interest",
+            keyvalues={"as_id": service.id},
+            retcols=[
+                "room_id", "sender", "membership_event_id", "stream_ordering",
+            ],
+        )
+
+        # A room may be listed more than once if it matched for more than one
+        # reason. Prefer the entries from a join event, since they have the
+        # most information.
+        rooms = {}
+        for row in rows:
+            if row["room_id"] in rooms and not row["membership_event_id"]:
+                continue
+            rooms[row["room_id"]] = RoomsForUser(
+                row["room_id"], row["sender"], Membership.JOIN,
+                row["membership_event_id"], row["stream_ordering"],
+            )
+
+        return set(rooms.values())
+
+    def _ensure_app_service_room_interest_txn(self, txn, service):
+        """Rebuilds the rooms the service is interested in if its namespaces
+        have changed since they were last worked out.
+
+        This only checks the database the first time it is called for each
+        service, since the registrations are only loaded at startup.
+        """
+        if service.id in self._app_service_room_interest_checked:
+            return
+
+        namespaces = json.dumps(
+            {"namespaces": service.namespaces, "sender": service.sender},
+            sort_keys=True,
+        )
+        stored_namespaces = self._simple_select_one_onecol_txn(
+            txn,
+            table="application_services_room_interest_state",
+            keyvalues={"as_id": service.id},
+            retcol="namespaces",
+            allow_none=True,
+        )
+
+        if stored_namespaces != namespaces:
+            logger.info(
+                "Rebuilding rooms application service %s is interested in",
+                service.id,
+            )
+            self._rebuild_app_service_room_interest_txn(txn, service)
+            self._simple_upsert_txn(
+                txn,
+                table="application_services_room_interest_state",
+                keyvalues={"as_id": service.id},
+                values={"namespaces": namespaces},
+            )
+
+        txn.call_after(self._app_service_room_interest_checked.add, service.id)
+
+    def _rebuild_app_service_room_interest_txn(self, txn, service):
+        self._simple_delete_txn(
+            txn,
+            table="application_services_room_interest",
+            keyvalues={"as_id": service.id},
+        )
+
+        rows = []
+
         # get all rooms matching the room ID regex.
         room_entries = self._simple_select_list_txn(
             txn=txn, table="rooms", keyvalues=None, retcols=["room_id"]
         )
-        matching_room_list = set([
-            r["room_id"] for r in room_entries if
-            service.is_interested_in_room(r["room_id"])
-        ])
+        rows.extend(
+            (r["room_id"], r["room_id"], service.sender, None, None)
+            for r in room_entries
+            if service.is_interested_in_room(r["room_id"])
+        )
 
         # resolve room IDs for matching room alias regex.
         room_alias_mappings = self._simple_select_list_txn(
             txn=txn, table="room_aliases", keyvalues=None,
             retcols=["room_id", "room_alias"]
         )
-        matching_room_list |= set([
-            r["room_id"] for r in room_alias_mappings if
-            service.is_interested_in_alias(r["room_alias"])
-        ])
+        rows.extend(
+            (r["room_id"], r["room_alias"], service.sender, None, None)
+            for r in room_alias_mappings
+            if service.is_interested_in_alias(r["room_alias"])
+        )
 
         # get all rooms for every user for this AS. This is scoped to users on
         # this HS only.
@@ -122,7 +196,6 @@ class ApplicationServiceStore(SQLBaseStore):
             u["name"] for u in user_list if
             service.is_interested_in_user(u["name"])
         ]
-        rooms_for_user_matching_user_id = set()  # RoomsForUser list
         for user_id in user_list:
             # FIXME: This assumes this store is linked with RoomMemberStore :(
             rooms_for_user = self._get_rooms_for_user_where_membership_is_txn(
@@ -130,19 +203,136 @@ class ApplicationServiceStore(SQLBaseStore):
                 user_id=user_id,
                 membership_list=[Membership.JOIN]
             )
-            rooms_for_user_matching_user_id |= set(rooms_for_user)
-
-        # make RoomsForUser tuples for room ids and aliases which are not in the
-        # main rooms_for_user_list - e.g. they are rooms which do not have AS
-        # registered users in it.
-        known_room_ids = [r.room_id for r in rooms_for_user_matching_user_id]
-        missing_rooms_for_user = [
-            RoomsForUser(r, service.sender, "join") for r in
-            matching_room_list if r not in known_room_ids
-        ]
-        rooms_for_user_matching_user_id |= set(missing_rooms_for_user)
+            rows.extend(
+                (r.room_id, user_id, r.sender, r.event_id, r.stream_ordering)
+                for r in rooms_for_user
+            )
+
+        self._simple_insert_many_txn(
+            txn,
+            table="application_services_room_interest",
+            values=[
+                {
+                    "as_id": service.id,
+                    "room_id": room_id,
+                    "interest": interest,
+                    "sender": sender,
+                    "membership_event_id": event_id,
+                    "stream_ordering": stream_ordering,
+                }
+                for room_id, interest, sender, event_id, stream_ordering in rows
+            ],
+        )
+
+    def _add_app_service_room_interest_txn(self, txn, room_id, interest,
+                                           services, sender=None,
+                                           event_id=None, stream_ordering=None):
+        """Records that the given services are interested in a room.
+
+        Args:
+            txn: The database transaction.
+            room_id (str): The room the services are interested in.
+            interest (str): The room ID, room alias or user ID that matched.
+            services (list): The ApplicationServices that are interested.
+            sender (str): The sender of the join event, if the interest is
+                because of a user. Defaults to the service's sender.
+            event_id (str): The join event, if any.
+            stream_ordering (int): The stream ordering of the join event.
+        """
+        if not services:
+            return
 
-        return rooms_for_user_matching_user_id
+        self._remove_app_service_room_interest_txn(txn, room_id, interest)
+        self._simple_insert_many_txn(
+            txn,
+            table="application_services_room_interest",
+            values=[
+                {
+                    "as_id": service.id,
+                    "room_id": room_id,
+                    "interest": interest,
+                    "sender": sender or service.sender,
+                    "membership_event_id": event_id,
+                    "stream_ordering": stream_ordering,
+                }
+                for service in services
+            ],
+        )
+
+    def _remove_app_service_room_interest_txn(self, txn, room_id, interest):
+        self._simple_delete_txn(
+            txn,
+            table="application_services_room_interest",
+            keyvalues={"room_id": room_id, "interest": interest},
+        )
+
+    def _update_app_service_room_interest_for_room_txn(self, txn, room_id):
+        """Called when a new room is stored."""
+        self._add_app_service_room_interest_txn(
+            txn, room_id, room_id,
+            [s for s in self.services_cache if s.is_interested_in_room(room_id)],
+        )
+
+    def _update_app_service_room_interest_for_alias_txn(self, txn, room_alias,
+                                                        room_id):
+        """Called when a room alias is created."""
+        self._add_app_service_room_interest_txn(
+            txn, room_id, room_alias,
+            [
+                s for s in self.services_cache
+                if s.is_interested_in_alias(room_alias)
+            ],
+        )
+
+    def _update_app_service_room_interest_for_members_txn(self, txn, room_id,
+                                                          events):
+        """Called when the current membership of local users in a room changes.
+
+        Args:
+            txn: The database transaction.
+            room_id (str): The room whose membership changed.
+            events (list): The new current m.room.member events.
+        """
+        for event in events:
+            user_id = event.state_key
+            if not self.hs.is_mine_id(user_id):
+                continue
+
+            services = [
+                s for s in self.services_cache
+                if s.is_interested_in_user(user_id)
+            ]
+            if not services:
+                continue
+
+            if event.membership == Membership.JOIN:
+                self._add_app_service_room_interest_txn(
+                    txn, room_id, user_id, services,
+                    sender=event.sender,
+                    event_id=event.event_id,
+                    stream_ordering=getattr(
+                        event.internal_metadata, "stream_ordering", None
+                    ),
+                )
+            else:
+                self._remove_app_service_room_interest_txn(txn, room_id, user_id)
+
+    def _reset_app_service_room_interest_for_members_txn(self, txn, room_id,
+                                                         events):
+        """Called when the whole current state of a room is replaced, e.g.
+        when joining a room over federation.
+        """
+        if not self.services_cache:
+            return
+
+        txn.execute(
+            "DELETE FROM application_services_room_interest"
+            " WHERE room_id = ? AND membership_event_id IS NOT NULL",
+            (room_id,)
+        )
+        self._update_app_service_room_interest_for_members_txn(
+            txn, room_id, events
+        )
 
     @classmethod
     def _load_appservice(cls, hostname, as_info, config_filename):
@@ -340,12 +530,25 @@ class ApplicationServiceTransactionStore(SQLBaseStore):
 
         new_txn_id = max(highest_txn_id, last_txn_id) + 1
 
-        # Insert new txn into txn table
-        event_ids = json.dumps([e.event_id for e in events])
+        # Insert new txn into txn table. The events are only referenced by ID,
+        # and read back from the events table when the txn is retried. (The
+        # event_ids column is only used by txns created by older versions.)
         txn.execute(
             "INSERT INTO application_services_txns(as_id, txn_id, event_ids) "
             "VALUES(?,?,?)",
-            (service.id, new_txn_id, event_ids)
+            (service.id, new_txn_id, "[]")
+        )
+        self._simple_insert_many_txn(
+            txn,
+            table="application_services_txn_events",
+            values=[
+                {
+                    "as_id": service.id,
+                    "txn_id": new_txn_id,
+                    "event_id": e.event_id,
+                }
+                for e in events
+            ],
         )
         return AppServiceTransaction(
             service=service, id=new_txn_id, events=events
@@ -396,6 +599,10 @@ class ApplicationServiceTransactionStore(SQLBaseStore):
             txn, "application_services_txns",
             dict(txn_id=txn_id, as_id=service.id)
         )
+        self._simple_delete_txn(
+            txn, "application_services_txn_events",
+            dict(txn_id=txn_id, as_id=service.id)
+        )
 
     def get_oldest_unsent_txn(self, service):
         """Get the oldest transaction which has not been sent for this
@@ -427,13 +634,40 @@ class ApplicationServiceTransactionStore(SQLBaseStore):
 
         entry = rows[0]
 
-        event_ids = json.loads(entry["event_ids"])
+        txn.execute(
+            "SELECT e.event_id FROM application_services_txn_events AS t"
+            " INNER JOIN events AS e USING (event_id)"
+            " WHERE t.as_id = ? AND t.txn_id = ?"
+            " ORDER BY e.stream_ordering ASC",
+            (service.id, entry["txn_id"],)
+        )
+        event_ids = [r[0] for r in txn.fetchall()]
+        if not event_ids:
+            event_ids = json.loads(entry["event_ids"])
         events = self._get_events_txn(txn, event_ids)
 
         return AppServiceTransaction(
             service=service, id=entry["txn_id"], events=events
         )
 
+    def get_appservice_unsent_txn_count(self, service):
+        """Get the number of transactions which have not yet been sent to this
+        service.
+
+        Args:
+            service(ApplicationService): The app service to count txns for.
+        Returns:
+            A Deferred which resolves to the number of unsent txns.
+        """
+        def f(txn):
+            txn.execute(
+                "SELECT COUNT(*) FROM application_services_txns WHERE as_id=?",
+                (service.id,)
+            )
+            return txn.fetchone()[0]
+
+        return self.runInteraction("get_appservice_unsent_txn_count", f)
+
     def _get_last_txn(self, txn, service_id):
         txn.execute(
             "SELECT last_txn FROM application_services_state WHERE as_id=?",
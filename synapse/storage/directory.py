@@ -107,6 +107,14 @@ class DirectoryStore(SQLBaseStore):
                 },
                 desc="create_room_alias_association",
             )
+
+        # FIXME: This assumes this store is linked with ApplicationServiceStore
+        yield self.runInteraction(
+            "create_room_alias_association",
+            self._update_app_service_room_interest_for_alias_txn,
+            room_alias.to_string(), room_id,
+        )
+
         self.get_aliases_for_room.invalidate((room_id,))
 
     def get_room_alias_creator(self, room_alias):
@@ -153,6 +161,10 @@ class DirectoryStore(SQLBaseStore):
             (room_alias.to_string(),)
         )
 
+        self._remove_app_service_room_interest_txn(
+            txn, room_id, room_alias.to_string()
+        )
+
         return room_id
 
     @cached(max_entries=5000)
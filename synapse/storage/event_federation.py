@@ -16,7 +16,10 @@
 from twisted.internet import defer
 
 from ._base import SQLBaseStore
+from synapse.crypto.event_signing import compute_event_reference_hash
+from synapse.util.caches import CACHE_SIZE_FACTOR
 from synapse.util.caches.descriptors import cached
+from synapse.util.caches.lrucache import LruCache
 from unpaddedbase64 import encode_base64
 
 import logging
@@ -36,6 +39,15 @@ class EventFederationStore(SQLBaseStore):
     and backfilling from another server respectively.
     """
 
+    def __init__(self, hs):
+        super(EventFederationStore, self).__init__(hs)
+
+        # room_id -> dict of event_id -> (prev_hashes, depth) for the room's
+        # forward extremities, see get_latest_event_ids_and_hashes_in_room
+        self._forward_extremities_cache = LruCache(
+            max_size=int(10000 * CACHE_SIZE_FACTOR)
+        )
+
     def get_auth_chain(self, event_ids):
         return self.get_auth_chain_ids(event_ids).addCallback(self._get_events)
 
@@ -114,12 +126,44 @@ class EventFederationStore(SQLBaseStore):
             retcol="event_id",
         )
 
+    @defer.inlineCallbacks
     def get_latest_event_ids_and_hashes_in_room(self, room_id):
-        return self.runInteraction(
-            "get_latest_event_ids_and_hashes_in_room",
-            self._get_latest_event_ids_and_hashes_in_room,
-            room_id,
-        )
+        """Get the forward extremities of the room, to be used as the
+        prev_events of a new event.
+
+        The extremities are kept in memory once loaded, and updated as events
+        are persisted, so that building events doesn't need to hit the
+        database.
+
+        Returns:
+            Deferred[list]: list of (event_id, prev_hashes, depth) tuples
+        """
+        extremities = self._forward_extremities_cache.get(room_id)
+        if extremities is None:
+            # Any events persisted in the room after this point will have a
+            # higher stream ordering, and so stop us caching a stale result.
+            current_stream_ordering = self._stream_id_gen.get_max_token()
+
+            results = yield self.runInteraction(
+                "get_latest_event_ids_and_hashes_in_room",
+                self._get_latest_event_ids_and_hashes_in_room,
+                room_id,
+            )
+            extremities = {
+                event_id: (prev_hashes, depth)
+                for event_id, prev_hashes, depth in results
+            }
+
+            changed = self._events_stream_cache.has_entity_changed(
+                room_id, current_stream_ordering,
+            )
+            if not changed:
+                self._forward_extremities_cache.set(room_id, extremities)
+
+        defer.returnValue([
+            (event_id, prev_hashes, depth)
+            for event_id, (prev_hashes, depth) in extremities.items()
+        ])
 
     @cached()
     def get_latest_event_ids_in_room(self, room_id):
@@ -284,10 +328,55 @@ class EventFederationStore(SQLBaseStore):
             ]
         )
 
-        for room_id in events_by_room:
+        for room_id, room_events in events_by_room.items():
             txn.call_after(
                 self.get_latest_event_ids_in_room.invalidate, (room_id,)
             )
+            self._update_forward_extremities_cache_txn(txn, room_id, room_events)
+
+    def _update_forward_extremities_cache_txn(self, txn, room_id, events):
+        """Updates our in memory copy of the room's forward extremities, if we
+        have one, once the transaction has committed.
+        """
+        if self._forward_extremities_cache.get(room_id) is None:
+            # A lookup may be loading the extremities from the database right
+            # now, so make sure that it doesn't leave behind a stale copy.
+            txn.call_after(self._forward_extremities_cache.pop, room_id)
+            return
+
+        event_ids = self._simple_select_onecol_txn(
+            txn,
+            table="event_forward_extremities",
+            keyvalues={"room_id": room_id},
+            retcol="event_id",
+        )
+
+        new_events = {
+            ev.event_id: ev for ev in events
+            if not ev.internal_metadata.is_outlier()
+        }
+
+        def update():
+            old_extremities = self._forward_extremities_cache.get(room_id)
+            if old_extremities is None:
+                return
+
+            extremities = {}
+            for event_id in event_ids:
+                if event_id in old_extremities:
+                    extremities[event_id] = old_extremities[event_id]
+                elif event_id in new_events:
+                    ev = new_events[event_id]
+                    extremities[event_id] = (_get_prev_hashes(ev), ev.depth)
+                else:
+                    # We don't know the depth and hashes of this extremity, so
+                    # reload the room from the database next time.
+                    self._forward_extremities_cache.pop(room_id)
+                    return
+
+            self._forward_extremities_cache.set(room_id, extremities)
+
+        txn.call_after(update)
 
     def get_backfill_events(self, room_id, event_list, limit):
         """Get a list of Events for a given topic that occurred before (and
@@ -430,3 +519,14 @@ class EventFederationStore(SQLBaseStore):
 
         txn.execute(query, (room_id,))
         txn.call_after(self.get_latest_event_ids_in_room.invalidate, (room_id,))
+        txn.call_after(self._forward_extremities_cache.pop, room_id)
+
+
+def _get_prev_hashes(event):
+    """Get the reference hashes of the event, in the form used for the
+    prev_events of a new event.
+    """
+    ref_alg, ref_hash_bytes = compute_event_reference_hash(event)
+    if ref_alg != "sha256":
+        return {}
+    return {ref_alg: encode_base64(ref_hash_bytes)}
@@ -12,9 +12,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from ._base import SQLBaseStore, _RollbackButIsFineException
+from ._base import SQLBaseStore
 
 from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 
 from synapse.events import FrozenEvent, USE_FROZEN_DICTS
 from synapse.events.utils import prune_event
@@ -24,6 +25,7 @@ from synapse.util.logutils import log_function
 from synapse.api.constants import EventTypes
 
 from canonicaljson import encode_canonical_json
+from collections import deque, namedtuple
 from contextlib import contextmanager
 
 import logging
@@ -50,6 +52,12 @@ EVENT_QUEUE_ITERATIONS = 3  # No. times we block waiting for requests for events
 EVENT_QUEUE_TIMEOUT_S = 0.1  # Timeout when waiting for requests for events
 
 
+_QueuedEvent = namedtuple(
+    "_QueuedEvent",
+    ("event", "context", "is_new_state", "current_state", "deferred"),
+)
+
+
 class EventsStore(SQLBaseStore):
     EVENT_ORIGIN_SERVER_TS_NAME = "event_origin_server_ts"
 
@@ -59,6 +67,14 @@ class EventsStore(SQLBaseStore):
             self.EVENT_ORIGIN_SERVER_TS_NAME, self._background_reindex_origin_server_ts
         )
 
+        # Events waiting to be persisted by persist_event, as a map from
+        # room_id to list of _QueuedEvent. Each room is persisted by at most
+        # one transaction at a time, and we persist at most as many rooms
+        # at once as there are database connections.
+        self._event_persist_queues = {}
+        self._rooms_persisting = set()
+        self._rooms_waiting_to_persist = deque()
+
     @defer.inlineCallbacks
     def persist_events(self, events_and_contexts, backfilled=False,
                        is_new_state=True):
@@ -103,22 +119,133 @@ class EventsStore(SQLBaseStore):
     @log_function
     def persist_event(self, event, context,
                       is_new_state=True, current_state=None):
+        """Queues the event to be persisted along with any other events
+        waiting to be persisted in the same room.
+
+        All the events queued for a room are persisted in a single
+        transaction, so concurrent sends to a room share a commit rather than
+        each racing to update the room's forward extremities.
+
+        Returns:
+            Deferred: resolves to a (stream_ordering, max_persisted_id) tuple
+            once the event has been persisted.
+        """
+        deferred = defer.Deferred()
+        self._event_persist_queues.setdefault(event.room_id, []).append(
+            _QueuedEvent(event, context, is_new_state, current_state, deferred)
+        )
+        self._maybe_start_persisting(event.room_id)
+
+        with PreserveLoggingContext():
+            yield deferred
+
+        max_persisted_id = yield self._stream_id_gen.get_max_token()
+        defer.returnValue(
+            (event.internal_metadata.stream_ordering, max_persisted_id)
+        )
+
+    def _maybe_start_persisting(self, room_id):
+        """Starts persisting the events queued for the room, unless the room
+        is already being persisted or we're already persisting as many rooms
+        as we have database connections for.
+        """
+        if room_id in self._rooms_persisting:
+            # The events will be picked up once the current batch finishes.
+            return
+
+        if len(self._rooms_persisting) >= self._db_pool.max:
+            if room_id not in self._rooms_waiting_to_persist:
+                self._rooms_waiting_to_persist.append(room_id)
+            return
+
+        self._rooms_persisting.add(room_id)
+        with PreserveLoggingContext():
+            self._persist_queued_events(room_id)
+
+    @defer.inlineCallbacks
+    def _persist_queued_events(self, room_id):
         try:
-            with self._stream_id_gen.get_next() as stream_ordering:
-                event.internal_metadata.stream_ordering = stream_ordering
+            queued = self._event_persist_queues.pop(room_id, None)
+            if queued:
+                yield self._persist_event_batch(queued)
+        finally:
+            self._rooms_persisting.discard(room_id)
+
+            # If more events arrived for the room while we were persisting
+            # then let any rooms that were waiting go first.
+            if room_id in self._event_persist_queues:
+                self._rooms_waiting_to_persist.append(room_id)
+
+            while self._rooms_waiting_to_persist:
+                if len(self._rooms_persisting) >= self._db_pool.max:
+                    break
+                self._maybe_start_persisting(
+                    self._rooms_waiting_to_persist.popleft()
+                )
+
+    @defer.inlineCallbacks
+    def _persist_event_batch(self, queued):
+        """Persists a list of _QueuedEvent in a single transaction, and
+        resolves their deferreds once the transaction has committed.
+        """
+        try:
+            with self._stream_id_gen.get_next_mult(len(queued)) as orderings:
+                for item, stream_ordering in zip(queued, orderings):
+                    item.event.internal_metadata.stream_ordering = stream_ordering
+
                 yield self.runInteraction(
                     "persist_event",
-                    self._persist_event_txn,
-                    event=event,
-                    context=context,
-                    is_new_state=is_new_state,
-                    current_state=current_state,
+                    self._persist_event_batch_txn,
+                    queued,
+                )
+        except Exception:
+            if len(queued) > 1:
+                # Retry the events one by one so that a single bad event
+                # doesn't fail the rest of the batch.
+                logger.exception(
+                    "Failed to persist batch of %d events, retrying individually",
+                    len(queued),
                 )
-        except _RollbackButIsFineException:
-            pass
+                for item in queued:
+                    yield self._persist_event_batch([item])
+            else:
+                failure = Failure()
+                with PreserveLoggingContext():
+                    queued[0].deferred.errback(failure)
+            return
 
-        max_persisted_id = yield self._stream_id_gen.get_max_token()
-        defer.returnValue((stream_ordering, max_persisted_id))
+        for item in queued:
+            with PreserveLoggingContext():
+                item.deferred.callback(None)
+
+    def _persist_event_batch_txn(self, txn, queued):
+        # Events that reset the current state of the room have to be persisted
+        # on their own, but we can persist each run of other events together.
+        batch = []
+        batch_is_new_state = True
+        for item in queued:
+            if batch and (
+                item.current_state or item.is_new_state != batch_is_new_state
+            ):
+                self._persist_events_txn(
+                    txn, batch, backfilled=False, is_new_state=batch_is_new_state,
+                )
+                batch = []
+
+            if item.current_state:
+                self._persist_event_txn(
+                    txn, item.event, item.context,
+                    is_new_state=item.is_new_state,
+                    current_state=item.current_state,
+                )
+            else:
+                batch.append((item.event, item.context))
+                batch_is_new_state = item.is_new_state
+
+        if batch:
+            self._persist_events_txn(
+                txn, batch, backfilled=False, is_new_state=batch_is_new_state,
+            )
 
     @defer.inlineCallbacks
     def get_event(self, event_id, check_redacted=True,
@@ -183,9 +310,6 @@ class EventsStore(SQLBaseStore):
         # key, we *want* to update the `current_state_events` table
         if current_state:
             txn.call_after(self._get_current_state_for_key.invalidate_all)
-            txn.call_after(self.get_rooms_for_user.invalidate_all)
-            txn.call_after(self.get_users_in_room.invalidate, (event.room_id,))
-            txn.call_after(self.get_joined_hosts_for_room.invalidate, (event.room_id,))
             txn.call_after(self.get_room_name_and_aliases, event.room_id)
 
             self._simple_delete_txn(
@@ -206,6 +330,15 @@ class EventsStore(SQLBaseStore):
                     }
                 )
 
+            member_events = [s for s in current_state if s.type == EventTypes.Member]
+            self._reset_membership_index_for_room_txn(
+                txn, event.room_id, member_events,
+                event.internal_metadata.stream_ordering,
+            )
+            self._reset_app_service_room_interest_for_members_txn(
+                txn, event.room_id, member_events,
+            )
+
         return self._persist_events_txn(
             txn,
             [(event, context)],
@@ -236,10 +369,10 @@ class EventsStore(SQLBaseStore):
                     txn, event, context.push_actions
                 )
 
-        if event.type == EventTypes.Redaction and event.redacts is not None:
-            self._remove_push_actions_for_event_id_txn(
-                txn, event.room_id, event.redacts
-            )
+            if event.type == EventTypes.Redaction and event.redacts is not None:
+                self._remove_push_actions_for_event_id_txn(
+                    txn, event.room_id, event.redacts
+                )
 
         for room_id, depth in depth_updates.items():
             self._update_min_depth_for_room_txn(txn, room_id, depth)
@@ -310,6 +443,10 @@ class EventsStore(SQLBaseStore):
 
                 self._update_extremeties(txn, [event])
 
+                # We can't tell if this races with a load of the room's latest
+                # events, as the event already has its stream ordering.
+                txn.call_after(self._recent_events_cache.pop, event.room_id)
+
         events_and_contexts = filter(
             lambda ec: ec[0] not in to_remove,
             events_and_contexts
@@ -318,6 +455,10 @@ class EventsStore(SQLBaseStore):
         if not events_and_contexts:
             return
 
+        self._update_recent_events_cache_txn(
+            txn, [event for event, _ in events_and_contexts], backfilled,
+        )
+
         self._store_mult_state_groups_txn(txn, [
             (event, context)
             for event, context in events_and_contexts
@@ -352,15 +493,20 @@ class EventsStore(SQLBaseStore):
             ]
         )
 
-        def event_dict(event):
-            return {
+        def event_json(event):
+            if "redacted" not in event and "redacted_because" not in event:
+                # Reuse the encoding that was calculated when the event was
+                # checked, if possible.
+                return event.get_json_bytes()
+
+            return encode_json({
                 k: v
                 for k, v in event.get_dict().items()
                 if k not in [
                     "redacted",
                     "redacted_because",
                 ]
-            }
+            })
 
         self._simple_insert_many_txn(
             txn,
@@ -372,7 +518,7 @@ class EventsStore(SQLBaseStore):
                     "internal_metadata": encode_json(
                         event.internal_metadata.get_dict()
                     ).decode("UTF-8"),
-                    "json": encode_json(event_dict(event)).decode("UTF-8"),
+                    "json": event_json(event).decode("UTF-8"),
                 }
                 for event, _ in events_and_contexts
             ],
@@ -398,10 +544,11 @@ class EventsStore(SQLBaseStore):
             ],
         )
 
-        if context.rejected:
-            self._store_rejections_txn(
-                txn, event.event_id, context.rejected
-            )
+        for event, context in events_and_contexts:
+            if context.rejected:
+                self._store_rejections_txn(
+                    txn, event.event_id, context.rejected
+                )
 
         self._simple_insert_many_txn(
             txn,
@@ -463,7 +610,7 @@ class EventsStore(SQLBaseStore):
         )
 
         if is_new_state:
-            for event, _ in state_events_and_contexts:
+            for event, context in state_events_and_contexts:
                 if not context.rejected:
                     txn.call_after(
                         self._get_current_state_for_key.invalidate,
@@ -489,6 +636,12 @@ class EventsStore(SQLBaseStore):
                         }
                     )
 
+                    if event.type == EventTypes.Member:
+                        self._update_membership_index_txn(txn, [event])
+                        self._update_app_service_room_interest_for_members_txn(
+                            txn, event.room_id, [event]
+                        )
+
         return
 
     def _store_redaction(self, txn, event):
@@ -15,10 +15,26 @@
 
 from ._base import SQLBaseStore
 
+from twisted.internet import defer
+
+
+# How often we write out the last access times of remote media, in ms.
+MEDIA_ACCESS_FLUSH_INTERVAL_MS = 60 * 1000
+
 
 class MediaRepositoryStore(SQLBaseStore):
     """Persistence for attachments and avatars"""
 
+    def __init__(self, hs):
+        super(MediaRepositoryStore, self).__init__(hs)
+
+        # Map from (origin, media_id) to the time it was last accessed, for
+        # remote media accessed since we last wrote them to the database.
+        self._remote_media_accesses = {}
+        self._clock.looping_call(
+            self._flush_remote_media_accesses, MEDIA_ACCESS_FLUSH_INTERVAL_MS
+        )
+
     def get_default_thumbnails(self, top_level_type, sub_type):
         return []
 
@@ -83,7 +99,7 @@ class MediaRepositoryStore(SQLBaseStore):
             {"media_origin": origin, "media_id": media_id},
             (
                 "media_type", "media_length", "upload_name", "created_ts",
-                "filesystem_id",
+                "filesystem_id", "cold_ts",
             ),
             allow_none=True,
             desc="get_cached_remote_media",
@@ -102,10 +118,124 @@ class MediaRepositoryStore(SQLBaseStore):
                 "created_ts": time_now_ms,
                 "upload_name": upload_name,
                 "filesystem_id": filesystem_id,
+                "last_access_ts": time_now_ms,
             },
             desc="store_cached_remote_media",
         )
 
+    def mark_remote_media_accessed(self, origin, media_id):
+        """Records that some remote media has been served. The access times
+        are written out in batches rather than on every request.
+        """
+        self._remote_media_accesses[(origin, media_id)] = self._clock.time_msec()
+
+    def _flush_remote_media_accesses(self):
+        if not self._remote_media_accesses:
+            return defer.succeed(None)
+
+        accesses = self._remote_media_accesses
+        self._remote_media_accesses = {}
+
+        def update_cache_txn(txn):
+            txn.executemany(
+                "UPDATE remote_media_cache SET last_access_ts = ?"
+                " WHERE media_origin = ? AND media_id = ?",
+                [
+                    (ts, origin, media_id)
+                    for (origin, media_id), ts in accesses.items()
+                ]
+            )
+
+        return self.runInteraction(
+            "update_cached_last_access_time", update_cache_txn
+        )
+
+    def get_remote_media_cache_size(self):
+        """Gets the total size in bytes of the remote media and thumbnails
+        in the primary media store.
+        """
+        def get_remote_media_cache_size_txn(txn):
+            txn.execute(
+                "SELECT COALESCE(SUM(media_length), 0) FROM remote_media_cache"
+                " WHERE cold_ts IS NULL"
+            )
+            media_size = txn.fetchone()[0]
+
+            txn.execute(
+                "SELECT COALESCE(SUM(t.thumbnail_length), 0)"
+                " FROM remote_media_cache_thumbnails AS t"
+                " INNER JOIN remote_media_cache AS c"
+                " ON c.media_origin = t.media_origin AND c.media_id = t.media_id"
+                " WHERE c.cold_ts IS NULL"
+            )
+            thumbnail_size = txn.fetchone()[0]
+
+            return media_size + thumbnail_size
+
+        return self.runInteraction(
+            "get_remote_media_cache_size", get_remote_media_cache_size_txn
+        )
+
+    def get_least_recently_accessed_remote_media(self, limit):
+        """Gets the least recently accessed remote media in the primary media
+        store.
+
+        Returns:
+            Deferred list of dicts with the media_origin, media_id,
+            filesystem_id, and total size in bytes of the media and its
+            thumbnails.
+        """
+        def get_least_recently_accessed_remote_media_txn(txn):
+            txn.execute(
+                "SELECT c.media_origin, c.media_id, c.filesystem_id,"
+                " COALESCE(c.media_length, 0)"
+                " + COALESCE(SUM(t.thumbnail_length), 0) AS size"
+                " FROM remote_media_cache AS c"
+                " LEFT JOIN remote_media_cache_thumbnails AS t"
+                " ON c.media_origin = t.media_origin AND c.media_id = t.media_id"
+                " WHERE c.cold_ts IS NULL"
+                " GROUP BY c.media_origin, c.media_id, c.filesystem_id,"
+                " c.media_length, c.last_access_ts"
+                " ORDER BY c.last_access_ts ASC"
+                " LIMIT ?",
+                (limit,)
+            )
+            return self.cursor_to_dict(txn)
+
+        return self.runInteraction(
+            "get_least_recently_accessed_remote_media",
+            get_least_recently_accessed_remote_media_txn,
+        )
+
+    def mark_remote_media_cold(self, origin, media_id, time_now_ms):
+        """Records that the remote media has been moved to the secondary media
+        store.
+        """
+        return self._simple_update_one(
+            "remote_media_cache",
+            {"media_origin": origin, "media_id": media_id},
+            {"cold_ts": time_now_ms},
+            desc="mark_remote_media_cold",
+        )
+
+    def delete_remote_media(self, origin, media_id):
+        def delete_remote_media_txn(txn):
+            self._simple_delete_txn(
+                txn,
+                "remote_media_cache",
+                keyvalues={
+                    "media_origin": origin, "media_id": media_id
+                },
+            )
+            self._simple_delete_txn(
+                txn,
+                "remote_media_cache_thumbnails",
+                keyvalues={
+                    "media_origin": origin, "media_id": media_id
+                },
+            )
+        return self.runInteraction("delete_remote_media", delete_remote_media_txn)
+
     def get_remote_media_thumbnails(self, origin, media_id):
         return self._simple_select_list(
             "remote_media_cache_thumbnails",
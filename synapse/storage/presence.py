@@ -15,7 +15,9 @@
 
 from ._base import SQLBaseStore
 from synapse.api.constants import PresenceState
-from synapse.util.caches.descriptors import cached, cachedInlineCallbacks
+from synapse.util.caches.descriptors import (
+    cached, cachedInlineCallbacks, cachedList
+)
 
 from collections import namedtuple
 from twisted.internet import defer
@@ -55,7 +57,38 @@ class UserPresenceState(namedtuple("UserPresenceState",
         )
 
 
+def format_user_presence_state(state, now):
+    """Convert UserPresenceState to a format that can be sent down to clients
+    and to other servers.
+    """
+    content = {
+        "presence": state.state,
+        "user_id": state.user_id,
+    }
+    if state.last_active_ts:
+        content["last_active_ago"] = now - state.last_active_ts
+    if state.status_msg and state.state != PresenceState.OFFLINE:
+        content["status_msg"] = state.status_msg
+    if state.state == PresenceState.ONLINE:
+        content["currently_active"] = state.currently_active
+
+    return content
+
+
+# How far ahead of the stream ids handed out by take_presence_stream_ids we
+# record a high-water mark in the database.
+PRESENCE_STREAM_ID_RESERVATION = 1000
+
+
 class PresenceStore(SQLBaseStore):
+    def __init__(self, hs):
+        super(PresenceStore, self).__init__(hs)
+
+        # The high-water mark we have recorded in presence_stream_max_id, which
+        # _presence_id_gen resumes above after a restart. We always record a
+        # new one the first time we take ids.
+        self._presence_reserved_id = 0
+
     @defer.inlineCallbacks
     def update_presence(self, presence_states):
         stream_ordering_manager = self._presence_id_gen.get_next_mult(
@@ -77,44 +110,110 @@ class PresenceStore(SQLBaseStore):
                 state.user_id, stream_id,
             )
 
-        # Actually insert new rows
-        self._simple_insert_many_txn(
-            txn,
-            table="presence_stream",
-            values=[
-                {
-                    "stream_id": stream_id,
-                    "user_id": state.user_id,
-                    "state": state.state,
-                    "last_active_ts": state.last_active_ts,
-                    "last_federation_update_ts": state.last_federation_update_ts,
-                    "last_user_sync_ts": state.last_user_sync_ts,
-                    "status_msg": state.status_msg,
-                    "currently_active": state.currently_active,
-                }
-                for state in presence_states
-            ],
+        self._persist_presence_txn(txn, stream_orderings, presence_states)
+
+    @defer.inlineCallbacks
+    def take_presence_stream_ids(self, presence_states, update_stream_cache=True):
+        """Assigns stream ids to the given presence updates without persisting
+        them, so that they can be sent to clients straight away and written
+        to the database later with persist_presence.
+
+        Args:
+            presence_states (list): List of UserPresenceState
+            update_stream_cache (bool): Whether to mark the users as changed
+                in the presence stream change cache.
+
+        Returns:
+            Deferred[list]: The stream ids, in the same order as
+            `presence_states`.
+        """
+        stream_ordering_manager = self._presence_id_gen.get_next_mult(
+            len(presence_states)
+        )
+
+        with stream_ordering_manager as stream_orderings:
+            if stream_orderings and stream_orderings[-1] > self._presence_reserved_id:
+                # The ids may be seen by clients before the updates reach the
+                # database, so record a high-water mark above them before the
+                # current token moves past them. Otherwise, after a crash, the
+                # id generator would resume below tokens clients already have.
+                yield self._reserve_presence_stream_ids(
+                    stream_orderings[-1] + PRESENCE_STREAM_ID_RESERVATION
+                )
+
+            if update_stream_cache:
+                for stream_id, state in zip(stream_orderings, presence_states):
+                    self.presence_stream_cache.entity_has_changed(
+                        state.user_id, stream_id,
+                    )
+
+        defer.returnValue(stream_orderings)
+
+    @defer.inlineCallbacks
+    def _reserve_presence_stream_ids(self, reserved_id):
+        def _reserve_presence_stream_ids_txn(txn):
+            txn.execute(
+                "UPDATE presence_stream_max_id SET stream_id = ?"
+                " WHERE stream_id < ?",
+                (reserved_id, reserved_id,)
+            )
+
+        yield self.runInteraction(
+            "reserve_presence_stream_ids", _reserve_presence_stream_ids_txn,
         )
+        self._presence_reserved_id = max(self._presence_reserved_id, reserved_id)
 
-        # Delete old rows to stop database from getting really big
+    def persist_presence(self, stream_orderings, presence_states):
+        """Persists presence updates that were assigned stream ids by
+        take_presence_stream_ids. There must be at most one update per user.
+        """
+        return self.runInteraction(
+            "persist_presence",
+            self._persist_presence_txn, stream_orderings, presence_states,
+        )
+
+    def _persist_presence_txn(self, txn, stream_orderings, presence_states):
+        # Delete old rows to stop database from getting really big. We do this
+        # before inserting so that we don't delete the rows we're about to
+        # insert.
         sql = (
             "DELETE FROM presence_stream WHERE"
             " stream_id < ?"
             " AND user_id IN (%s)"
         )
 
+        max_stream_id = max(stream_orderings)
         batches = (
             presence_states[i:i + 50]
             for i in xrange(0, len(presence_states), 50)
         )
         for states in batches:
-            args = [stream_id]
+            args = [max_stream_id]
             args.extend(s.user_id for s in states)
             txn.execute(
                 sql % (",".join("?" for _ in states),),
                 args
             )
 
+        # Actually insert new rows
+        self._simple_insert_many_txn(
+            txn,
+            table="presence_stream",
+            values=[
+                {
+                    "stream_id": stream_id,
+                    "user_id": state.user_id,
+                    "state": state.state,
+                    "last_active_ts": state.last_active_ts,
+                    "last_federation_update_ts": state.last_federation_update_ts,
+                    "last_user_sync_ts": state.last_user_sync_ts,
+                    "status_msg": state.status_msg,
+                    "currently_active": state.currently_active,
+                }
+                for stream_id, state in zip(stream_orderings, presence_states)
+            ],
+        )
+
     def get_all_presence_updates(self, last_id, current_id):
         def get_all_presence_updates_txn(txn):
             sql = (
@@ -243,6 +342,40 @@ class PresenceStore(SQLBaseStore):
             "@%s:%s" % (u, self.hs.hostname,) for u in user_localparts
         ])
 
+    @cachedList(cache=get_presence_list_observers_accepted.cache,
+                list_name="observed_userids", inlineCallbacks=True)
+    def get_presence_list_observers_accepted_for_users(self, observed_userids):
+        """Bulk version of get_presence_list_observers_accepted.
+
+        Returns:
+            Deferred[dict]: observed user_id -> list of observer user_ids
+        """
+        def f(txn):
+            observed = list(observed_userids)
+            rows = []
+            for start in xrange(0, len(observed), 100):
+                batch = observed[start:start + 100]
+                sql = (
+                    "SELECT observed_user_id, user_id FROM presence_list"
+                    " WHERE accepted = ? AND observed_user_id IN (%s)"
+                ) % (",".join(["?"] * len(batch)),)
+
+                txn.execute(sql, [True] + batch)
+                rows.extend(txn.fetchall())
+            return rows
+
+        rows = yield self.runInteraction(
+            "get_presence_list_observers_accepted_for_users", f
+        )
+
+        results = {user_id: [] for user_id in observed_userids}
+        for observed_user_id, localpart in rows:
+            results[observed_user_id].append(
+                "@%s:%s" % (localpart, self.hs.hostname,)
+            )
+
+        defer.returnValue(results)
+
     @defer.inlineCallbacks
     def del_presence_list(self, observer_localpart, observed_userid):
         yield self._simple_delete_one(
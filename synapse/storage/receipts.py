@@ -14,11 +14,13 @@
 # limitations under the License.
 
 from ._base import SQLBaseStore
-from synapse.util.caches.descriptors import cachedInlineCallbacks, cachedList, cached
+from synapse.util.caches.descriptors import cachedInlineCallbacks, cached
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 
 from twisted.internet import defer
 
+from collections import OrderedDict
 import logging
 import json
 
@@ -26,6 +28,54 @@ import json
 logger = logging.getLogger(__name__)
 
 
+class _RoomReceipts(object):
+    """The latest linearized receipt of each type for each user in a room."""
+
+    __slots__ = ("receipts",)
+
+    def __init__(self):
+        # (receipt_type, user_id) -> (stream_id, event_id, data), ordered by
+        # stream_id
+        self.receipts = OrderedDict()
+
+    def update(self, receipt_type, user_id, event_id, data, stream_id):
+        key = (receipt_type, user_id)
+        current = self.receipts.get(key)
+        if current is not None and current[0] >= stream_id:
+            # We already have a newer receipt (e.g. from the initial load)
+            return
+
+        self.receipts.pop(key, None)
+        self.receipts[key] = (stream_id, event_id, data)
+        self._sort()
+
+    def _sort(self):
+        # Receipts are nearly always applied in stream order, so this is
+        # rarely needed.
+        if len(self.receipts) < 2:
+            return
+
+        it = reversed(self.receipts.values())
+        last = next(it)[0]
+        if next(it)[0] > last:
+            self.receipts = OrderedDict(
+                sorted(self.receipts.items(), key=lambda i: i[1][0])
+            )
+
+    def get_changed(self, from_key, to_key):
+        """Returns the receipts with from_key < stream_id <= to_key, as a list
+        of (receipt_type, user_id, event_id, data).
+        """
+        results = []
+        for key in reversed(self.receipts):
+            stream_id, event_id, data = self.receipts[key]
+            if from_key and stream_id <= from_key:
+                break
+            if stream_id <= to_key:
+                results.append((key[0], key[1], event_id, data))
+        return results
+
+
 class ReceiptsStore(SQLBaseStore):
     def __init__(self, hs):
         super(ReceiptsStore, self).__init__(hs)
@@ -34,6 +84,9 @@ class ReceiptsStore(SQLBaseStore):
             "ReceiptsRoomChangeCache", self._receipts_id_gen.get_max_token()
         )
 
+        # room_id -> _RoomReceipts, kept up to date as receipts are inserted
+        self._receipt_snapshots = LruCache(max_size=5000)
+
     @cached(num_args=2)
     def get_receipts_for_room(self, room_id, receipt_type):
         return self._simple_select_list(
@@ -100,7 +153,7 @@ class ReceiptsStore(SQLBaseStore):
 
         defer.returnValue([ev for res in results.values() for ev in res])
 
-    @cachedInlineCallbacks(num_args=3, max_entries=5000)
+    @defer.inlineCallbacks
     def get_linearized_receipts_for_room(self, room_id, to_key, from_key=None):
         """Get receipts for a single room for sending to clients.
 
@@ -113,112 +166,102 @@ class ReceiptsStore(SQLBaseStore):
         Returns:
             list: A list of receipts.
         """
-        def f(txn):
-            if from_key:
-                sql = (
-                    "SELECT * FROM receipts_linearized WHERE"
-                    " room_id = ? AND stream_id > ? AND stream_id <= ?"
-                )
-
-                txn.execute(
-                    sql,
-                    (room_id, from_key, to_key)
-                )
-            else:
-                sql = (
-                    "SELECT * FROM receipts_linearized WHERE"
-                    " room_id = ? AND stream_id <= ?"
-                )
-
-                txn.execute(
-                    sql,
-                    (room_id, to_key)
-                )
-
-            rows = self.cursor_to_dict(txn)
-
-            return rows
-
-        rows = yield self.runInteraction(
-            "get_linearized_receipts_for_room", f
+        results = yield self._get_linearized_receipts_for_rooms(
+            [room_id], to_key, from_key=from_key
         )
+        defer.returnValue(results[room_id])
 
-        if not rows:
-            defer.returnValue([])
-
-        content = {}
-        for row in rows:
-            content.setdefault(
-                row["event_id"], {}
-            ).setdefault(
-                row["receipt_type"], {}
-            )[row["user_id"]] = json.loads(row["data"])
-
-        defer.returnValue([{
-            "type": "m.receipt",
-            "room_id": room_id,
-            "content": content,
-        }])
-
-    @cachedList(cache=get_linearized_receipts_for_room.cache, list_name="room_ids",
-                num_args=3, inlineCallbacks=True)
+    @defer.inlineCallbacks
     def _get_linearized_receipts_for_rooms(self, room_ids, to_key, from_key=None):
+        """Returns a dict of room_id to a list of receipt events, answered from
+        the per room receipt snapshots. The snapshots of any rooms that aren't
+        cached are loaded from the database first.
+        """
         if not room_ids:
             defer.returnValue({})
 
-        def f(txn):
-            if from_key:
-                sql = (
-                    "SELECT * FROM receipts_linearized WHERE"
-                    " room_id IN (%s) AND stream_id > ? AND stream_id <= ?"
-                ) % (
-                    ",".join(["?"] * len(room_ids))
-                )
-                args = list(room_ids)
-                args.extend([from_key, to_key])
-
-                txn.execute(sql, args)
+        snapshots = {}
+        missing = []
+        for room_id in room_ids:
+            snapshot = self._receipt_snapshots.get(room_id)
+            if snapshot is None:
+                missing.append(room_id)
             else:
-                sql = (
-                    "SELECT * FROM receipts_linearized WHERE"
-                    " room_id IN (%s) AND stream_id <= ?"
-                ) % (
-                    ",".join(["?"] * len(room_ids))
-                )
+                snapshots[room_id] = snapshot
 
-                args = list(room_ids)
-                args.append(to_key)
+        if missing:
+            loaded = yield self._load_receipt_snapshots(missing)
+            snapshots.update(loaded)
 
-                txn.execute(sql, args)
+        results = {}
+        for room_id in room_ids:
+            # The content is of the form:
+            # {"$foo:bar": { "read": { "@user:host": <receipt> }, .. }, .. }
+            content = {}
+            changed = snapshots[room_id].get_changed(from_key, to_key)
+            for receipt_type, user_id, event_id, data in changed:
+                event_entry = content.setdefault(event_id, {})
+                event_entry.setdefault(receipt_type, {})[user_id] = data
+
+            if content:
+                results[room_id] = [{
+                    "type": "m.receipt",
+                    "room_id": room_id,
+                    "content": content,
+                }]
+            else:
+                results[room_id] = []
 
-            return self.cursor_to_dict(txn)
+        defer.returnValue(results)
 
-        txn_results = yield self.runInteraction(
-            "_get_linearized_receipts_for_rooms", f
-        )
+    @defer.inlineCallbacks
+    def _load_receipt_snapshots(self, room_ids):
+        """Loads the current receipts for the given rooms from the database,
+        and caches them unless they changed while being loaded.
 
-        results = {}
-        for row in txn_results:
-            # We want a single event per room, since we want to batch the
-            # receipts by room, event and type.
-            room_event = results.setdefault(row["room_id"], {
-                "type": "m.receipt",
-                "room_id": row["room_id"],
-                "content": {},
-            })
+        Returns:
+            Deferred[dict]: room_id -> _RoomReceipts
+        """
+        current_token = self._receipts_id_gen.get_max_token()
 
-            # The content is of the form:
-            # {"$foo:bar": { "read": { "@user:host": <receipt> }, .. }, .. }
-            event_entry = room_event["content"].setdefault(row["event_id"], {})
-            receipt_type = event_entry.setdefault(row["receipt_type"], {})
+        def f(txn):
+            results = []
+            for start in xrange(0, len(room_ids), 100):
+                batch = room_ids[start:start + 100]
+                sql = (
+                    "SELECT room_id, receipt_type, user_id, event_id, data,"
+                    " stream_id FROM receipts_linearized WHERE room_id IN (%s)"
+                ) % (",".join(["?"] * len(batch)),)
+                txn.execute(sql, batch)
+                results.extend(txn.fetchall())
+            return results
 
-            receipt_type[row["user_id"]] = json.loads(row["data"])
+        rows = yield self.runInteraction("_load_receipt_snapshots", f)
 
-        results = {
-            room_id: [results[room_id]] if room_id in results else []
-            for room_id in room_ids
-        }
-        defer.returnValue(results)
+        rows.sort(key=lambda r: r[5])
+
+        snapshots = {room_id: _RoomReceipts() for room_id in room_ids}
+        for room_id, receipt_type, user_id, event_id, data, stream_id in rows:
+            snapshots[room_id].update(
+                receipt_type, user_id, event_id, json.loads(data), stream_id
+            )
+
+        for room_id, snapshot in snapshots.items():
+            # A receipt may have been persisted after we read the table but
+            # before we got here, in which case it wasn't applied to the
+            # snapshot, so we can't cache it.
+            if not self._receipts_stream_cache.has_entity_changed(
+                room_id, current_token
+            ):
+                self._receipt_snapshots.set(room_id, snapshot)
+
+        defer.returnValue(snapshots)
+
+    def _update_receipt_snapshot(self, room_id, receipt_type, user_id,
+                                 event_id, data, stream_id):
+        snapshot = self._receipt_snapshots.get(room_id)
+        if snapshot is not None:
+            snapshot.update(receipt_type, user_id, event_id, data, stream_id)
 
     def get_max_receipt_stream_id(self):
         return self._receipts_id_gen.get_max_token()
@@ -231,9 +274,6 @@ class ReceiptsStore(SQLBaseStore):
         txn.call_after(
             self.get_receipts_for_user.invalidate, (user_id, receipt_type)
         )
-        # FIXME: This shouldn't invalidate the whole cache
-        txn.call_after(self.get_linearized_receipts_for_room.invalidate_all)
-
         txn.call_after(
             self._receipts_stream_cache.entity_has_changed,
             room_id, stream_id
@@ -294,6 +334,11 @@ class ReceiptsStore(SQLBaseStore):
             }
         )
 
+        txn.call_after(
+            self._update_receipt_snapshot,
+            room_id, receipt_type, user_id, event_id, data, stream_id
+        )
+
         return True
 
     @defer.inlineCallbacks
@@ -366,9 +411,6 @@ class ReceiptsStore(SQLBaseStore):
         txn.call_after(
             self.get_receipts_for_user.invalidate, (user_id, receipt_type)
         )
-        # FIXME: This shouldn't invalidate the whole cache
-        txn.call_after(self.get_linearized_receipts_for_room.invalidate_all)
-
         self._simple_delete_txn(
             txn,
             table="receipts_graph",
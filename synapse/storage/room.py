@@ -47,16 +47,22 @@ class RoomStore(SQLBaseStore):
         Raises:
             StoreError if the room could not be stored.
         """
-        try:
-            yield self._simple_insert(
+        def store_room_txn(txn):
+            self._simple_insert_txn(
+                txn,
                 "rooms",
                 {
                     "room_id": room_id,
                     "creator": room_creator_user_id,
                     "is_public": is_public,
                 },
-                desc="store_room",
             )
+            # FIXME: This assumes this store is linked with
+            # ApplicationServiceStore
+            self._update_app_service_room_interest_for_room_txn(txn, room_id)
+
+        try:
+            yield self.runInteraction("store_room", store_room_txn)
         except Exception as e:
             logger.error("store_room with room_id=%s failed: %s", room_id, e)
             raise StoreError(500, "Problem creating room.")
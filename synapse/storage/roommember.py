@@ -18,15 +18,23 @@ from twisted.internet import defer
 from collections import namedtuple
 
 from ._base import SQLBaseStore
-from synapse.util.caches.descriptors import cached, cachedInlineCallbacks
+from synapse.util.caches.descriptors import (
+    cached, cachedInlineCallbacks
+)
 
 from synapse.api.constants import Membership
-from synapse.types import UserID
+from synapse.util.caches import CACHE_SIZE_FACTOR
+from synapse.util.caches.lrucache import LruCache
+
+import synapse.metrics
 
+import itertools
 import logging
 
 logger = logging.getLogger(__name__)
 
+metrics = synapse.metrics.get_metrics_for(__name__)
+
 
 RoomsForUser = namedtuple(
     "RoomsForUser",
@@ -34,7 +42,207 @@ RoomsForUser = namedtuple(
 )
 
 
+def _get_domain_from_id(user_id):
+    return user_id.split(":", 1)[1]
+
+
+class _MembershipIndex(object):
+    """An in memory index of the joined members of every room, mirroring the
+    member events in `current_state_events`.
+    """
+
+    def __init__(self):
+        # room_id -> set of user_ids
+        self._room_to_users = {}
+        # user_id -> room_id -> RoomsForUser
+        self._user_to_rooms = {}
+        # room_id -> server name -> number of joined users on that server
+        self._room_to_host_counts = {}
+
+    def get_rooms_for_user(self, user_id):
+        return self._user_to_rooms.get(user_id, {}).values()
+
+    def get_users_in_room(self, room_id):
+        return list(self._room_to_users.get(room_id, ()))
+
+    def get_hosts_in_room(self, room_id):
+        return set(self._room_to_host_counts.get(room_id, ()))
+
+    def update(self, room_id, user_id, membership):
+        """Updates the membership of a user in a room.
+
+        Args:
+            room_id (str)
+            user_id (str)
+            membership (RoomsForUser|None): The user's join, or None if the
+                user is no longer joined to the room.
+        """
+        if membership is not None:
+            users = self._room_to_users.setdefault(room_id, set())
+            if user_id not in users:
+                users.add(user_id)
+                host_counts = self._room_to_host_counts.setdefault(room_id, {})
+                host = _get_domain_from_id(user_id)
+                host_counts[host] = host_counts.get(host, 0) + 1
+
+            self._user_to_rooms.setdefault(user_id, {})[room_id] = membership
+            return
+
+        users = self._room_to_users.get(room_id)
+        if users is not None and user_id in users:
+            users.discard(user_id)
+            if not users:
+                del self._room_to_users[room_id]
+
+            host_counts = self._room_to_host_counts[room_id]
+            host = _get_domain_from_id(user_id)
+            host_counts[host] -= 1
+            if not host_counts[host]:
+                del host_counts[host]
+                if not host_counts:
+                    del self._room_to_host_counts[room_id]
+
+        rooms = self._user_to_rooms.get(user_id)
+        if rooms is not None:
+            rooms.pop(room_id, None)
+            if not rooms:
+                del self._user_to_rooms[user_id]
+
+    def reset_room(self, room_id, memberships):
+        """Replaces the joined members of a room.
+
+        Args:
+            room_id (str)
+            memberships (dict): user_id -> RoomsForUser
+        """
+        for user_id in self._room_to_users.get(room_id, set()).copy():
+            self.update(room_id, user_id, None)
+
+        for user_id, membership in memberships.items():
+            self.update(room_id, user_id, membership)
+
+    def num_rooms(self):
+        return len(self._room_to_users)
+
+    def num_users(self):
+        return len(self._user_to_rooms)
+
+    def num_hosts(self):
+        return sum(len(hosts) for hosts in self._room_to_host_counts.itervalues())
+
+    def num_memberships(self):
+        return sum(len(users) for users in self._room_to_users.itervalues())
+
+
 class RoomMemberStore(SQLBaseStore):
+    def __init__(self, hs):
+        super(RoomMemberStore, self).__init__(hs)
+
+        # user_id -> (stream_ordering, room_ids, user_ids), see
+        # get_users_who_share_room_with_user
+        self._users_who_share_room_cache = LruCache(
+            max_size=int(5000 * CACHE_SIZE_FACTOR)
+        )
+
+        metrics.register_callback(
+            "membership_index_rooms", self._membership_index.num_rooms,
+        )
+        metrics.register_callback(
+            "membership_index_users", self._membership_index.num_users,
+        )
+        metrics.register_callback(
+            "membership_index_memberships", self._membership_index.num_memberships,
+        )
+        metrics.register_callback(
+            "membership_index_hosts", self._membership_index.num_hosts,
+        )
+
+    def _load_membership_index(self, db_conn):
+        """Loads the joined members of every room from the database, for use
+        as the in memory membership index.
+        """
+        sql = (
+            "SELECT m.user_id, m.room_id, m.sender, m.membership,"
+            " m.event_id, e.stream_ordering"
+            " FROM current_state_events as c"
+            " INNER JOIN room_memberships as m"
+            " ON m.event_id = c.event_id"
+            " AND m.room_id = c.room_id"
+            " AND m.user_id = c.state_key"
+            " INNER JOIN events as e"
+            " ON e.event_id = c.event_id"
+            " WHERE m.membership = ?"
+        )
+        sql = self.database_engine.convert_param_style(sql)
+
+        txn = db_conn.cursor()
+        txn.execute(sql, (Membership.JOIN,))
+        rows = txn.fetchall()
+        txn.close()
+
+        index = _MembershipIndex()
+        for row in rows:
+            index.update(row[1], row[0], RoomsForUser(*row[1:]))
+
+        return index
+
+    def _update_membership_index_txn(self, txn, events):
+        """Updates the membership index, once the transaction has been
+        committed, with member events that have become part of the current
+        state of their rooms.
+        """
+        for event in events:
+            if event.membership == Membership.JOIN:
+                membership = RoomsForUser(
+                    event.room_id, event.user_id, event.membership,
+                    event.event_id, event.internal_metadata.stream_ordering,
+                )
+            else:
+                membership = None
+
+            txn.call_after(
+                self._membership_index.update,
+                event.room_id, event.state_key, membership,
+            )
+
+    def _reset_membership_index_for_room_txn(self, txn, room_id, events,
+                                             stream_ordering):
+        """Replaces the members of a room in the membership index, once the
+        transaction has been committed, with the given member events, which
+        are the new current state of the room.
+        """
+        joins = [e for e in events if e.membership == Membership.JOIN]
+
+        stream_orderings = {
+            e.event_id: e.internal_metadata.stream_ordering
+            for e in joins
+            if getattr(e.internal_metadata, "stream_ordering", None) is not None
+        }
+        rows = self._simple_select_many_txn(
+            txn,
+            table="events",
+            column="event_id",
+            iterable=[e.event_id for e in joins if e.event_id not in stream_orderings],
+            keyvalues={},
+            retcols=("event_id", "stream_ordering"),
+        )
+        stream_orderings.update({
+            row["event_id"]: row["stream_ordering"] for row in rows
+        })
+
+        txn.call_after(
+            self._membership_index.reset_room, room_id, {
+                e.state_key: RoomsForUser(
+                    e.room_id, e.user_id, e.membership, e.event_id,
+                    stream_orderings.get(e.event_id),
+                )
+                for e in joins
+            }
+        )
+        txn.call_after(
+            self._room_membership_stream_cache.entity_has_changed,
+            room_id, stream_ordering,
+        )
 
     def _store_room_members_txn(self, txn, events):
         """Store a room member in the database.
@@ -55,13 +263,14 @@ class RoomMemberStore(SQLBaseStore):
         )
 
         for event in events:
-            txn.call_after(self.get_rooms_for_user.invalidate, (event.state_key,))
-            txn.call_after(self.get_joined_hosts_for_room.invalidate, (event.room_id,))
-            txn.call_after(self.get_users_in_room.invalidate, (event.room_id,))
             txn.call_after(
                 self._membership_stream_cache.entity_has_changed,
                 event.state_key, event.internal_metadata.stream_ordering
             )
+            txn.call_after(
+                self._room_membership_stream_cache.entity_has_changed,
+                event.room_id, event.internal_metadata.stream_ordering
+            )
 
     def get_room_member(self, user_id, room_id):
         """Retrieve the current state of a room member.
@@ -83,18 +292,62 @@ class RoomMemberStore(SQLBaseStore):
             lambda events: events[0] if events else None
         )
 
-    @cached(max_entries=5000)
     def get_users_in_room(self, room_id):
-        def f(txn):
+        """Returns the users joined to the room, from the membership index.
 
-            rows = self._get_members_rows_txn(
-                txn,
-                room_id=room_id,
-                membership=Membership.JOIN,
-            )
+        Returns:
+            Deferred[list]: list of user_ids
+        """
+        return defer.succeed(self._membership_index.get_users_in_room(room_id))
+
+    def get_users_in_rooms(self, room_ids):
+        """Bulk version of get_users_in_room.
+
+        Returns:
+            Deferred[dict]: room_id -> list of user_ids
+        """
+        return defer.succeed({
+            room_id: self._membership_index.get_users_in_room(room_id)
+            for room_id in room_ids
+        })
+
+    @defer.inlineCallbacks
+    def get_users_who_share_room_with_user(self, user_id):
+        """Returns the set of users who are joined to at least one room that
+        the given user is joined to, including the user themselves if they are
+        joined to any rooms.
+
+        The result is cached per user, and is reused until either the user's
+        rooms or the membership of one of those rooms changes.
 
-            return [r["user_id"] for r in rows]
-        return self.runInteraction("get_users_in_room", f)
+        Returns:
+            Deferred[frozenset]: set of user_ids
+        """
+        # Any membership change after this point will have a higher stream
+        # ordering, and so will cause a new entry to be recalculated.
+        current_stream_ordering = self._stream_id_gen.get_max_token()
+
+        rooms = yield self.get_rooms_for_user(user_id)
+        room_ids = frozenset(r.room_id for r in rooms)
+
+        cached = self._users_who_share_room_cache.get(user_id)
+        if cached is not None:
+            stream_ordering, cached_room_ids, user_ids = cached
+            if cached_room_ids == room_ids:
+                changed = self._room_membership_stream_cache.get_entities_changed(
+                    room_ids, stream_ordering,
+                )
+                if not changed:
+                    defer.returnValue(user_ids)
+
+        users_by_room = yield self.get_users_in_rooms(room_ids)
+        user_ids = frozenset(itertools.chain.from_iterable(users_by_room.values()))
+
+        self._users_who_share_room_cache.set(
+            user_id, (current_stream_ordering, room_ids, user_ids)
+        )
+
+        defer.returnValue(user_ids)
 
     def get_room_members(self, room_id, membership=None):
         """Retrieve the current room member list for a room.
@@ -187,26 +440,26 @@ class RoomMemberStore(SQLBaseStore):
             RoomsForUser(**r) for r in self.cursor_to_dict(txn)
         ]
 
-    @cached(max_entries=5000)
     def get_joined_hosts_for_room(self, room_id):
-        return self.runInteraction(
-            "get_joined_hosts_for_room",
-            self._get_joined_hosts_for_room_txn,
-            room_id,
-        )
+        """Returns the servers with users joined to the room, from the
+        membership index. This is proportional to the number of servers in
+        the room rather than the number of users.
 
-    def _get_joined_hosts_for_room_txn(self, txn, room_id):
-        rows = self._get_members_rows_txn(
-            txn,
-            room_id, membership=Membership.JOIN
-        )
+        Returns:
+            Deferred[set]: set of server names
+        """
+        return defer.succeed(self._membership_index.get_hosts_in_room(room_id))
 
-        joined_domains = set(
-            UserID.from_string(r["user_id"]).domain
-            for r in rows
-        )
+    def get_joined_hosts_for_rooms(self, room_ids):
+        """Bulk version of get_joined_hosts_for_room.
 
-        return joined_domains
+        Returns:
+            Deferred[dict]: room_id -> set of server names
+        """
+        return defer.succeed({
+            room_id: self._membership_index.get_hosts_in_room(room_id)
+            for room_id in room_ids
+        })
 
     def _get_members_events_txn(self, txn, room_id, membership=None, user_id=None):
         rows = self._get_members_rows_txn(
@@ -243,11 +496,24 @@ class RoomMemberStore(SQLBaseStore):
 
         return rows
 
-    @cached(max_entries=5000)
     def get_rooms_for_user(self, user_id):
-        return self.get_rooms_for_user_where_membership_is(
-            user_id, membership_list=[Membership.JOIN],
-        )
+        """Returns the rooms the user is joined to, from the membership index.
+
+        Returns:
+            Deferred[list]: list of RoomsForUser
+        """
+        return defer.succeed(self._membership_index.get_rooms_for_user(user_id))
+
+    def get_rooms_for_users(self, user_ids):
+        """Bulk version of get_rooms_for_user.
+
+        Returns:
+            Deferred[dict]: user_id -> list of RoomsForUser
+        """
+        return defer.succeed({
+            user_id: self._membership_index.get_rooms_for_user(user_id)
+            for user_id in user_ids
+        })
 
     @defer.inlineCallbacks
     def forget(self, user_id, room_id):
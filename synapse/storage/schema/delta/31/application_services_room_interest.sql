@@ -0,0 +1,44 @@
+/* Copyright 2016 OpenMarket Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* The rooms each application service is interested in, so that working out
+ * which rooms to send to an application service doesn't need to scan every
+ * room, alias and user. `interest` is the room ID, room alias or local user ID
+ * that matched one of the service's namespaces; rooms matched through a user
+ * also record the join event.
+ */
+CREATE TABLE IF NOT EXISTS application_services_room_interest(
+    as_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    interest TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    membership_event_id TEXT,
+    stream_ordering BIGINT
+);
+
+CREATE INDEX application_services_room_interest_as_id
+    ON application_services_room_interest(as_id, room_id);
+
+CREATE INDEX application_services_room_interest_room_id
+    ON application_services_room_interest(room_id, interest);
+
+/* The namespaces that were used to build the rows above, so that the rows can
+ * be rebuilt if an application service's registration changes.
+ */
+CREATE TABLE IF NOT EXISTS application_services_room_interest_state(
+    as_id TEXT NOT NULL,
+    namespaces TEXT NOT NULL,
+    UNIQUE (as_id)
+);
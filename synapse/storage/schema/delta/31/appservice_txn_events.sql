@@ -0,0 +1,26 @@
+/* Copyright 2016 OpenMarket Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* The events in each unsent application service transaction. The events
+ * themselves are read from the events table when the transaction is retried.
+ */
+CREATE TABLE IF NOT EXISTS application_services_txn_events(
+    as_id TEXT NOT NULL,
+    txn_id INTEGER NOT NULL,
+    event_id TEXT NOT NULL
+);
+
+CREATE INDEX application_services_txn_events_id
+    ON application_services_txn_events(as_id, txn_id);
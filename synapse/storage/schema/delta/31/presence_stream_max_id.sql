@@ -0,0 +1,28 @@
+/* Copyright 2016 OpenMarket Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* A high-water mark for presence stream ids. Presence updates are sent to
+ * clients before they are written to presence_stream, so the stream id
+ * generator resumes from here after a restart rather than reusing ids that
+ * clients may have already seen.
+ */
+CREATE TABLE IF NOT EXISTS presence_stream_max_id(
+    Lock CHAR(1) NOT NULL DEFAULT 'X' UNIQUE,  -- Makes sure this table only has one row.
+    stream_id  BIGINT NOT NULL,
+    CHECK (Lock='X')
+);
+
+INSERT INTO presence_stream_max_id (stream_id)
+    SELECT COALESCE(MAX(stream_id), 0) FROM presence_stream;
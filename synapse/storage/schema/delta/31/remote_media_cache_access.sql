@@ -0,0 +1,29 @@
+/* Copyright 2016 OpenMarket Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* When the remote media was last downloaded or served, used to evict the
+ * least recently used media when the cache gets too big.
+ */
+ALTER TABLE remote_media_cache ADD COLUMN last_access_ts BIGINT;
+
+/* When the media was moved to the secondary media store, or NULL if it is
+ * still in the primary one.
+ */
+ALTER TABLE remote_media_cache ADD COLUMN cold_ts BIGINT;
+
+UPDATE remote_media_cache SET last_access_ts = created_ts;
+
+CREATE INDEX remote_media_cache_last_access_ts
+    ON remote_media_cache(last_access_ts);
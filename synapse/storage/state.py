@@ -70,7 +70,7 @@ class StateStore(SQLBaseStore):
     def _store_mult_state_groups_txn(self, txn, events_and_contexts):
         state_groups = {}
         for event, context in events_and_contexts:
-            if context.current_state is None:
+            if context.current_state is None and context.state_group is None:
                 continue
 
             if context.state_group is not None:
@@ -118,7 +118,7 @@ class StateStore(SQLBaseStore):
                     "event_id": event.event_id,
                 }
                 for event, context in events_and_contexts
-                if context.current_state is not None
+                if event.event_id in state_groups
             ],
         )
 
@@ -214,6 +214,31 @@ class StateStore(SQLBaseStore):
                 f, chunk
             )
 
+    def get_state_group_for_events(self, event_ids):
+        """Get the state group of each of the given events.
+
+        Returns:
+            Deferred[dict]: event_id -> state_group, for the events that have
+            a state group.
+        """
+        return self._get_state_group_for_events(event_ids)
+
+    @defer.inlineCallbacks
+    def get_state_for_group(self, group, types=None):
+        """Get the state of a state group.
+
+        Args:
+            group: The state group.
+            types (list): List of (type, state_key) tuples used to filter the
+                state fetched, where a `state_key` of None matches any
+                `state_key`. If None, all of the state is fetched.
+
+        Returns:
+            Deferred[dict]: (type, state_key) -> state event
+        """
+        group_to_state = yield self._get_state_for_groups([group], types)
+        defer.returnValue(group_to_state[group])
+
     @defer.inlineCallbacks
     def get_state_for_events(self, event_ids, types):
         """Given a list of event_ids and type tuples, return a list of state
@@ -36,11 +36,12 @@ what sort order was used:
 from twisted.internet import defer
 
 from ._base import SQLBaseStore
-from synapse.util.caches.descriptors import cached
+from synapse.storage.engines import PostgresEngine
+from synapse.util.caches.lrucache import LruCache
 from synapse.api.constants import EventTypes
 from synapse.types import RoomStreamToken
-from synapse.util.logcontext import preserve_fn
 
+import bisect
 import logging
 
 
@@ -76,7 +77,77 @@ def upper_bound(token):
         )
 
 
+class _RecentRoomEvents(object):
+    """The latest non-outlier events in a room, i.e. the rows of `events` with
+    the largest (topological_ordering, stream_ordering), kept in ascending
+    order.
+
+    Since these are the top rows of the room, the top N rows of any stream
+    range of the room can be served from here as long as we have at least N
+    rows in that range, or we hold every event in the room (`complete`).
+    """
+
+    __slots__ = ("keys", "rows", "complete",)
+
+    def __init__(self, rows, complete):
+        self.rows = rows
+        self.keys = [_recent_event_key(row) for row in rows]
+        self.complete = complete
+
+    def add(self, row, max_size):
+        key = _recent_event_key(row)
+        if not self.complete and (not self.keys or key < self.keys[0]):
+            # There are older events in the room that we don't have, so we
+            # don't know where this one fits.
+            return
+
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return
+
+        self.keys.insert(i, key)
+        self.rows.insert(i, row)
+
+        if len(self.rows) > max_size:
+            del self.keys[0]
+            del self.rows[0]
+            self.complete = False
+
+    def get(self, limit, end_stream, from_stream=None):
+        """Returns the last `limit` rows with a stream ordering in the range
+        (from_stream, end_stream], latest first, or None if we can't tell.
+        """
+        rows = []
+        for row in reversed(self.rows):
+            if len(rows) >= limit:
+                return rows
+            stream = row["stream_ordering"]
+            if stream > end_stream:
+                continue
+            if from_stream is not None and stream <= from_stream:
+                continue
+            rows.append(row)
+
+        if len(rows) >= limit or self.complete:
+            return rows
+        return None
+
+
+def _recent_event_key(row):
+    return row["topological_ordering"], row["stream_ordering"]
+
+
 class StreamStore(SQLBaseStore):
+    def __init__(self, hs):
+        super(StreamStore, self).__init__(hs)
+
+        # room_id -> _RecentRoomEvents, used to serve the timelines of sync
+        # and initialSync without hitting the database.
+        self._recent_events_per_room = hs.config.recent_events_per_room
+        self._recent_events_cache = LruCache(
+            max_size=hs.config.recent_events_cache_size
+        )
+
     @defer.inlineCallbacks
     def get_appservice_room_stream(self, service, from_key, to_key, limit=0):
         # NB this lives here instead of appservice.py so we can reuse the
@@ -117,11 +188,11 @@ class StreamStore(SQLBaseStore):
             #    room_alias regex
             #  - We want ALL events for rooms that AS users have joined.
             # This is currently supported via get_app_service_rooms (which is
-            # used for the Notifier listener rooms). We can't reasonably make a
-            # SQL query for these room IDs, so we'll pull all the events between
-            # from/to and filter in python.
+            # used for the Notifier listener rooms), which reads the rooms from
+            # the application_services_room_interest table. We pull all the
+            # events between from/to and filter in python.
             rooms_for_as = self._get_app_service_rooms_txn(txn, service)
-            room_ids_for_as = [r.room_id for r in rooms_for_as]
+            room_ids_for_as = set(r.room_id for r in rooms_for_as)
 
             def app_service_interested(row):
                 if row["room_id"] in room_ids_for_as:
@@ -159,6 +230,16 @@ class StreamStore(SQLBaseStore):
     @defer.inlineCallbacks
     def get_room_events_stream_for_rooms(self, room_ids, from_key, to_key, limit=0,
                                          order='DESC'):
+        """Get the new events in each of the given rooms, as per
+        `get_room_events_stream_for_room`.
+
+        The events for all the rooms are fetched with a single query where the
+        database supports it, and then loaded in one batch.
+
+        Returns:
+            Deferred[dict]: room_id -> (events, key), for each of the rooms that
+            have changed since `from_key`.
+        """
         from_id = RoomStreamToken.parse_stream_token(from_key).stream
 
         room_ids = yield self._events_stream_cache.get_entities_changed(
@@ -168,19 +249,95 @@ class StreamStore(SQLBaseStore):
         if not room_ids:
             defer.returnValue({})
 
+        if from_key == to_key:
+            defer.returnValue({room_id: ([], from_key) for room_id in room_ids})
+
+        to_id = RoomStreamToken.parse_stream_token(to_key).stream
+
+        room_to_rows = yield self.runInteraction(
+            "get_room_events_stream_for_rooms",
+            self._get_room_events_stream_for_rooms_txn,
+            list(room_ids), from_id, to_id, limit, order,
+        )
+
+        events = yield self._get_events(
+            [r["event_id"] for rows in room_to_rows.values() for r in rows],
+            get_prev_content=True
+        )
+        event_map = {e.event_id: e for e in events}
+
         results = {}
-        room_ids = list(room_ids)
-        for rm_ids in (room_ids[i:i + 20] for i in xrange(0, len(room_ids), 20)):
-            res = yield defer.gatherResults([
-                preserve_fn(self.get_room_events_stream_for_room)(
-                    room_id, from_key, to_key, limit, order=order,
-                )
-                for room_id in rm_ids
-            ])
-            results.update(dict(zip(rm_ids, res)))
+        for room_id in room_ids:
+            rows = [
+                r for r in room_to_rows.get(room_id, [])
+                if r["event_id"] in event_map
+            ]
+            ret = [event_map[r["event_id"]] for r in rows]
+
+            self._set_before_and_after(ret, rows, topo_order=False)
+
+            if order.lower() == "desc":
+                ret.reverse()
+
+            if rows:
+                key = "s%d" % min(r["stream_ordering"] for r in rows)
+            else:
+                # Assume we didn't get anything because there was nothing to
+                # get.
+                key = from_key
+
+            results[room_id] = (ret, key)
 
         defer.returnValue(results)
 
+    def _get_room_events_stream_for_rooms_txn(self, txn, room_ids, from_id,
+                                              to_id, limit, order):
+        """Returns a dict of room_id -> list of rows, with up to `limit` events
+        per room between the two stream orderings, in stream order.
+        """
+        if isinstance(self.database_engine, PostgresEngine):
+            # Pick the first `limit` events of each room in one go.
+            sql = (
+                "SELECT event_id, room_id, stream_ordering FROM ("
+                " SELECT event_id, room_id, stream_ordering,"
+                " ROW_NUMBER() OVER ("
+                " PARTITION BY room_id ORDER BY stream_ordering %(order)s"
+                " ) AS rn"
+                " FROM events WHERE"
+                " room_id IN (%(room_ids)s)"
+                " AND not outlier"
+                " AND stream_ordering > ? AND stream_ordering <= ?"
+                " ) AS e"
+                " WHERE rn <= ?"
+                " ORDER BY stream_ordering %(order)s"
+            ) % {
+                "order": order,
+                "room_ids": ",".join(["?"] * len(room_ids)),
+            }
+            txn.execute(sql, room_ids + [from_id, to_id, limit])
+            rows = self.cursor_to_dict(txn)
+        else:
+            # SQLite doesn't reliably support window functions, so we do a
+            # query per room, but still within the one transaction.
+            sql = (
+                "SELECT event_id, room_id, stream_ordering FROM events WHERE"
+                " room_id = ?"
+                " AND not outlier"
+                " AND stream_ordering > ? AND stream_ordering <= ?"
+                " ORDER BY stream_ordering %s LIMIT ?"
+            ) % (order,)
+
+            rows = []
+            for room_id in room_ids:
+                txn.execute(sql, (room_id, from_id, to_id, limit))
+                rows.extend(self.cursor_to_dict(txn))
+
+        room_to_rows = {}
+        for row in rows:
+            room_to_rows.setdefault(row["room_id"], []).append(row)
+
+        return room_to_rows
+
     @defer.inlineCallbacks
     def get_room_events_stream_for_room(self, room_id, from_key, to_key, limit=0,
                                         order='DESC'):
@@ -482,11 +639,66 @@ class StreamStore(SQLBaseStore):
 
         defer.returnValue((events, token))
 
-    @cached(num_args=4)
+    @defer.inlineCallbacks
     def get_recent_event_ids_for_room(self, room_id, limit, end_token, from_token=None):
         end_token = RoomStreamToken.parse_stream_token(end_token)
+        if from_token is not None:
+            from_token = RoomStreamToken.parse_stream_token(from_token)
+            from_stream = from_token.stream
+        else:
+            from_stream = None
+
+        rows = None
+        recent = self._recent_events_cache.get(room_id)
+        if recent is None:
+            # Any events persisted in the room after this point will have a
+            # higher stream ordering, and so stop us caching a stale result.
+            current_stream_ordering = self._stream_id_gen.get_max_token()
+
+            recent, rows = yield self.runInteraction(
+                "get_recent_events_for_room",
+                self._load_recent_events_for_room_txn,
+                room_id, limit, end_token.stream, from_stream,
+            )
+
+            changed = self._events_stream_cache.has_entity_changed(
+                room_id, current_stream_ordering,
+            )
+            if not changed:
+                self._recent_events_cache.set(room_id, recent)
+        else:
+            rows = recent.get(limit, end_token.stream, from_stream)
+            if rows is None:
+                rows = yield self.runInteraction(
+                    "get_recent_events_for_room",
+                    self._get_recent_events_for_room_txn,
+                    room_id, limit, end_token.stream, from_stream,
+                )
+
+        rows = list(reversed(rows))  # As we selected with reverse ordering
 
-        if from_token is None:
+        if rows:
+            # Tokens are positions between events.
+            # This token points *after* the last event in the chunk.
+            # We need it to point to the event before it in the chunk
+            # since we are going backwards so we subtract one from the
+            # stream part.
+            topo = rows[0]["topological_ordering"]
+            toke = rows[0]["stream_ordering"] - 1
+            start_token = str(RoomStreamToken(topo, toke))
+
+            token = (start_token, str(end_token))
+        else:
+            token = (str(end_token), str(end_token))
+
+        defer.returnValue((rows, token))
+
+    def _get_recent_events_for_room_txn(self, txn, room_id, limit, end_stream,
+                                        from_stream=None):
+        """Returns the last `limit` non-outlier events in the room with a
+        stream ordering in the range (from_stream, end_stream], latest first.
+        """
+        if from_stream is None:
             sql = (
                 "SELECT stream_ordering, topological_ordering, event_id"
                 " FROM events"
@@ -494,8 +706,8 @@ class StreamStore(SQLBaseStore):
                 " ORDER BY topological_ordering DESC, stream_ordering DESC"
                 " LIMIT ?"
             )
+            txn.execute(sql, (room_id, end_stream, False, limit,))
         else:
-            from_token = RoomStreamToken.parse_stream_token(from_token)
             sql = (
                 "SELECT stream_ordering, topological_ordering, event_id"
                 " FROM events"
@@ -504,38 +716,70 @@ class StreamStore(SQLBaseStore):
                 " ORDER BY topological_ordering DESC, stream_ordering DESC"
                 " LIMIT ?"
             )
+            txn.execute(sql, (room_id, from_stream, end_stream, False, limit))
 
-        def get_recent_events_for_room_txn(txn):
-            if from_token is None:
-                txn.execute(sql, (room_id, end_token.stream, False, limit,))
-            else:
-                txn.execute(sql, (
-                    room_id, from_token.stream, end_token.stream, False, limit
-                ))
+        return self.cursor_to_dict(txn)
 
-            rows = self.cursor_to_dict(txn)
+    def _load_recent_events_for_room_txn(self, txn, room_id, limit, end_stream,
+                                         from_stream=None):
+        """Loads the latest events of the room to cache, and uses them to
+        answer the given query if possible.
 
-            rows.reverse()  # As we selected with reverse ordering
+        Returns:
+            tuple(_RecentRoomEvents, list): The loaded events and the rows
+            matching the query, as returned by _get_recent_events_for_room_txn
+        """
+        max_size = self._recent_events_per_room
+        sql = (
+            "SELECT stream_ordering, topological_ordering, event_id"
+            " FROM events"
+            " WHERE room_id = ? AND outlier = ?"
+            " ORDER BY topological_ordering DESC, stream_ordering DESC"
+            " LIMIT ?"
+        )
+        txn.execute(sql, (room_id, False, max_size + 1,))
+        rows = self.cursor_to_dict(txn)
+        complete = len(rows) <= max_size
+        rows = rows[:max_size]
+        rows.reverse()
+
+        recent = _RecentRoomEvents(rows, complete)
+        result = recent.get(limit, end_stream, from_stream)
+        if result is None:
+            result = self._get_recent_events_for_room_txn(
+                txn, room_id, limit, end_stream, from_stream,
+            )
+        return recent, result
 
-            if rows:
-                # Tokens are positions between events.
-                # This token points *after* the last event in the chunk.
-                # We need it to point to the event before it in the chunk
-                # since we are going backwards so we subtract one from the
-                # stream part.
-                topo = rows[0]["topological_ordering"]
-                toke = rows[0]["stream_ordering"] - 1
-                start_token = str(RoomStreamToken(topo, toke))
-
-                token = (start_token, str(end_token))
+    def _update_recent_events_cache_txn(self, txn, events, backfilled):
+        """Adds newly persisted non-outlier events to the rooms' cached latest
+        events once the transaction has committed.
+        """
+        rooms = {}
+        for event in events:
+            if event.internal_metadata.is_outlier():
+                continue
+            rooms.setdefault(event.room_id, []).append({
+                "stream_ordering": event.internal_metadata.stream_ordering,
+                "topological_ordering": event.depth,
+                "event_id": event.event_id,
+            })
+
+        for room_id, rows in rooms.items():
+            if backfilled:
+                # Backfilled events don't advance the stream cache, so we
+                # can't tell if they race with a load of the room.
+                txn.call_after(self._recent_events_cache.pop, room_id)
             else:
-                token = (str(end_token), str(end_token))
+                txn.call_after(self._add_to_recent_events_cache, room_id, rows)
 
-            return rows, token
+    def _add_to_recent_events_cache(self, room_id, rows):
+        recent = self._recent_events_cache.get(room_id)
+        if recent is None:
+            return
 
-        return self.runInteraction(
-            "get_recent_events_for_room", get_recent_events_for_room_txn
-        )
+        for row in rows:
+            recent.add(row, self._recent_events_per_room)
 
     @defer.inlineCallbacks
     def get_room_events_max_id(self, direction='f'):
@@ -14,6 +14,7 @@
 
 from twisted.internet import defer
 
+import thread
 import threading
 import logging
 
@@ -53,6 +54,11 @@ class LoggingContext(object):
 
     thread_local = threading.local()
 
+    # If not None, a map from thread ident to the context currently active in
+    # that thread. This is only maintained while something, e.g. the
+    # sampling profiler, needs to look at the contexts of other threads.
+    contexts_by_thread = None
+
     class Sentinel(object):
         """Sentinel to represent the root context"""
 
@@ -111,6 +117,8 @@ class LoggingContext(object):
         if current is not context:
             current.stop()
             cls.thread_local.current_context = context
+            if cls.contexts_by_thread is not None:
+                cls.contexts_by_thread[thread.get_ident()] = context
             context.start()
         return current
 
@@ -16,6 +16,7 @@
 from twisted.internet import defer
 
 from synapse.api.errors import LimitExceededError
+from synapse.api.ratelimiting import Ratelimiter
 
 from synapse.util.async import sleep
 from synapse.util.logcontext import preserve_fn
@@ -54,8 +55,14 @@ class FederationRateLimiter(object):
         self.reject_limit = reject_limit
         self.concurrent_requests = concurrent_requests
 
+        # host -> _PerHostRatelimiter, for hosts with requests in flight
         self.ratelimiters = {}
 
+        # Requests are delayed once the host has used up its burst of
+        # `sleep_limit` requests, which is refilled over `window_size`.
+        self._request_counts = Ratelimiter()
+        self._request_rate_hz = sleep_limit * 1000. / window_size
+
     def ratelimit(self, host):
         """Used to ratelimit an incoming request from given host
 
@@ -71,9 +78,11 @@ class FederationRateLimiter(object):
         Returns:
             _PerHostRatelimiter
         """
-        return self.ratelimiters.setdefault(
-            host,
-            _PerHostRatelimiter(
+        ratelimiter = self.ratelimiters.get(host)
+        if ratelimiter is None:
+            ratelimiter = _PerHostRatelimiter(
+                ratelimiter=self,
+                host=host,
                 clock=self.clock,
                 window_size=self.window_size,
                 sleep_limit=self.sleep_limit,
@@ -81,12 +90,30 @@ class FederationRateLimiter(object):
                 reject_limit=self.reject_limit,
                 concurrent_requests=self.concurrent_requests,
             )
-        ).ratelimit()
+            self.ratelimiters[host] = ratelimiter
+        return ratelimiter.ratelimit()
+
+    def should_sleep(self, host):
+        """Records a request from the host, and returns whether it has sent
+        too many recently and so should be delayed.
+        """
+        allowed, _ = self._request_counts.can_do_action(
+            host, self.clock.time(), self._request_rate_hz, self.sleep_limit,
+        )
+        return not allowed
+
+    def on_host_idle(self, host):
+        """Called when the host has no requests in flight, so that we stop
+        tracking it.
+        """
+        self.ratelimiters.pop(host, None)
 
 
 class _PerHostRatelimiter(object):
-    def __init__(self, clock, window_size, sleep_limit, sleep_msec,
-                 reject_limit, concurrent_requests):
+    def __init__(self, ratelimiter, host, clock, window_size, sleep_limit,
+                 sleep_msec, reject_limit, concurrent_requests):
+        self.ratelimiter = ratelimiter
+        self.host = host
         self.clock = clock
 
         self.window_size = window_size
@@ -98,20 +125,12 @@ class _PerHostRatelimiter(object):
         self.sleeping_requests = set()
         self.ready_request_queue = collections.OrderedDict()
         self.current_processing = set()
-        self.request_times = []
 
     def is_empty(self):
-        time_now = self.clock.time_msec()
-        self.request_times[:] = [
-            r for r in self.request_times
-            if time_now - r < self.window_size
-        ]
-
         return not (
             self.ready_request_queue
             or self.sleeping_requests
             or self.current_processing
-            or self.request_times
         )
 
     @contextlib.contextmanager
@@ -129,12 +148,6 @@ class _PerHostRatelimiter(object):
             self._on_exit(request_id)
 
     def _on_enter(self, request_id):
-        time_now = self.clock.time_msec()
-        self.request_times[:] = [
-            r for r in self.request_times
-            if time_now - r < self.window_size
-        ]
-
         queue_size = len(self.ready_request_queue) + len(self.sleeping_requests)
         if queue_size > self.reject_limit:
             raise LimitExceededError(
@@ -143,8 +156,6 @@ class _PerHostRatelimiter(object):
                 ),
             )
 
-        self.request_times.append(time_now)
-
         def queue_request():
             if len(self.current_processing) > self.concurrent_requests:
                 logger.debug("Ratelimit [%s]: Queue req", id(request_id))
@@ -154,12 +165,7 @@ class _PerHostRatelimiter(object):
             else:
                 return defer.succeed(None)
 
-        logger.debug(
-            "Ratelimit [%s]: len(self.request_times)=%d",
-            id(request_id), len(self.request_times),
-        )
-
-        if len(self.request_times) > self.sleep_limit:
+        if self.ratelimiter.should_sleep(self.host):
             logger.debug(
                 "Ratelimit [%s]: sleeping req",
                 id(request_id),
@@ -215,3 +221,6 @@ class _PerHostRatelimiter(object):
             deferred.callback(None)
         except KeyError:
             pass
+
+        if self.is_empty():
+            self.ratelimiter.on_host_idle(self.host)
@@ -293,3 +293,35 @@ class AuthTestCase(unittest.TestCase):
         #     yield self.auth.get_user_from_macaroon(macaroon.serialize())
         # self.assertEqual(401, cm.exception.code)
         # self.assertIn("Invalid macaroon", cm.exception.msg)
+
+    @defer.inlineCallbacks
+    def test_get_user_from_macaroon_cached(self):
+        self.store.get_user_by_access_token = Mock(
+            return_value={"name": "@baldrick:matrix.org", "token_id": 7}
+        )
+
+        user_id = "@baldrick:matrix.org"
+        macaroon = pymacaroons.Macaroon(
+            location=self.hs.config.server_name,
+            identifier="key",
+            key=self.hs.config.macaroon_secret_key)
+        macaroon.add_first_party_caveat("gen = 1")
+        macaroon.add_first_party_caveat("type = access")
+        macaroon.add_first_party_caveat("user_id = %s" % (user_id,))
+        serialized = macaroon.serialize()
+
+        validate_macaroon = self.auth.validate_macaroon
+        self.auth.validate_macaroon = Mock(side_effect=validate_macaroon)
+
+        for _ in range(2):
+            user_info = yield self.auth.get_user_by_access_token(serialized)
+            self.assertEqual(UserID.from_string(user_id), user_info["user"])
+            self.assertEqual(7, user_info["token_id"])
+
+        self.assertEqual(1, self.auth.validate_macaroon.call_count)
+
+        # Once the token has been deleted it is no longer accepted
+        self.store.get_user_by_access_token = Mock(return_value=None)
+        with self.assertRaises(AuthError) as cm:
+            yield self.auth.get_user_by_access_token(serialized)
+        self.assertEqual(401, cm.exception.code)
@@ -456,6 +456,38 @@ class FilteringTestCase(unittest.TestCase):
         results = user_filter.filter_room_state(events)
         self.assertEquals([], results)
 
+    def test_filter_mixed_types(self):
+        definition = {
+            "types": ["m.room.*", "org.matrix.foo.bar", "org.matrix.foo.*"],
+            "not_types": ["m.room.member"],
+        }
+        events = [
+            MockEvent(sender="@foo:bar", type=event_type, room_id="!foo:bar")
+            for event_type in (
+                "m.room.message",  # matches the "m.room.*" prefix
+                "m.room.member",  # excluded by not_types
+                "org.matrix.foo.bar",  # matches literally
+                "org.matrix.foo.baz",  # matches the "org.matrix.foo.*" prefix
+                "org.matrix.foobar",  # matches nothing
+                "m.presence",  # matches nothing
+            )
+        ]
+
+        results = Filter(definition).filter(events)
+
+        self.assertEquals(
+            ["m.room.message", "org.matrix.foo.bar", "org.matrix.foo.baz"],
+            [event.type for event in results],
+        )
+
+    def test_filter_empty_definition(self):
+        events = [
+            MockEvent(sender="@foo:bar", type="m.room.message", room_id="!foo:bar"),
+            {"type": "m.presence", "content": {"user_id": "@foo:bar"}},
+        ]
+
+        self.assertEquals(events, Filter({}).filter(events))
+
     def test_filter_rooms(self):
         definition = {
             "rooms": ["!allowed:example.com", "!excluded:example.com"],
@@ -518,3 +550,30 @@ class FilteringTestCase(unittest.TestCase):
         self.assertEquals(filter.get_filter_json(), user_filter_json)
 
         self.assertRegexpMatches(repr(filter), r"<FilterCollection \{.*\}>")
+
+    @defer.inlineCallbacks
+    def test_get_filter_cached(self):
+        user_filter_json = {
+            "room": {
+                "timeline": {
+                    "limit": 5,
+                }
+            }
+        }
+
+        filter_id = yield self.datastore.add_user_filter(
+            user_localpart=user_localpart + "3",
+            user_filter=user_filter_json,
+        )
+
+        first = yield self.filtering.get_user_filter(
+            user_localpart=user_localpart + "3",
+            filter_id=filter_id,
+        )
+        second = yield self.filtering.get_user_filter(
+            user_localpart=user_localpart + "3",
+            filter_id=filter_id,
+        )
+
+        self.assertIs(first, second)
+        self.assertEquals(5, second.timeline_limit())
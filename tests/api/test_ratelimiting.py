@@ -38,3 +38,44 @@ class TestRatelimiter(unittest.TestCase):
         )
 
         self.assertNotIn("test_id_1", limiter.message_counts)
+
+    def test_pruning_out_of_order(self):
+        limiter = Ratelimiter()
+        # test_id_1 has sent enough messages that it won't expire for a while
+        for _ in range(5):
+            limiter.send_message(
+                user_id="test_id_1", time_now_s=0, msg_rate_hz=0.1, burst_count=5,
+            )
+        limiter.send_message(
+            user_id="test_id_2", time_now_s=1, msg_rate_hz=0.1, burst_count=5,
+        )
+
+        allowed, time_allowed = limiter.send_message(
+            user_id="test_id_3", time_now_s=20, msg_rate_hz=0.1, burst_count=5,
+        )
+
+        self.assertIn("test_id_1", limiter.message_counts)
+        self.assertNotIn("test_id_2", limiter.message_counts)
+
+        allowed, time_allowed = limiter.send_message(
+            user_id="test_id_3", time_now_s=50, msg_rate_hz=0.1, burst_count=5,
+        )
+
+        self.assertNotIn("test_id_1", limiter.message_counts)
+
+    def test_actions_are_limited_separately(self):
+        limiter = Ratelimiter()
+        allowed, _ = limiter.can_do_action(
+            key=("join", "test_id"), time_now_s=0, rate_hz=0.1, burst_count=1,
+        )
+        self.assertTrue(allowed)
+
+        allowed, _ = limiter.can_do_action(
+            key=("join", "test_id"), time_now_s=1, rate_hz=0.1, burst_count=1,
+        )
+        self.assertFalse(allowed)
+
+        allowed, _ = limiter.can_do_action(
+            key=("register", "test_id"), time_now_s=1, rate_hz=0.1, burst_count=1,
+        )
+        self.assertTrue(allowed)
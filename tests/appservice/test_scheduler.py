@@ -250,3 +250,55 @@ class ApplicationServiceSchedulerQueuerTestCase(unittest.TestCase):
         srv_2_defer.callback(srv2)
         self.txn_ctrl.send.assert_called_with(srv2, [srv_2_event2])
         self.assertEquals(3, self.txn_ctrl.send.call_count)
+
+    def test_send_large_queue_in_batches(self):
+        sends = []
+
+        def send(service, events):
+            sends.append(defer.Deferred())
+            return sends[-1]
+        self.txn_ctrl.send = Mock(side_effect=send)
+        self.queuer.max_txn_events = 2
+        service = Mock(id=4)
+        events = [Mock(event_id=str(i)) for i in range(5)]
+        for event in events:
+            self.queuer.enqueue(service, event)
+        self.txn_ctrl.send.assert_called_with(service, events[:1])
+
+        # the queued events should be split into transactions of at most 2
+        sends[-1].callback(service)
+        self.txn_ctrl.send.assert_called_with(service, events[1:3])
+        sends[-1].callback(service)
+        self.txn_ctrl.send.assert_called_with(service, events[3:])
+        self.assertEquals(3, self.txn_ctrl.send.call_count)
+
+    def test_send_queue_limited_by_size(self):
+        sends = []
+
+        def send(service, events):
+            sends.append(defer.Deferred())
+            return sends[-1]
+        self.txn_ctrl.send = Mock(side_effect=send)
+        self.queuer.max_txn_bytes = 50
+        service = Mock(id=4)
+
+        def make_event(event_id, size):
+            event = Mock(event_id=event_id)
+            event.get_pdu_json.return_value = {"body": "x" * size}
+            return event
+
+        first = make_event("first", 10)
+        big = make_event("big", 100)
+        small1 = make_event("small1", 10)
+        small2 = make_event("small2", 10)
+
+        self.queuer.enqueue(service, first)
+        self.queuer.enqueue(service, big)
+        self.queuer.enqueue(service, small1)
+        self.queuer.enqueue(service, small2)
+
+        # an event bigger than the limit is sent on its own
+        sends[-1].callback(service)
+        self.txn_ctrl.send.assert_called_with(service, [big])
+        sends[-1].callback(service)
+        self.txn_ctrl.send.assert_called_with(service, [small1, small2])
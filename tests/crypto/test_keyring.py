@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from mock import Mock, patch
+
+from synapse.api.errors import SynapseError
+from synapse.crypto.keyring import Keyring
+from synapse.util.logcontext import LoggingContext
+
+from signedjson.key import generate_signing_key, get_verify_key
+from signedjson.sign import sign_json, verify_signed_json
+
+from tests.utils import setup_test_homeserver
+
+import threading
+
+
+class KeyringTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            http_client=None,
+            resource_for_federation=Mock(),
+        )
+        self.keyring = Keyring(self.hs)
+
+        self.signing_key = generate_signing_key("1")
+        yield self.hs.get_datastore().store_server_verify_key(
+            "remote", "remote", 0, get_verify_key(self.signing_key),
+        )
+
+    @defer.inlineCallbacks
+    def test_verify_json_objects_for_server(self):
+        valid = [
+            sign_json({"foo": i}, "remote", self.signing_key)
+            for i in range(10)
+        ]
+        tampered = sign_json({"foo": "bar"}, "remote", self.signing_key)
+        tampered["foo"] = "baz"
+
+        verify_threads = []
+
+        def verify(*args):
+            verify_threads.append(threading.current_thread())
+            return verify_signed_json(*args)
+
+        with patch("synapse.crypto.keyring.verify_signed_json", verify):
+            deferreds = self.keyring.verify_json_objects_for_server(
+                [("remote", json_object) for json_object in valid] +
+                [("remote", tampered)]
+            )
+
+            for deferred in deferreds[:-1]:
+                yield deferred
+
+            with self.assertRaises(SynapseError):
+                yield deferreds[-1]
+
+        # The signatures should have been checked off the reactor thread.
+        self.assertEquals(len(valid) + 1, len(verify_threads))
+        self.assertNotIn(threading.current_thread(), verify_threads)
+
+    @defer.inlineCallbacks
+    def test_verify_unsigned_json(self):
+        deferreds = self.keyring.verify_json_objects_for_server([
+            ("remote", sign_json({"foo": "bar"}, "remote", self.signing_key)),
+            ("remote", {"foo": "bar"}),
+        ])
+
+        yield deferreds[0]
+
+        with self.assertRaises(SynapseError):
+            yield deferreds[1]
+
+    @defer.inlineCallbacks
+    def test_verify_preserves_logcontext(self):
+        with LoggingContext("test") as context:
+            deferreds = self.keyring.verify_json_objects_for_server([
+                ("remote", sign_json({"foo": "bar"}, "remote", self.signing_key)),
+            ])
+
+            yield deferreds[0]
+
+            self.assertIs(context, LoggingContext.current_context())
+
+    @defer.inlineCallbacks
+    def test_slow_server_does_not_block_others(self):
+        # Fetching keys for "slow" never completes, which shouldn't stop the
+        # objects signed by "remote" from being verified.
+        self.keyring.get_keys_from_perspectives = Mock(
+            return_value=defer.Deferred(),
+        )
+
+        slow_key = generate_signing_key("1")
+        deferreds = self.keyring.verify_json_objects_for_server([
+            ("remote", sign_json({"foo": "bar"}, "remote", self.signing_key)),
+            ("slow", sign_json({"foo": "bar"}, "slow", slow_key)),
+        ])
+
+        yield deferreds[0]
+
+        self.assertFalse(deferreds[1].called)
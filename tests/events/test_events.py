@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from .. import unittest
+
+from synapse.events import FrozenEvent
+from synapse.events.utils import prune_event
+
+from canonicaljson import encode_canonical_json
+from mock import patch
+
+
+class EventJsonTestCase(unittest.TestCase):
+    """Tests that the canonical encodings cached on events match a fresh
+    encoding of the event."""
+
+    def setUp(self):
+        self.event = FrozenEvent({
+            "event_id": "$test:domain",
+            "type": "m.room.message",
+            "room_id": "!room:domain",
+            "sender": "@alice:domain",
+            "content": {"body": "hello", "msgtype": "m.text"},
+            "signatures": {"domain": {"ed25519:1": "sig"}},
+            "hashes": {"sha256": "hash"},
+            "unsigned": {"age_ts": 1000000},
+        })
+
+    def test_json_bytes(self):
+        self.assertEquals(
+            encode_canonical_json(self.event.get_dict()),
+            self.event.get_json_bytes(),
+        )
+
+    def test_json_bytes_after_signing(self):
+        self.event.get_json_bytes()
+
+        self.event.signatures["other"] = {"ed25519:1": "othersig"}
+        self.event.unsigned["age_ts"] = 2000000
+
+        self.assertEquals(
+            encode_canonical_json(self.event.get_dict()),
+            self.event.get_json_bytes(),
+        )
+
+    def test_content_hash_json_bytes(self):
+        event_dict = self.event.get_pdu_json()
+        for key in ("unsigned", "signatures", "hashes"):
+            event_dict.pop(key, None)
+
+        self.assertEquals(
+            encode_canonical_json(event_dict),
+            self.event.get_content_hash_json_bytes(),
+        )
+
+    def test_redacted_json_bytes(self):
+        event_dict = prune_event(self.event).get_pdu_json()
+        for key in ("unsigned", "signatures"):
+            event_dict.pop(key, None)
+
+        self.assertEquals(
+            encode_canonical_json(event_dict),
+            self.event.get_redacted_json_bytes(),
+        )
+
+    def test_encodings_are_cached(self):
+        with patch(
+            "synapse.events.encode_canonical_json",
+            side_effect=encode_canonical_json,
+        ) as encode:
+            for _ in range(3):
+                self.event.get_json_bytes()
+                self.event.get_content_hash_json_bytes()
+                self.event.get_redacted_json_bytes()
+
+            self.assertEquals(3, encode.call_count)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.api.errors import SynapseError
+from synapse.crypto.event_signing import add_hashes_and_signatures
+from synapse.crypto.keyring import Keyring
+from synapse.events import FrozenEvent
+from synapse.events.builder import EventBuilder
+from synapse.federation.federation_base import FederationBase
+
+from signedjson.key import generate_signing_key, get_verify_key
+
+from tests.utils import setup_test_homeserver
+
+
+class CheckSigsAndHashesTestCase(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            http_client=None,
+            resource_for_federation=Mock(),
+        )
+
+        self.federation = FederationBase()
+        self.federation.keyring = Keyring(self.hs)
+        self.federation.store = self.hs.get_datastore()
+
+        self.signing_key = generate_signing_key("1")
+        yield self.hs.get_datastore().store_server_verify_key(
+            "remote", "remote", 0, get_verify_key(self.signing_key),
+        )
+
+    def _build_pdu(self, idx, signing_key=None):
+        builder = EventBuilder({
+            "event_id": "$%d:remote" % (idx,),
+            "room_id": "!room:remote",
+            "sender": "@user:remote",
+            "origin": "remote",
+            "origin_server_ts": 1000000,
+            "type": "m.room.message",
+            "content": {"body": "message %d" % (idx,), "msgtype": "m.text"},
+            "prev_events": [],
+            "auth_events": [],
+            "depth": idx,
+            "signatures": {},
+            "unsigned": {},
+        })
+        add_hashes_and_signatures(
+            builder, "remote", signing_key or self.signing_key,
+        )
+        return builder.build()
+
+    @defer.inlineCallbacks
+    def test_check_sigs_and_hashes(self):
+        pdus = [self._build_pdu(i) for i in range(10)]
+
+        checked = yield defer.gatherResults(
+            self.federation._check_sigs_and_hashes(pdus)
+        )
+
+        self.assertEquals(pdus, checked)
+
+    @defer.inlineCallbacks
+    def test_tampered_content_is_redacted(self):
+        pdu_json = self._build_pdu(0).get_pdu_json()
+        pdu_json["content"] = {"body": "tampered", "msgtype": "m.text"}
+        pdu = FrozenEvent(pdu_json)
+
+        checked = yield self.federation._check_sigs_and_hash(pdu)
+
+        self.assertEquals(pdu.event_id, checked.event_id)
+        self.assertEquals({}, checked.content)
+
+    @defer.inlineCallbacks
+    def test_bad_signature(self):
+        pdus = [
+            self._build_pdu(0),
+            self._build_pdu(1, signing_key=generate_signing_key("1")),
+        ]
+
+        deferreds = self.federation._check_sigs_and_hashes(pdus)
+
+        checked = yield deferreds[0]
+        self.assertEquals(pdus[0], checked)
+
+        with self.assertRaises(SynapseError):
+            yield deferreds[1]
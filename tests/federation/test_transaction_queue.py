@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.api.constants import PresenceState
+from synapse.federation.transaction_queue import TransactionQueue
+from synapse.storage.presence import UserPresenceState
+
+from tests.utils import setup_test_homeserver, MockClock
+
+
+class TransactionQueuePresenceTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            clock=MockClock(),
+            datastore=Mock(spec=[
+                "prep_send_transaction",
+                "delivered_txn",
+                "get_destination_retry_timings",
+            ]),
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        datastore = hs.get_datastore()
+        datastore.prep_send_transaction.return_value = defer.succeed(None)
+        datastore.delivered_txn.return_value = defer.succeed(None)
+        datastore.get_destination_retry_timings.return_value = defer.succeed(None)
+
+        self.sent = []
+        self.transport_layer = Mock()
+        self.transport_layer.send_transaction.side_effect = self._send_transaction
+
+        self.queue = TransactionQueue(hs, self.transport_layer)
+
+    def _send_transaction(self, transaction, json_data_cb):
+        d = defer.Deferred()
+        self.sent.append((transaction, d))
+        return d
+
+    def _state(self, user_id, state):
+        return UserPresenceState.default(user_id).copy_and_replace(state=state)
+
+    def _pushed(self, transaction):
+        self.assertEquals(1, len(transaction.edus))
+        edu = transaction.edus[0]
+        self.assertEquals("m.presence", edu.edu_type)
+        return sorted(
+            (p["user_id"], p["presence"]) for p in edu.content["push"]
+        )
+
+    def test_latest_state_per_user(self):
+        self.queue.send_presence("remote", [
+            self._state("@apple:test", PresenceState.ONLINE),
+        ])
+
+        self.assertEquals(1, len(self.sent))
+        transaction, d = self.sent[0]
+        self.assertEquals(
+            [("@apple:test", PresenceState.ONLINE)], self._pushed(transaction)
+        )
+
+        # While the transaction is in flight, updates get queued up and
+        # replaced by later updates of the same user.
+        self.queue.send_presence("remote", [
+            self._state("@apple:test", PresenceState.UNAVAILABLE),
+            self._state("@banana:test", PresenceState.ONLINE),
+        ])
+        self.queue.send_presence("remote", [
+            self._state("@apple:test", PresenceState.OFFLINE),
+        ])
+
+        self.assertEquals(1, len(self.sent))
+
+        d.callback({})
+
+        self.assertEquals(2, len(self.sent))
+        transaction, d = self.sent[1]
+        self.assertEquals([
+            ("@apple:test", PresenceState.OFFLINE),
+            ("@banana:test", PresenceState.ONLINE),
+        ], self._pushed(transaction))
+
+        d.callback({})
+        self.assertEquals(2, len(self.sent))
+
+    def test_failure_is_handled(self):
+        # A state that can't be formatted makes building the transaction
+        # fail, which should be logged rather than left unhandled.
+        self.queue.send_presence("remote", [
+            self._state("@apple:test", PresenceState.ONLINE).copy_and_replace(
+                last_active_ts="not a timestamp",
+            ),
+        ])
+
+        self.assertEquals(0, len(self.sent))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from mock import Mock, NonCallableMock
+
+from synapse.handlers._base import MAX_PREV_EVENTS
+from synapse.types import UserID
+
+from tests.utils import setup_test_homeserver, requester_for_user
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MessageSendBenchmarkTestCase(unittest.TestCase):
+    """Benchmarks the per event cost of sending messages into a room.
+    """
+
+    NUM_MESSAGES = 200
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            http_client=None,
+            replication_layer=Mock(),
+            ratelimiter=NonCallableMock(spec_set=[
+                "send_message",
+            ]),
+        )
+        self.hs.get_ratelimiter().send_message.return_value = (True, 0)
+
+        self.store = self.hs.get_datastore()
+        self.message_handler = self.hs.get_handlers().message_handler
+
+        self.user = UserID.from_string("@sender:test")
+        self.requester = requester_for_user(self.user)
+
+        result = yield self.hs.get_handlers().room_creation_handler.create_room(
+            self.requester, {}
+        )
+        self.room_id = result["room_id"]
+
+    @defer.inlineCallbacks
+    def test_send_messages(self):
+        start = time.time()
+        for i in range(self.NUM_MESSAGES):
+            event = yield self.message_handler.create_and_send_nonmember_event(
+                self.requester,
+                {
+                    "type": "m.room.message",
+                    "content": {"body": "message %d" % (i,), "msgtype": "m.text"},
+                    "room_id": self.room_id,
+                    "sender": self.user.to_string(),
+                }
+            )
+        elapsed = time.time() - start
+
+        logger.info(
+            "Sending a message took %.2fms",
+            elapsed * 1000. / self.NUM_MESSAGES,
+        )
+
+        stored = yield self.store.get_event(event.event_id)
+        self.assertEquals(event.get_json_bytes(), stored.get_json_bytes())
+
+    @defer.inlineCallbacks
+    def test_prev_events_are_capped(self):
+        extremities = [
+            ("$event%d:test" % (depth,), {}, depth)
+            for depth in range(1, 2 * MAX_PREV_EVENTS + 1)
+        ]
+        self.store.get_latest_event_ids_and_hashes_in_room = Mock(
+            return_value=defer.succeed(extremities)
+        )
+
+        builder = self.hs.get_event_builder_factory().new({
+            "type": "m.room.message",
+            "content": {"body": "message", "msgtype": "m.text"},
+            "room_id": self.room_id,
+            "sender": self.user.to_string(),
+        })
+        event, _ = yield self.message_handler._create_new_client_event(builder)
+
+        # The deepest extremities should have been picked.
+        self.assertEquals(
+            set(e_id for e_id, _, _ in extremities[-MAX_PREV_EVENTS:]),
+            set(e_id for e_id, _ in event.prev_events),
+        )
+        self.assertEquals(2 * MAX_PREV_EVENTS + 1, event.depth)
+
+    @defer.inlineCallbacks
+    def test_message_state_is_loaded_lazily(self):
+        event, context = yield self.message_handler.create_event({
+            "type": "m.room.message",
+            "content": {"body": "message", "msgtype": "m.text"},
+            "room_id": self.room_id,
+            "sender": self.user.to_string(),
+        })
+
+        self.assertIsNone(context.current_state)
+        self.assertIsNotNone(context.state_group)
+
+        yield self.message_handler.send_nonmember_event(
+            self.requester, event, context,
+        )
+
+        self.assertIsNone(context.current_state)
+
+        # The event should still have been given the room's state.
+        state = yield self.store.get_state_for_event(event.event_id)
+        self.assertIn(("m.room.member", self.user.to_string()), state)
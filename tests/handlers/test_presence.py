@@ -15,16 +15,26 @@
 
 
 from tests import unittest
+from twisted.internet import defer
 
 from mock import Mock, call
 
-from synapse.api.constants import PresenceState
+from synapse.api.constants import Membership, PresenceState
 from synapse.handlers.presence import (
     handle_update, handle_timeout,
     IDLE_TIMER, SYNC_ONLINE_TIMEOUT, LAST_ACTIVE_GRANULARITY, FEDERATION_TIMEOUT,
     FEDERATION_PING_INTERVAL,
 )
 from synapse.storage.presence import UserPresenceState
+from synapse.types import RoomID, UserID
+
+from tests.storage.event_injector import EventInjector
+from tests.utils import setup_test_homeserver
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 
 class PresenceUpdateTestCase(unittest.TestCase):
@@ -382,3 +392,136 @@ class PresenceTimeoutTestCase(unittest.TestCase):
 
         self.assertIsNotNone(new_state)
         self.assertEquals(state, new_state)
+
+
+class PresencePersistTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.presence_handler = self.hs.get_handlers().presence_handler
+        self.event_source = self.hs.get_event_sources().sources["presence"]
+
+        self.u_apple = UserID.from_string("@apple:test")
+        self.u_banana = UserID.from_string("@banana:test")
+
+    @defer.inlineCallbacks
+    def test_write_behind(self):
+        from_key = self.event_source.get_current_key()
+
+        yield self.presence_handler.set_state(
+            self.u_apple, {"presence": PresenceState.ONLINE}
+        )
+        yield self.presence_handler.set_state(
+            self.u_banana, {"presence": PresenceState.ONLINE}
+        )
+        yield self.presence_handler.set_state(
+            self.u_apple, {"presence": PresenceState.UNAVAILABLE}
+        )
+
+        # Clients are told about the new states before they're persisted
+        current_key = self.event_source.get_current_key()
+        self.assertEquals(from_key + 3, current_key)
+
+        events, _ = yield self.event_source.get_new_events(
+            user=self.u_apple, from_key=from_key,
+        )
+        self.assertEquals(
+            [(self.u_apple.to_string(), PresenceState.UNAVAILABLE)],
+            [(e["content"]["user_id"], e["content"]["presence"]) for e in events]
+        )
+
+        states = yield self.store.get_presence_for_users([
+            self.u_apple.to_string(), self.u_banana.to_string(),
+        ])
+        self.assertEquals([], states)
+
+        # Replication includes the unpersisted updates
+        rows = yield self.presence_handler.get_all_presence_updates(
+            from_key, current_key
+        )
+        self.assertEquals([
+            (from_key + 2, self.u_banana.to_string(), PresenceState.ONLINE),
+            (from_key + 3, self.u_apple.to_string(), PresenceState.UNAVAILABLE),
+        ], [row[:3] for row in rows])
+
+        # All the updates are written in one go, keeping only the latest
+        # state for each user
+        yield self.presence_handler._persist_pending_presence()
+
+        states = yield self.store.get_presence_for_users([
+            self.u_apple.to_string(), self.u_banana.to_string(),
+        ])
+        self.assertEquals({
+            self.u_apple.to_string(): PresenceState.UNAVAILABLE,
+            self.u_banana.to_string(): PresenceState.ONLINE,
+        }, {state.user_id: state.state for state in states})
+
+        db_rows = yield self.store.get_all_presence_updates(from_key, current_key)
+        self.assertEquals(rows, [tuple(row) for row in db_rows])
+
+
+class PresenceEventSourceBenchmarkTestCase(unittest.TestCase):
+    """Benchmarks incremental presence syncs for a user in many rooms.
+    """
+
+    NUM_ROOMS = 1000
+    NUM_SYNCS = 100
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        self.store = self.hs.get_datastore()
+        self.presence_handler = self.hs.get_handlers().presence_handler
+        self.event_source = self.hs.get_event_sources().sources["presence"]
+        event_injector = EventInjector(self.hs)
+
+        self.user = UserID.from_string("@syncer:test")
+        self.others = []
+
+        for i in range(self.NUM_ROOMS):
+            room = RoomID.from_string("!room%d:test" % (i,))
+            other = UserID.from_string("@user%d:test" % (i,))
+            self.others.append(other)
+
+            yield event_injector.inject_room_member(room, self.user, Membership.JOIN)
+            yield event_injector.inject_room_member(room, other, Membership.JOIN)
+
+    @defer.inlineCallbacks
+    def test_incremental_sync(self):
+        from_key = self.event_source.get_current_key()
+
+        changed = self.others[self.NUM_ROOMS / 2]
+        yield self.presence_handler.set_state(
+            changed, {"presence": PresenceState.ONLINE}
+        )
+
+        get_users_in_rooms = self.store.get_users_in_rooms
+        self.store.get_users_in_rooms = Mock(side_effect=get_users_in_rooms)
+
+        start = time.time()
+        for _ in range(self.NUM_SYNCS):
+            events, _ = yield self.event_source.get_new_events(
+                user=self.user, from_key=from_key,
+            )
+            self.assertEquals(
+                [changed.to_string()],
+                [e["content"]["user_id"] for e in events],
+            )
+        elapsed = time.time() - start
+
+        logger.info(
+            "Incremental presence sync in %d rooms took %.2fms",
+            self.NUM_ROOMS, elapsed * 1000. / self.NUM_SYNCS,
+        )
+
+        # The users who share a room with the syncing user should only have
+        # been calculated once.
+        self.assertEquals(1, self.store.get_users_in_rooms.call_count)
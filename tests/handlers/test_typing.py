@@ -30,10 +30,11 @@ from synapse.handlers.typing import TypingNotificationHandler
 from synapse.types import UserID
 
 
-def _expect_edu(destination, edu_type, content, origin="test"):
+def _expect_edu(destination, edu_type, content, origin="test",
+                origin_server_ts=1000000):
     return {
         "origin": origin,
-        "origin_server_ts": 1000000,
+        "origin_server_ts": origin_server_ts,
         "pdus": [],
         "edus": [
             {
@@ -80,6 +81,7 @@ class TypingNotificationsTestCase(unittest.TestCase):
                 "get_received_txn_response",
                 "set_received_txn_response",
                 "get_destination_retry_timings",
+                "get_joined_hosts_for_room",
             ]),
             handlers=None,
             notifier=mock_notifier,
@@ -138,23 +140,10 @@ class TypingNotificationsTestCase(unittest.TestCase):
         self.room_member_handler.get_joined_rooms_for_user = get_joined_rooms_for_user
 
         @defer.inlineCallbacks
-        def fetch_room_distributions_into(
-            room_id, localusers=None, remotedomains=None, ignore_user=None
-        ):
+        def get_joined_hosts_for_room(room_id):
             members = yield get_room_members(room_id)
-            for member in members:
-                if ignore_user is not None and member == ignore_user:
-                    continue
-
-                if hs.is_mine(member):
-                    if localusers is not None:
-                        localusers.add(member)
-                else:
-                    if remotedomains is not None:
-                        remotedomains.add(member.domain)
-        self.room_member_handler.fetch_room_distributions_into = (
-            fetch_room_distributions_into
-        )
+            defer.returnValue(set(member.domain for member in members))
+        self.datastore.get_joined_hosts_for_room = get_joined_hosts_for_room
 
         def check_joined_room(room_id, user_id):
             if user_id not in [u.to_string() for u in self.room_members]:
@@ -218,7 +207,8 @@ class TypingNotificationsTestCase(unittest.TestCase):
                         "room_id": self.room_id,
                         "user_id": self.u_apple.to_string(),
                         "typing": True,
-                    }
+                    },
+                    origin_server_ts=1000050,
                 ),
                 json_data_callback=ANY,
                 long_retries=True,
@@ -233,6 +223,9 @@ class TypingNotificationsTestCase(unittest.TestCase):
             timeout=20000,
         )
 
+        # EDUs are sent after a short delay, to coalesce changes
+        self.clock.advance_time_msec(50)
+
         yield put_json.await_calls()
 
     @defer.inlineCallbacks
@@ -288,7 +281,8 @@ class TypingNotificationsTestCase(unittest.TestCase):
                         "room_id": self.room_id,
                         "user_id": self.u_apple.to_string(),
                         "typing": False,
-                    }
+                    },
+                    origin_server_ts=1000050,
                 ),
                 json_data_callback=ANY,
                 long_retries=True,
@@ -300,9 +294,6 @@ class TypingNotificationsTestCase(unittest.TestCase):
         from synapse.handlers.typing import RoomMember
         member = RoomMember(self.room_id, self.u_apple)
         self.handler._member_typing_until[member] = 1002000
-        self.handler._member_typing_timer[member] = (
-            self.clock.call_later(1002, lambda: 0)
-        )
         self.handler._room_typing[self.room_id] = set((self.u_apple,))
 
         self.assertEquals(self.event_source.get_current_key(), 0)
@@ -317,6 +308,8 @@ class TypingNotificationsTestCase(unittest.TestCase):
             call('typing_key', 1, rooms=[self.room_id]),
         ])
 
+        self.clock.advance_time_msec(50)
+
         yield put_json.await_calls()
 
         self.assertEquals(self.event_source.get_current_key(), 1)
@@ -363,7 +356,13 @@ class TypingNotificationsTestCase(unittest.TestCase):
             },
         }])
 
+        # Timeouts are checked every 5 seconds, so may be a few seconds late
         self.clock.advance_time(11)
+        self.handler._handle_timeouts()
+        self.assertEquals(self.event_source.get_current_key(), 1)
+
+        self.clock.advance_time(5)
+        self.handler._handle_timeouts()
 
         self.on_new_event.assert_has_calls([
             call('typing_key', 2, rooms=[self.room_id]),
@@ -408,3 +407,66 @@ class TypingNotificationsTestCase(unittest.TestCase):
                 "user_ids": [self.u_apple.to_string()],
             },
         }])
+
+    @defer.inlineCallbacks
+    def test_remote_updates_coalesced(self):
+        self.room_members = [self.u_apple, self.u_banana, self.u_onion]
+
+        put_json = self.mock_http_client.put_json
+        put_json.expect_call_and_return(
+            call(
+                "farm",
+                path="/_matrix/federation/v1/send/1000000/",
+                data=_expect_edu(
+                    "farm",
+                    "m.typing",
+                    content={
+                        "room_id": self.room_id,
+                        "user_id": self.u_apple.to_string(),
+                        "typing": False,
+                    },
+                    origin_server_ts=1000050,
+                ),
+                json_data_callback=ANY,
+                long_retries=True,
+            ),
+            defer.succeed((200, "OK"))
+        )
+
+        yield self.handler.started_typing(
+            target_user=self.u_apple,
+            auth_user=self.u_apple,
+            room_id=self.room_id,
+            timeout=20000,
+        )
+        yield self.handler.stopped_typing(
+            target_user=self.u_apple,
+            auth_user=self.u_apple,
+            room_id=self.room_id,
+        )
+
+        # Only the latest state is sent
+        self.clock.advance_time_msec(50)
+
+        yield put_json.await_calls()
+
+    def test_get_all_typing_updates(self):
+        self.handler._push_update_local("room1", self.u_apple, True)
+        self.handler._push_update_local("room2", self.u_banana, True)
+        self.handler._push_update_local("room1", self.u_apple, False)
+
+        self.assertEquals(
+            self.handler.get_all_typing_updates(0, 3),
+            [
+                (2, "room2", '["@banana:test"]'),
+                (3, "room1", '[]'),
+            ]
+        )
+        self.assertEquals(
+            self.handler.get_all_typing_updates(2, 3),
+            [(3, "room1", '[]')]
+        )
+        self.assertEquals(self.handler.get_all_typing_updates(3, 3), [])
+
+        # Rooms where nobody is typing aren't kept around
+        self.assertEquals(self.handler._room_typing.keys(), ["room2"])
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests import unittest
+
+from mock import Mock
+
+from synapse.metrics.profiler import SamplingProfiler
+from synapse.util.logcontext import LoggingContext
+
+import thread
+import time
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+    def _busy_wait(self, profiler, samples):
+        while profiler.sample_count < samples:
+            time.sleep(0.001)
+
+    def test_samples_tagged_by_context(self):
+        profiler = SamplingProfiler(
+            thread.get_ident(), Mock(threads=[]), 0.001,
+        )
+        profiler.start()
+        try:
+            with LoggingContext("GET-42") as context:
+                context.servlet = "RoomSendEventRestServlet"
+                self._busy_wait(profiler, 5)
+        finally:
+            profiler.stop()
+            profiler.join()
+
+        self.assertIsNone(LoggingContext.contexts_by_thread)
+
+        stacks = profiler.collapsed_stacks().splitlines()
+        self.assertTrue(stacks)
+        for line in stacks:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(int(count) > 0)
+            self.assertTrue(stack.startswith("reactor;"))
+
+        self.assertTrue(any(
+            line.startswith("reactor;RoomSendEventRestServlet;")
+            and "_busy_wait" in line
+            for line in stacks
+        ))
+
+    def test_request_ids_stripped(self):
+        profiler = SamplingProfiler(
+            thread.get_ident(), Mock(threads=[]), 0.001,
+        )
+        profiler.start()
+        try:
+            with LoggingContext("GET-42"):
+                self._busy_wait(profiler, 5)
+        finally:
+            profiler.stop()
+            profiler.join()
+
+        self.assertIn("reactor;GET;", profiler.collapsed_stacks())
+
+    def test_stop_does_not_wait_for_interval(self):
+        profiler = SamplingProfiler(
+            thread.get_ident(), Mock(threads=[]), 60,
+        )
+        profiler.start()
+
+        start = time.time()
+        profiler.stop()
+        profiler.join()
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals(0, profiler.sample_count)
@@ -147,7 +147,8 @@ class RoomTypingTestCase(RestTestCase):
 
         self.assertEquals(self.event_source.get_current_key(), 1)
 
-        self.clock.advance_time(31)
+        self.clock.advance_time(36)
+        self.hs.get_handlers().typing_notification_handler._handle_timeouts()
 
         self.assertEquals(self.event_source.get_current_key(), 2)
 
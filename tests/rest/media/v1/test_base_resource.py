@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests import unittest
+
+from io import BytesIO
+
+from synapse.api.errors import SynapseError
+from synapse.rest.media.v1.base_resource import (
+    parse_byte_range, DownloadProgress,
+)
+
+
+class ParseByteRangeTestCase(unittest.TestCase):
+    def test_simple_range(self):
+        self.assertEquals(parse_byte_range("bytes=0-99", 1000), (0, 99))
+        self.assertEquals(parse_byte_range("bytes=100-", 1000), (100, 999))
+
+    def test_suffix_range(self):
+        self.assertEquals(parse_byte_range("bytes=-100", 1000), (900, 999))
+        self.assertEquals(parse_byte_range("bytes=-2000", 1000), (0, 999))
+
+    def test_end_past_file(self):
+        self.assertEquals(parse_byte_range("bytes=500-5000", 1000), (500, 999))
+
+    def test_ignored_ranges(self):
+        self.assertIsNone(parse_byte_range("bytes=0-10,20-30", 1000))
+        self.assertIsNone(parse_byte_range("lines=0-10", 1000))
+        self.assertIsNone(parse_byte_range("bytes=10-5", 1000))
+        self.assertIsNone(parse_byte_range("bytes=a-b", 1000))
+
+    def test_unsatisfiable(self):
+        with self.assertRaises(SynapseError) as cm:
+            parse_byte_range("bytes=1000-", 1000)
+        self.assertEquals(cm.exception.code, 416)
+
+
+class DownloadProgressTestCase(unittest.TestCase):
+    def test_wait_for_data(self):
+        progress = DownloadProgress()
+        progress.set_stream(BytesIO())
+
+        d = progress.wait_for_data(0)
+        self.assertFalse(d.called)
+
+        progress.write(b"hello")
+        self.assertTrue(d.called)
+        self.assertEquals(progress.length, 5)
+
+        d = progress.wait_for_data(5)
+        self.assertFalse(d.called)
+        progress.finish()
+        self.assertTrue(d.called)
+
+    def test_start(self):
+        progress = DownloadProgress()
+        d = progress.wait_for_start()
+        self.assertFalse(d.called)
+
+        progress.started({"media_type": "image/png"})
+        self.assertEquals(d.result, {"media_type": "image/png"})
+
+    def test_fail(self):
+        progress = DownloadProgress()
+        start_d = progress.wait_for_start()
+        data_d = progress.wait_for_data(0)
+
+        progress.fail(Exception("Download failed"))
+
+        self.assertFailure(start_d, Exception)
+        self.assertFailure(data_d, Exception)
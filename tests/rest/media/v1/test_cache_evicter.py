@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests import unittest
+from twisted.internet import defer
+
+import shutil
+import tempfile
+
+from synapse.rest.media.v1.cache_evicter import RemoteMediaCacheEvicter
+from synapse.rest.media.v1.filepath import MediaFilePaths
+
+from tests.utils import setup_test_homeserver
+
+
+class RemoteMediaCacheEvicterTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        hs = yield setup_test_homeserver()
+        hs.config.remote_media_cache_max_size = 250
+
+        self.clock = hs.get_clock()
+        self.store = hs.get_datastore()
+        self.evicter = RemoteMediaCacheEvicter(
+            hs, MediaFilePaths(self.dir), None, {},
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @defer.inlineCallbacks
+    def _store_media(self, media_id, media_length):
+        yield self.store.store_cached_remote_media(
+            origin="remote",
+            media_id=media_id,
+            media_type="image/png",
+            media_length=media_length,
+            time_now_ms=self.clock.time_msec(),
+            upload_name=None,
+            filesystem_id="fs_" + media_id,
+        )
+        self.clock.advance_time(1)
+
+    @defer.inlineCallbacks
+    def test_evicts_least_recently_accessed(self):
+        yield self._store_media("a", 100)
+        yield self._store_media("b", 100)
+        yield self._store_media("c", 100)
+
+        # "a" has been accessed since, but the access hasn't been flushed to
+        # the database yet.
+        self.store.mark_remote_media_accessed("remote", "a")
+
+        yield self.evicter.evict()
+
+        for media_id, evicted in (("a", False), ("b", True), ("c", False)):
+            media = yield self.store.get_cached_remote_media("remote", media_id)
+            self.assertEquals(media is None, evicted)
+
+    @defer.inlineCallbacks
+    def test_unknown_length(self):
+        yield self._store_media("a", None)
+        yield self._store_media("b", 200)
+        yield self._store_media("c", 100)
+
+        yield self.evicter.evict()
+
+        for media_id, evicted in (("a", True), ("b", True), ("c", False)):
+            media = yield self.store.get_cached_remote_media("remote", media_id)
+            self.assertEquals(media is None, evicted)
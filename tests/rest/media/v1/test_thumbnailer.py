@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests import unittest
+from twisted.internet import defer
+
+import os
+import shutil
+import tempfile
+import time
+
+import PIL.Image as Image
+
+from synapse.rest.media.v1.thumbnailer import (
+    generate_thumbnails, ThumbnailerPool,
+)
+
+
+class GenerateThumbnailsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.dir, "input")
+        Image.new("RGB", (1200, 800)).save(self.input_path, "JPEG")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_generate_thumbnails(self):
+        thumbnails = [
+            (os.path.join(self.dir, "1"), 32, 32, "crop", "image/png"),
+            (os.path.join(self.dir, "2"), 640, 426, "scale", "image/jpeg"),
+            (os.path.join(self.dir, "3"), 96, 96, "crop", "image/jpeg"),
+        ]
+
+        lengths = generate_thumbnails(self.input_path, thumbnails, 32000000)
+
+        for (path, width, height, _, _), length in zip(thumbnails, lengths):
+            self.assertEquals(os.path.getsize(path), length)
+            self.assertEquals(Image.open(path).size, (width, height))
+
+    def test_too_large(self):
+        thumbnails = [
+            (os.path.join(self.dir, "1"), 32, 32, "crop", "image/png"),
+        ]
+
+        lengths = generate_thumbnails(self.input_path, thumbnails, 1000)
+
+        self.assertEquals(lengths, [None])
+        self.assertFalse(os.path.exists(thumbnails[0][0]))
+
+
+class ThumbnailerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.dir, "input")
+        Image.new("RGB", (1200, 800)).save(self.input_path, "JPEG")
+
+        self.pool = ThumbnailerPool(1, timeout=1)
+
+    def tearDown(self):
+        if self.pool._pool:
+            self.pool._pool.terminate()
+            self.pool._pool.join()
+        shutil.rmtree(self.dir)
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        path = os.path.join(self.dir, "1")
+        lengths = yield self.pool.run(
+            generate_thumbnails, self.input_path,
+            [(path, 32, 32, "crop", "image/png")], 32000000,
+        )
+
+        self.assertEquals(lengths, [os.path.getsize(path)])
+
+    @defer.inlineCallbacks
+    def test_failure(self):
+        with self.assertRaises(Exception) as cm:
+            yield self.pool.run(
+                generate_thumbnails, os.path.join(self.dir, "missing"),
+                [(os.path.join(self.dir, "1"), 32, 32, "crop", "image/png")],
+                32000000,
+            )
+
+        # The worker's traceback should be passed back to us.
+        self.assertIn("IOError", str(cm.exception))
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        with self.assertRaises(Exception) as cm:
+            yield self.pool.run(time.sleep, 10)
+
+        self.assertIn("timed out", str(cm.exception))
@@ -73,3 +73,5 @@ class EventInjector:
         )
 
         yield self.store.persist_event(event, context)
+
+        defer.returnValue(event)
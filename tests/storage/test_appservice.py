@@ -18,10 +18,12 @@ from tests import unittest
 from twisted.internet import defer
 
 from tests.utils import setup_test_homeserver
+from synapse.api.constants import EventTypes
 from synapse.appservice import ApplicationService, ApplicationServiceState
 from synapse.storage.appservice import (
     ApplicationServiceStore, ApplicationServiceTransactionStore
 )
+from synapse.types import RoomAlias
 
 import json
 import os
@@ -369,6 +371,41 @@ class ApplicationServiceTransactionStoreTestCase(unittest.TestCase):
         self.assertEquals(10, txn.id)
         self.assertEquals(events, txn.events)
 
+    @defer.inlineCallbacks
+    def test_get_appservice_unsent_txn_count(self):
+        service = Mock(id=self.as_list[0]["id"])
+        events = [Mock(event_id="e1"), Mock(event_id="e2")]
+
+        count = yield self.store.get_appservice_unsent_txn_count(service)
+        self.assertEquals(0, count)
+
+        yield self._insert_txn(self.as_list[1]["id"], 9, events)
+        yield self.store.create_appservice_txn(service, events)
+        yield self.store.create_appservice_txn(service, events)
+
+        count = yield self.store.get_appservice_unsent_txn_count(service)
+        self.assertEquals(2, count)
+
+    @defer.inlineCallbacks
+    def test_txn_events_are_deleted_on_completion(self):
+        service = Mock(id=self.as_list[0]["id"])
+        events = [Mock(event_id="e1"), Mock(event_id="e2")]
+        txn = yield self.store.create_appservice_txn(service, events)
+
+        res = yield self.db_pool.runQuery(
+            "SELECT event_id FROM application_services_txn_events"
+            " WHERE as_id=? AND txn_id=?",
+            (service.id, txn.id)
+        )
+        self.assertEquals(set(["e1", "e2"]), set(r[0] for r in res))
+
+        yield self.store.complete_appservice_txn(txn.id, service)
+
+        res = yield self.db_pool.runQuery(
+            "SELECT event_id FROM application_services_txn_events"
+        )
+        self.assertEquals(0, len(res))
+
     @defer.inlineCallbacks
     def test_get_appservices_by_state_single(self):
         yield self._set_state(
@@ -410,6 +447,98 @@ class ApplicationServiceTransactionStoreTestCase(unittest.TestCase):
 
 
 # required for ApplicationServiceTransactionStoreTestCase tests
+class ApplicationServiceRoomInterestTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+        # The interest is maintained as events are persisted, so this needs
+        # the full datastore.
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.message_handler = hs.get_handlers().message_handler
+
+        self.service = ApplicationService(
+            "token", id="irc", sender="@irc:test",
+            namespaces={
+                ApplicationService.NS_USERS: [
+                    {"regex": "@irc_.*:test", "exclusive": True},
+                ],
+                ApplicationService.NS_ALIASES: [
+                    {"regex": "#irc_.*:test", "exclusive": True},
+                ],
+                ApplicationService.NS_ROOMS: [
+                    {"regex": "!irc.*:test", "exclusive": True},
+                ],
+            },
+        )
+        self.store.services_cache = [self.service]
+
+    @defer.inlineCallbacks
+    def inject_room_member(self, room_id, user_id, membership):
+        builder = self.event_builder_factory.new({
+            "type": EventTypes.Member,
+            "sender": user_id,
+            "state_key": user_id,
+            "room_id": room_id,
+            "content": {"membership": membership},
+        })
+
+        event, context = yield self.message_handler._create_new_client_event(
+            builder
+        )
+
+        yield self.store.persist_event(event, context)
+
+    @defer.inlineCallbacks
+    def get_room_ids(self):
+        rooms = yield self.store.get_app_service_rooms(self.service)
+        defer.returnValue(set(r.room_id for r in rooms))
+
+    @defer.inlineCallbacks
+    def test_interest_is_maintained(self):
+        self.assertEquals(set(), (yield self.get_room_ids()))
+
+        yield self.store.store_room("!ircroom:test", "@alice:test", True)
+        yield self.store.store_room("!other:test", "@alice:test", True)
+        yield self.store.create_room_alias_association(
+            RoomAlias("irc_chan", "test"), "!aliased:test", ["test"]
+        )
+        yield self.inject_room_member("!joined:test", "@irc_bob:test", "join")
+        yield self.inject_room_member("!other:test", "@alice:test", "join")
+
+        self.assertEquals(
+            set(["!ircroom:test", "!aliased:test", "!joined:test"]),
+            (yield self.get_room_ids()),
+        )
+
+        yield self.inject_room_member("!joined:test", "@irc_bob:test", "leave")
+        yield self.store.delete_room_alias(RoomAlias("irc_chan", "test"))
+
+        self.assertEquals(set(["!ircroom:test"]), (yield self.get_room_ids()))
+
+    @defer.inlineCallbacks
+    def test_interest_is_rebuilt_when_namespaces_change(self):
+        yield self.store.register("@irc_bob:test", "bob_token", None)
+        yield self.store.store_room("!ircroom:test", "@alice:test", True)
+        yield self.inject_room_member("!joined:test", "@irc_bob:test", "join")
+
+        self.assertEquals(
+            set(["!ircroom:test", "!joined:test"]),
+            (yield self.get_room_ids()),
+        )
+
+        # Simulate a restart with the room namespace removed from the
+        # registration.
+        self.service.namespaces[ApplicationService.NS_ROOMS] = []
+        self.store._app_service_room_interest_checked.clear()
+
+        self.assertEquals(set(["!joined:test"]), (yield self.get_room_ids()))
+
+
 class TestTransactionStore(ApplicationServiceTransactionStore,
                            ApplicationServiceStore):
 
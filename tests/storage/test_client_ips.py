@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.types import UserID
+
+from tests.utils import setup_test_homeserver
+
+
+class ClientIpStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver()
+
+        self.clock = hs.get_clock()
+        self.store = hs.get_datastore()
+        self.user = UserID.from_string("@user:test")
+
+    @defer.inlineCallbacks
+    def test_insert_is_batched(self):
+        self.store.insert_client_ip(self.user, "token", "1.2.3.4", "agent")
+
+        rows = yield self.store._simple_select_list(
+            "user_ips", {"user_id": self.user.to_string()}, ["ip"],
+        )
+        self.assertEquals(rows, [])
+
+        # The whois API still sees it before it has been flushed
+        sessions = yield self.store.get_user_ip_and_agents(self.user)
+        self.assertEquals(sessions, [{
+            "access_token": "token",
+            "ip": "1.2.3.4",
+            "user_agent": "agent",
+            "last_seen": self.clock.time_msec(),
+        }])
+
+        yield self.store._update_client_ips_batch()
+
+        rows = yield self.store._simple_select_list(
+            "user_ips", {"user_id": self.user.to_string()}, ["ip", "last_seen"],
+        )
+        self.assertEquals(rows, [{
+            "ip": "1.2.3.4",
+            "last_seen": self.clock.time_msec(),
+        }])
+
+    @defer.inlineCallbacks
+    def test_pending_entries_override_database(self):
+        self.store.insert_client_ip(self.user, "token", "1.2.3.4", "agent")
+        yield self.store._update_client_ips_batch()
+
+        self.clock.advance_time(600)
+        self.store.insert_client_ip(self.user, "token", "1.2.3.4", "agent")
+        self.store.insert_client_ip(self.user, "token", "5.6.7.8", "agent")
+
+        sessions = yield self.store.get_user_ip_and_agents(self.user)
+        self.assertEquals(
+            sorted((s["ip"], s["last_seen"]) for s in sessions),
+            [
+                ("1.2.3.4", self.clock.time_msec()),
+                ("5.6.7.8", self.clock.time_msec()),
+            ],
+        )
+
+        yield self.store._update_client_ips_batch()
+
+        rows = yield self.store._simple_select_list(
+            "user_ips", {"user_id": self.user.to_string()}, ["ip", "last_seen"],
+        )
+        self.assertEquals(len(rows), 2)
+        self.assertTrue(all(
+            row["last_seen"] == self.clock.time_msec() for row in rows
+        ))
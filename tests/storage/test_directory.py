@@ -17,7 +17,6 @@
 from tests import unittest
 from twisted.internet import defer
 
-from synapse.storage.directory import DirectoryStore
 from synapse.types import RoomID, RoomAlias
 
 from tests.utils import setup_test_homeserver
@@ -29,7 +28,9 @@ class DirectoryStoreTestCase(unittest.TestCase):
     def setUp(self):
         hs = yield setup_test_homeserver()
 
-        self.store = DirectoryStore(hs)
+        # Aliases are also tracked for application services, so this needs
+        # the full datastore.
+        self.store = hs.get_datastore()
 
         self.room = RoomID.from_string("!abcde:test")
         self.alias = RoomAlias.from_string("#my-room:test")
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.types import RoomID, UserID
+
+from tests.storage.event_injector import EventInjector
+from tests.utils import setup_test_homeserver
+
+
+class ForwardExtremitiesTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(
+            resource_for_federation=Mock(),
+            http_client=None,
+        )
+
+        self.store = hs.get_datastore()
+        self.event_injector = EventInjector(hs)
+
+        self.room = RoomID.from_string("!abc123:test")
+        self.user = UserID.from_string("@alice:test")
+
+        yield self.event_injector.create_room(self.room)
+
+    def _get_latest_from_db(self):
+        return self.store.runInteraction(
+            "get_latest_event_ids_and_hashes_in_room",
+            self.store._get_latest_event_ids_and_hashes_in_room,
+            self.room.to_string(),
+        )
+
+    @defer.inlineCallbacks
+    def test_extremities_are_kept_in_memory(self):
+        # Load the extremities into memory.
+        yield self.store.get_latest_event_ids_and_hashes_in_room(
+            self.room.to_string()
+        )
+
+        for i in range(3):
+            event = yield self.event_injector.inject_message(
+                self.room, self.user, "message %d" % (i,)
+            )
+
+            runInteraction = self.store.runInteraction
+            self.store.runInteraction = Mock(side_effect=runInteraction)
+
+            latest = yield self.store.get_latest_event_ids_and_hashes_in_room(
+                self.room.to_string()
+            )
+
+            self.assertEquals(0, self.store.runInteraction.call_count)
+            self.store.runInteraction = runInteraction
+
+            self.assertEquals([event.event_id], [e_id for e_id, _, _ in latest])
+
+            from_db = yield self._get_latest_from_db()
+            self.assertEquals(from_db, latest)
+
+    @defer.inlineCallbacks
+    def test_clean_room_for_join(self):
+        yield self.store.get_latest_event_ids_and_hashes_in_room(
+            self.room.to_string()
+        )
+
+        yield self.store.clean_room_for_join(self.room.to_string())
+
+        latest = yield self.store.get_latest_event_ids_and_hashes_in_room(
+            self.room.to_string()
+        )
+        self.assertEquals([], latest)
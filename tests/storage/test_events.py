@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from mock import Mock
+from synapse.api.constants import EventTypes
 from synapse.types import RoomID, UserID
 
 from tests import unittest
@@ -94,6 +95,153 @@ class EventsStoreTestCase(unittest.TestCase):
         self.assertEqual(3, count)
         self._assert_stats_reporting(8, self.hs.clock.now)
 
+    @defer.inlineCallbacks
+    def _create_messages(self, room, user, count):
+        builder_factory = self.hs.get_event_builder_factory()
+
+        events = []
+        for i in range(count):
+            builder = builder_factory.new({
+                "type": EventTypes.Message,
+                "sender": user.to_string(),
+                "room_id": room.to_string(),
+                "content": {"body": "message %d" % (i,), "msgtype": u"message"},
+            })
+            event, context = yield self.message_handler._create_new_client_event(
+                builder
+            )
+            events.append((event, context))
+
+        defer.returnValue(events)
+
+    @defer.inlineCallbacks
+    def test_persist_event_batches_room(self):
+        room = RoomID.from_string("!abc123:test")
+        user = UserID.from_string("@raccoonlover:test")
+        yield self.event_injector.create_room(room)
+
+        events = yield self._create_messages(room, user, 10)
+
+        runInteraction = self.store.runInteraction
+        self.store.runInteraction = Mock(side_effect=runInteraction)
+
+        results = yield defer.gatherResults([
+            self.store.persist_event(event, context)
+            for event, context in events
+        ])
+
+        # The first event is persisted straight away, and the rest are
+        # persisted together once it has finished.
+        self.assertEquals(2, self.store.runInteraction.call_count)
+
+        stream_orderings = [stream_ordering for stream_ordering, _ in results]
+        self.assertEquals(sorted(stream_orderings), stream_orderings)
+        self.assertEquals(len(events), len(set(stream_orderings)))
+
+        self.store.runInteraction = runInteraction
+        persisted = yield self.store.get_events([e.event_id for e, _ in events])
+        self.assertEquals(len(events), len(persisted))
+
+    @defer.inlineCallbacks
+    def test_persist_event_failure_is_isolated(self):
+        room = RoomID.from_string("!abc123:test")
+        user = UserID.from_string("@raccoonlover:test")
+        yield self.event_injector.create_room(room)
+
+        events = yield self._create_messages(room, user, 4)
+        bad_event_id = events[2][0].event_id
+
+        persist_events_txn = self.store._persist_events_txn
+
+        def _persist_events_txn(txn, events_and_contexts, **kwargs):
+            if any(e.event_id == bad_event_id for e, _ in events_and_contexts):
+                raise Exception("Failed to persist event")
+            return persist_events_txn(txn, events_and_contexts, **kwargs)
+
+        self.store._persist_events_txn = _persist_events_txn
+
+        deferreds = [
+            self.store.persist_event(event, context)
+            for event, context in events
+        ]
+
+        for i, deferred in enumerate(deferreds):
+            if i == 2:
+                with self.assertRaises(Exception):
+                    yield deferred
+            else:
+                yield deferred
+
+        persisted = yield self.store.get_events([e.event_id for e, _ in events])
+        self.assertEquals(
+            set(e.event_id for e, _ in events) - set([bad_event_id]),
+            set(persisted),
+        )
+
+    @defer.inlineCallbacks
+    def test_persist_event_batch_with_rejected_state(self):
+        room = RoomID.from_string("!abc123:test")
+        user = UserID.from_string("@raccoonlover:test")
+        yield self.event_injector.create_room(room)
+
+        builder_factory = self.hs.get_event_builder_factory()
+        events = yield self._create_messages(room, user, 1)
+        for state_key in ("rejected", "accepted"):
+            builder = builder_factory.new({
+                "type": "org.example.state",
+                "state_key": state_key,
+                "sender": user.to_string(),
+                "room_id": room.to_string(),
+                "content": {},
+            })
+            event, context = yield self.message_handler._create_new_client_event(
+                builder
+            )
+            events.append((event, context))
+
+        rejected_event, rejected_context = events[1]
+        accepted_event, _ = events[2]
+        rejected_context.rejected = "auth_error"
+
+        runInteraction = self.store.runInteraction
+        self.store.runInteraction = Mock(side_effect=runInteraction)
+
+        # The message is persisted straight away, and the two state events
+        # are persisted together in the next batch.
+        yield defer.gatherResults([
+            self.store.persist_event(event, context)
+            for event, context in events
+        ])
+        self.assertEquals(2, self.store.runInteraction.call_count)
+        self.store.runInteraction = runInteraction
+
+        rejections = yield self.store._simple_select_onecol(
+            table="rejections",
+            keyvalues={"event_id": rejected_event.event_id},
+            retcol="reason",
+        )
+        self.assertEquals(["auth_error"], rejections)
+
+        rejections = yield self.store._simple_select_onecol(
+            table="rejections",
+            keyvalues={"event_id": accepted_event.event_id},
+            retcol="reason",
+        )
+        self.assertEquals([], rejections)
+
+        current_state = yield self.store._simple_select_list(
+            table="current_state_events",
+            keyvalues={
+                "room_id": room.to_string(),
+                "type": "org.example.state",
+            },
+            retcols=("state_key", "event_id"),
+        )
+        self.assertEquals(
+            [{"state_key": "accepted", "event_id": accepted_event.event_id}],
+            current_state,
+        )
+
     @defer.inlineCallbacks
     def _get_last_stream_token(self):
         rows = yield self.db_pool.runQuery(
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.storage.media_repository import MediaRepositoryStore
+
+from tests.utils import setup_test_homeserver
+
+
+class RemoteMediaCacheStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver()
+
+        self.clock = hs.get_clock()
+        self.store = MediaRepositoryStore(hs)
+
+    @defer.inlineCallbacks
+    def _store_media(self, media_id, media_length):
+        yield self.store.store_cached_remote_media(
+            origin="remote",
+            media_id=media_id,
+            media_type="image/png",
+            media_length=media_length,
+            time_now_ms=self.clock.time_msec(),
+            upload_name=None,
+            filesystem_id="fs_" + media_id,
+        )
+        self.clock.advance_time(1)
+
+    @defer.inlineCallbacks
+    def test_cache_size(self):
+        yield self._store_media("a", 100)
+        yield self._store_media("b", 200)
+        yield self.store.store_remote_media_thumbnail(
+            "remote", "a", "fs_a", 32, 32, "image/png", "crop", 10,
+        )
+
+        size = yield self.store.get_remote_media_cache_size()
+        self.assertEquals(size, 310)
+
+        yield self.store.mark_remote_media_cold("remote", "a", 1000)
+
+        size = yield self.store.get_remote_media_cache_size()
+        self.assertEquals(size, 200)
+
+    @defer.inlineCallbacks
+    def test_least_recently_accessed(self):
+        yield self._store_media("a", 100)
+        yield self._store_media("b", 200)
+        yield self.store.store_remote_media_thumbnail(
+            "remote", "a", "fs_a", 32, 32, "image/png", "crop", 10,
+        )
+
+        rows = yield self.store.get_least_recently_accessed_remote_media(10)
+        self.assertEquals([r["media_id"] for r in rows], ["a", "b"])
+        self.assertEquals([r["size"] for r in rows], [110, 200])
+
+        # Access times are batched up until they are flushed
+        self.store.mark_remote_media_accessed("remote", "a")
+        rows = yield self.store.get_least_recently_accessed_remote_media(10)
+        self.assertEquals([r["media_id"] for r in rows], ["a", "b"])
+
+        yield self.store._flush_remote_media_accesses()
+        rows = yield self.store.get_least_recently_accessed_remote_media(10)
+        self.assertEquals([r["media_id"] for r in rows], ["b", "a"])
+
+    @defer.inlineCallbacks
+    def test_unknown_length(self):
+        yield self._store_media("a", None)
+        yield self._store_media("b", 200)
+
+        size = yield self.store.get_remote_media_cache_size()
+        self.assertEquals(size, 200)
+
+        rows = yield self.store.get_least_recently_accessed_remote_media(10)
+        self.assertEquals([r["size"] for r in rows], [0, 200])
+
+    @defer.inlineCallbacks
+    def test_delete(self):
+        yield self._store_media("a", 100)
+        yield self.store.store_remote_media_thumbnail(
+            "remote", "a", "fs_a", 32, 32, "image/png", "crop", 10,
+        )
+
+        yield self.store.delete_remote_media("remote", "a")
+
+        media = yield self.store.get_cached_remote_media("remote", "a")
+        self.assertIsNone(media)
+        thumbnails = yield self.store.get_remote_media_thumbnails("remote", "a")
+        self.assertEquals(thumbnails, [])
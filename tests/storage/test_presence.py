@@ -17,7 +17,7 @@
 from tests import unittest
 from twisted.internet import defer
 
-from synapse.storage.presence import PresenceStore
+from synapse.storage.presence import PresenceStore, UserPresenceState
 from synapse.types import UserID
 
 from tests.utils import setup_test_homeserver, MockClock
@@ -133,3 +133,64 @@ class PresenceStoreTestCase(unittest.TestCase):
                 accepted=True,
             ))
         )
+
+    @defer.inlineCallbacks
+    def test_observers_for_users(self):
+        yield self.store.add_presence_list_pending(
+            observer_localpart=self.u_apple.localpart,
+            observed_userid=self.u_banana.to_string(),
+        )
+
+        observers = yield self.store.get_presence_list_observers_accepted_for_users(
+            [self.u_apple.to_string(), self.u_banana.to_string()]
+        )
+        self.assertEquals({
+            self.u_apple.to_string(): [],
+            self.u_banana.to_string(): [],
+        }, observers)
+
+        yield self.store.set_presence_list_accepted(
+            observer_localpart=self.u_apple.localpart,
+            observed_userid=self.u_banana.to_string(),
+        )
+
+        observers = yield self.store.get_presence_list_observers_accepted_for_users(
+            [self.u_apple.to_string(), self.u_banana.to_string()]
+        )
+        self.assertEquals({
+            self.u_apple.to_string(): [],
+            self.u_banana.to_string(): [self.u_apple.to_string()],
+        }, observers)
+
+
+class PresenceStreamIdsTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver(clock=MockClock())
+
+        self.store = hs.get_datastore()
+
+    @defer.inlineCallbacks
+    def test_take_presence_stream_ids_reserves_ids(self):
+        states = [
+            UserPresenceState.default(user_id)
+            for user_id in ("@apple:test", "@banana:test")
+        ]
+
+        stream_ids = yield self.store.take_presence_stream_ids(states)
+
+        # The ids are handed out before being persisted, so the database must
+        # record a high-water mark above them for a restart to resume from.
+        self.assertEquals(stream_ids[-1], self.store.get_current_presence_token())
+
+        def get_reserved_id(txn):
+            txn.execute("SELECT stream_id FROM presence_stream_max_id")
+            return txn.fetchone()[0]
+
+        reserved_id = yield self.store.runInteraction("test", get_reserved_id)
+        self.assertTrue(reserved_id >= stream_ids[-1])
+
+        yield self.store.persist_presence(stream_ids, states)
+        rows = yield self.store.get_all_presence_updates(0, stream_ids[-1])
+        self.assertEquals(stream_ids, sorted(row[0] for row in rows))
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests import unittest
+from twisted.internet import defer
+
+from synapse.storage.receipts import _RoomReceipts
+
+from tests.utils import setup_test_homeserver
+
+
+class ReceiptsStoreTestCase(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        hs = yield setup_test_homeserver()
+
+        self.store = hs.get_datastore()
+
+    @defer.inlineCallbacks
+    def _insert(self, room_id, user_id, event_id):
+        res = yield self.store.insert_receipt(
+            room_id, "m.read", user_id, [event_id], {"ts": 1}
+        )
+        defer.returnValue(res[0])
+
+    @defer.inlineCallbacks
+    def _get_content(self, room_ids, from_key):
+        events = yield self.store.get_linearized_receipts_for_rooms(
+            room_ids,
+            to_key=self.store.get_max_receipt_stream_id(),
+            from_key=from_key,
+        )
+        defer.returnValue({e["room_id"]: e["content"] for e in events})
+
+    @defer.inlineCallbacks
+    def test_receipts_for_rooms(self):
+        yield self._insert("!a:test", "@alice:test", "$1:test")
+        stream_id = yield self._insert("!a:test", "@bob:test", "$2:test")
+        yield self._insert("!b:test", "@bob:test", "$3:test")
+
+        content = yield self._get_content(["!a:test", "!b:test"], None)
+        self.assertEquals(content, {
+            "!a:test": {
+                "$1:test": {"m.read": {"@alice:test": {"ts": 1}}},
+                "$2:test": {"m.read": {"@bob:test": {"ts": 1}}},
+            },
+            "!b:test": {
+                "$3:test": {"m.read": {"@bob:test": {"ts": 1}}},
+            },
+        })
+
+        content = yield self._get_content(["!a:test", "!b:test"], stream_id)
+        self.assertEquals(content, {
+            "!b:test": {
+                "$3:test": {"m.read": {"@bob:test": {"ts": 1}}},
+            },
+        })
+
+    @defer.inlineCallbacks
+    def test_snapshot_is_updated(self):
+        stream_id = yield self._insert("!a:test", "@alice:test", "$1:test")
+
+        yield self._get_content(["!a:test"], None)
+        self.assertIsNotNone(self.store._receipt_snapshots.get("!a:test"))
+
+        yield self._insert("!a:test", "@bob:test", "$2:test")
+
+        content = yield self._get_content(["!a:test"], stream_id)
+        self.assertEquals(content, {
+            "!a:test": {
+                "$2:test": {"m.read": {"@bob:test": {"ts": 1}}},
+            },
+        })
+
+
+class RoomReceiptsTestCase(unittest.TestCase):
+
+    def test_get_changed(self):
+        receipts = _RoomReceipts()
+        receipts.update("m.read", "@alice:test", "$1:test", {}, 1)
+        receipts.update("m.read", "@bob:test", "$2:test", {}, 2)
+        receipts.update("m.read", "@alice:test", "$3:test", {}, 3)
+
+        self.assertEquals(
+            receipts.get_changed(1, 3),
+            [
+                ("m.read", "@alice:test", "$3:test", {}),
+                ("m.read", "@bob:test", "$2:test", {}),
+            ]
+        )
+        self.assertEquals(
+            receipts.get_changed(1, 2),
+            [("m.read", "@bob:test", "$2:test", {})]
+        )
+
+    def test_out_of_order_updates(self):
+        receipts = _RoomReceipts()
+        receipts.update("m.read", "@alice:test", "$1:test", {}, 1)
+        receipts.update("m.read", "@bob:test", "$3:test", {}, 3)
+        receipts.update("m.read", "@carol:test", "$2:test", {}, 2)
+
+        # an older receipt doesn't replace a newer one
+        receipts.update("m.read", "@bob:test", "$0:test", {}, 0)
+
+        self.assertEquals(
+            receipts.get_changed(2, 3),
+            [("m.read", "@bob:test", "$3:test", {})]
+        )
+        self.assertEquals(
+            receipts.get_changed(1, 3),
+            [
+                ("m.read", "@bob:test", "$3:test", {}),
+                ("m.read", "@carol:test", "$2:test", {}),
+            ]
+        )
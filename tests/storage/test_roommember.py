@@ -36,6 +36,7 @@ class RoomMemberStoreTestCase(unittest.TestCase):
         # We can't test the RoomMemberStore on its own without the other event
         # storage logic
         self.store = hs.get_datastore()
+        self.db_pool = hs.get_db_pool()
         self.event_builder_factory = hs.get_event_builder_factory()
         self.handlers = hs.get_handlers()
         self.message_handler = self.handlers.message_handler
@@ -144,3 +145,119 @@ class RoomMemberStoreTestCase(unittest.TestCase):
             {"test"},
             (yield self.store.get_joined_hosts_for_room(self.room.to_string()))
         )
+
+    @defer.inlineCallbacks
+    def test_bulk_lookups(self):
+        room2 = RoomID.from_string("!def456:test")
+
+        yield self.inject_room_member(self.room, self.u_alice, Membership.JOIN)
+        yield self.inject_room_member(room2, self.u_alice, Membership.JOIN)
+        yield self.inject_room_member(room2, self.u_charlie, Membership.JOIN)
+
+        rooms = yield self.store.get_rooms_for_users([
+            self.u_alice.to_string(), self.u_bob.to_string(),
+        ])
+        self.assertEquals(
+            {self.room.to_string(), room2.to_string()},
+            {r.room_id for r in rooms[self.u_alice.to_string()]}
+        )
+        self.assertEquals([], rooms[self.u_bob.to_string()])
+
+        hosts = yield self.store.get_joined_hosts_for_rooms([
+            self.room.to_string(), room2.to_string(),
+        ])
+        self.assertEquals({
+            self.room.to_string(): {"test"},
+            room2.to_string(): {"test", "elsewhere"},
+        }, hosts)
+
+    @defer.inlineCallbacks
+    def test_users_who_share_room_with_user(self):
+        room2 = RoomID.from_string("!def456:test")
+
+        yield self.inject_room_member(self.room, self.u_alice, Membership.JOIN)
+        yield self.inject_room_member(self.room, self.u_bob, Membership.JOIN)
+        yield self.inject_room_member(room2, self.u_charlie, Membership.JOIN)
+
+        users = yield self.store.get_users_who_share_room_with_user(
+            self.u_alice.to_string()
+        )
+        self.assertEquals(
+            {self.u_alice.to_string(), self.u_bob.to_string()}, users
+        )
+
+        # Someone else joining one of alice's rooms updates her entry
+        yield self.inject_room_member(self.room, self.u_charlie, Membership.JOIN)
+        users = yield self.store.get_users_who_share_room_with_user(
+            self.u_alice.to_string()
+        )
+        self.assertEquals({
+            self.u_alice.to_string(), self.u_bob.to_string(),
+            self.u_charlie.to_string(),
+        }, users)
+
+        # As does alice joining another room
+        yield self.inject_room_member(room2, self.u_alice, Membership.JOIN)
+        yield self.inject_room_member(self.room, self.u_bob, Membership.LEAVE)
+        users = yield self.store.get_users_who_share_room_with_user(
+            self.u_alice.to_string()
+        )
+        self.assertEquals(
+            {self.u_alice.to_string(), self.u_charlie.to_string()}, users
+        )
+
+        users = yield self.store.get_users_who_share_room_with_user(
+            self.u_bob.to_string()
+        )
+        self.assertEquals(frozenset(), users)
+
+    @defer.inlineCallbacks
+    def test_load_membership_index(self):
+        room2 = RoomID.from_string("!def456:test")
+
+        yield self.inject_room_member(self.room, self.u_alice, Membership.JOIN)
+        yield self.inject_room_member(self.room, self.u_bob, Membership.JOIN)
+        yield self.inject_room_member(room2, self.u_charlie, Membership.JOIN)
+        yield self.inject_room_member(self.room, self.u_bob, Membership.LEAVE)
+
+        # The index that would be loaded on startup matches the one that has
+        # been kept up to date in memory
+        index = yield self.db_pool.runWithConnection(
+            self.store._load_membership_index
+        )
+
+        for room in (self.room, room2):
+            self.assertEquals(
+                sorted((yield self.store.get_users_in_room(room.to_string()))),
+                sorted(index.get_users_in_room(room.to_string())),
+            )
+
+        for user in (self.u_alice, self.u_bob, self.u_charlie):
+            self.assertEquals(
+                sorted((yield self.store.get_rooms_for_user(user.to_string()))),
+                sorted(index.get_rooms_for_user(user.to_string())),
+            )
+
+        self.assertEquals([], index.get_rooms_for_user(self.u_bob.to_string()))
+        self.assertEquals({"test"}, index.get_hosts_in_room(self.room.to_string()))
+        self.assertEquals({"elsewhere"}, index.get_hosts_in_room(room2.to_string()))
+
+    @defer.inlineCallbacks
+    def test_joined_hosts(self):
+        u_dave = UserID.from_string("@dave:elsewhere")
+
+        yield self.inject_room_member(self.room, self.u_alice, Membership.JOIN)
+        yield self.inject_room_member(self.room, self.u_charlie, Membership.JOIN)
+        yield self.inject_room_member(self.room, u_dave, Membership.JOIN)
+
+        hosts = yield self.store.get_joined_hosts_for_room(self.room.to_string())
+        self.assertEquals({"test", "elsewhere"}, hosts)
+
+        # A server stays in the room until its last user leaves
+        yield self.inject_room_member(self.room, self.u_charlie, Membership.LEAVE)
+        hosts = yield self.store.get_joined_hosts_for_room(self.room.to_string())
+        self.assertEquals({"test", "elsewhere"}, hosts)
+
+        yield self.inject_room_member(self.room, u_dave, Membership.LEAVE)
+        hosts = yield self.store.get_joined_hosts_for_room(self.room.to_string())
+        self.assertEquals({"test"}, hosts)
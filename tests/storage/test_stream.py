@@ -183,3 +183,117 @@ class StreamStoreTestCase(unittest.TestCase):
             "prev_content" in event.unsigned,
             msg="No prev_content key"
         )
+
+    @defer.inlineCallbacks
+    def test_room_events_stream_for_rooms(self):
+        rooms = [self.room1, self.room2]
+        for room in rooms:
+            yield self.event_injector.create_room(room)
+            yield self.event_injector.inject_room_member(
+                room, self.u_alice, Membership.JOIN
+            )
+
+        start = yield self.store.get_room_events_max_id()
+
+        for i in range(5):
+            yield self.event_injector.inject_message(
+                self.room1, self.u_alice, u"message %d" % (i,)
+            )
+        yield self.event_injector.inject_message(
+            self.room2, self.u_alice, u"message"
+        )
+
+        end = yield self.store.get_room_events_max_id()
+
+        for order in ("DESC", "ASC"):
+            results = yield self.store.get_room_events_stream_for_rooms(
+                [room.to_string() for room in rooms], start, end,
+                limit=3, order=order,
+            )
+
+            self.assertEquals(
+                set(room.to_string() for room in rooms), set(results)
+            )
+
+            for room in rooms:
+                expected_events, expected_key = (
+                    yield self.store.get_room_events_stream_for_room(
+                        room.to_string(), start, end, limit=3, order=order,
+                    )
+                )
+                events, key = results[room.to_string()]
+
+                self.assertEquals(
+                    [e.event_id for e in expected_events],
+                    [e.event_id for e in events],
+                )
+                self.assertEquals(
+                    [e.internal_metadata.after for e in expected_events],
+                    [e.internal_metadata.after for e in events],
+                )
+                self.assertEquals(expected_key, key)
+
+        self.assertEquals(3, len(results[self.room1.to_string()][0]))
+        self.assertEquals(1, len(results[self.room2.to_string()][0]))
+
+    @defer.inlineCallbacks
+    def test_recent_event_ids_for_room(self):
+        yield self.event_injector.create_room(self.room1)
+        yield self.event_injector.inject_room_member(
+            self.room1, self.u_alice, Membership.JOIN
+        )
+
+        for i in range(8):
+            yield self.event_injector.inject_message(
+                self.room1, self.u_alice, u"message %d" % (i,)
+            )
+
+        room_id = self.room1.to_string()
+        end = yield self.store.get_room_events_max_id()
+        start = "s%d" % (self.store._stream_id_gen.get_max_token() - 6,)
+
+        @defer.inlineCallbacks
+        def check(limit, from_token=None):
+            rows, _ = yield self.store.get_recent_event_ids_for_room(
+                room_id, limit, end, from_token
+            )
+            expected = yield self.store.runInteraction(
+                "test", self.store._get_recent_events_for_room_txn,
+                room_id, limit,
+                self.store._stream_id_gen.get_max_token(),
+                int(from_token[1:]) if from_token else None,
+            )
+            self.assertEquals(
+                [r["event_id"] for r in reversed(expected)],
+                [r["event_id"] for r in rows],
+            )
+
+        # The first query loads the room's latest events, and the rest are
+        # served from memory unless they need older events.
+        yield check(3)
+
+        run_interaction = self.store.runInteraction
+        self.store.runInteraction = Mock(side_effect=run_interaction)
+
+        rows, _ = yield self.store.get_recent_event_ids_for_room(
+            room_id, 3, end
+        )
+        self.assertEquals(3, len(rows))
+        self.assertEquals(0, self.store.runInteraction.call_count)
+
+        event = yield self.event_injector.inject_message(
+            self.room1, self.u_alice, u"message"
+        )
+        self.store.runInteraction.reset_mock()
+        end = yield self.store.get_room_events_max_id()
+        rows, _ = yield self.store.get_recent_event_ids_for_room(
+            room_id, 3, end
+        )
+        self.assertEquals(event.event_id, rows[-1]["event_id"])
+        self.assertEquals(0, self.store.runInteraction.call_count)
+
+        self.store.runInteraction = run_interaction
+
+        for limit in (1, 5, 10, 20):
+            yield check(limit)
+            yield check(limit, start)
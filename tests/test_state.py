@@ -138,6 +138,8 @@ class StateTestCase(unittest.TestCase):
             spec_set=[
                 "get_state_groups",
                 "add_event_hashes",
+                "get_state_group_for_events",
+                "get_state_for_group",
             ]
         )
         hs = Mock(spec=[
@@ -521,6 +523,66 @@ class StateTestCase(unittest.TestCase):
 
         self.assertIsNone(context.state_group)
 
+    @defer.inlineCallbacks
+    def test_lazy_annotate_message(self):
+        event = create_event(
+            type="test_message", name="event",
+            prev_events=[("$prev1:test", {}), ("$prev2:test", {})],
+        )
+
+        state = {
+            ("test1", "1"): create_event(type="test1", state_key="1"),
+        }
+
+        group_name = "group_name_1"
+
+        self.store.get_state_group_for_events.return_value = defer.succeed({
+            "$prev1:test": group_name,
+            "$prev2:test": group_name,
+        })
+        self.store.get_state_for_group.return_value = defer.succeed(state)
+
+        context = yield self.state.compute_event_context(event, lazy=True)
+
+        self.assertIsNone(context.current_state)
+        self.assertEqual(group_name, context.state_group)
+        self.assertFalse(self.store.get_state_groups.called)
+
+        types = [("test1", None)]
+        loaded = yield context.get_current_state(types)
+
+        self.assertEqual(state, loaded)
+        self.store.get_state_for_group.assert_called_once_with(group_name, types)
+
+    @defer.inlineCallbacks
+    def test_lazy_annotate_message_with_conflict(self):
+        event = create_event(
+            type="test_message", name="event",
+            prev_events=[("$prev1:test", {}), ("$prev2:test", {})],
+        )
+
+        old_state = [
+            create_event(type="test1", state_key="1"),
+        ]
+
+        self.store.get_state_group_for_events.return_value = defer.succeed({
+            "$prev1:test": "group_name_1",
+            "$prev2:test": "group_name_2",
+        })
+        self.store.get_state_groups.return_value = {
+            "group_name_1": old_state,
+            "group_name_2": old_state,
+        }
+
+        context = yield self.state.compute_event_context(event, lazy=True)
+
+        # With more than one state group the state has to be resolved, so is
+        # loaded straight away.
+        self.assertEqual(
+            set([e.event_id for e in old_state]),
+            set([e.event_id for e in context.current_state.values()])
+        )
+
     @defer.inlineCallbacks
     def test_resolve_message_conflict(self):
         event = create_event(type="test_message", name="event")
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 OpenMarket Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from synapse.util.ratelimitutils import FederationRateLimiter
+
+from tests import unittest
+from tests.utils import MockClock
+
+
+class FederationRateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock()
+        self.limiter = FederationRateLimiter(
+            self.clock,
+            window_size=1000,
+            sleep_limit=2,
+            sleep_msec=10,
+            reject_limit=50,
+            concurrent_requests=3,
+        )
+
+    @defer.inlineCallbacks
+    def test_sleep_after_burst(self):
+        for _ in range(2):
+            with self.limiter.ratelimit("example.com") as d:
+                self.assertTrue(d.called)
+
+        with self.limiter.ratelimit("example.com") as d:
+            self.assertFalse(d.called)
+
+            # Other hosts are limited separately
+            with self.limiter.ratelimit("other.example.com") as other_d:
+                self.assertTrue(other_d.called)
+
+            yield d
+
+    def test_idle_hosts_are_forgotten(self):
+        with self.limiter.ratelimit("example.com") as d:
+            self.assertTrue(d.called)
+            self.assertIn("example.com", self.limiter.ratelimiters)
+
+        self.assertNotIn("example.com", self.limiter.ratelimiters)
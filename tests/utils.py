@@ -47,12 +47,20 @@ def setup_test_homeserver(name="test", datastore=None, config=None, **kargs):
         config = Mock()
         config.signing_key = [MockKey()]
         config.event_cache_size = 1
+        config.recent_events_per_room = 5
+        config.recent_events_cache_size = 10
         config.enable_registration = True
         config.macaroon_secret_key = "not even a little secret"
         config.server_name = "server.under.test"
         config.trusted_third_party_id_servers = []
         config.room_invite_state_types = []
 
+        config.federation_rc_window_size = 1000
+        config.federation_rc_sleep_limit = 10
+        config.federation_rc_sleep_delay = 500
+        config.federation_rc_reject_limit = 50
+        config.federation_rc_concurrent = 3
+
     config.database_config = {"name": "sqlite3"}
 
     if "clock" not in kargs: